@@ -0,0 +1,45 @@
+"""
+Microbenchmark: cost of an address lookup in Google/local networks.
+
+Run: python ./app/benchmarks/cidr_matcher.py [lookups]
+"""
+import ipaddress
+import random
+import socket
+import struct
+import sys
+import timeit
+
+from app.settings import GOOGLE_IPS, LOCAL_NETWORKS
+from app.utils.cidr_matcher import CIDRMatcher
+
+
+def parse_every_time(ip: str):
+    # previous implementation of `RemotePoint.is_google_ip`
+    return any([ipaddress.IPv4Address(ip) in ipaddress.IPv4Network(ip_mask) for ip_mask in GOOGLE_IPS])
+
+
+def main(lookups: int = 20000):
+    addresses = [socket.inet_ntoa(struct.pack('>I', random.getrandbits(32))) for _ in range(lookups)]
+
+    google_ips_matcher = CIDRMatcher(GOOGLE_IPS)
+    local_networks_matcher = CIDRMatcher(LOCAL_NETWORKS)
+
+    # results must not differ
+    assert all(parse_every_time(ip) == (ip in google_ips_matcher) for ip in addresses[:1000])
+
+    cases = {
+        'parse every time (google)': lambda: [parse_every_time(ip) for ip in addresses],
+        'CIDRMatcher (google)': lambda: [ip in google_ips_matcher for ip in addresses],
+        'CIDRMatcher (local)': lambda: [ip in local_networks_matcher for ip in addresses],
+        'CIDRMatcher build (google)': lambda: [CIDRMatcher(GOOGLE_IPS) for _ in range(lookups // 100)],
+    }
+
+    for name, case in cases.items():
+        seconds = min(timeit.repeat(case, number=1, repeat=3))
+        count = lookups // 100 if 'build' in name else lookups
+        print(f'{name:<30} {seconds / count * 1e9:>12.0f} ns/op')
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
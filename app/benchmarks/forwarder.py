@@ -0,0 +1,330 @@
+"""
+Benchmark of proxy forwarder server against local stand-ins: HTTP CONNECT proxy (as upstream provider)
+and echo/sink servers (as remotes). N SOCKS5 clients open tunnels concurrently and transfer data.
+
+Reports handshake and tunnel setup latency percentiles, setup rate, per-tunnel and aggregate throughput,
+CPU and RSS of server processes (Linux /proc) as JSON, so runs with different engines/settings can be compared.
+Server settings (PROXY_ENGINE, PROXY_WORKERS, RELAY_SPLICE, ...) are taken from environment.
+
+Run: python ./app/benchmarks/forwarder.py [--clients 50] [--size 10000000] [--mode echo|sink] [--route proxy|direct] [--output result.json]
+"""
+import argparse
+import json
+import os
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+CHUNK_SIZE = 65536
+PROXY_TARGET = '203.0.113.10' # documentation network: not local, so it's connected via upstream proxy
+DIRECT_TARGET = '127.0.0.1' # local network: connected directly
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def serve(handler):
+    """Threaded TCP server on localhost, @return: port"""
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(socket.SOMAXCONN)
+
+    def accept():
+        while True:
+            connection, _ = listener.accept()
+            threading.Thread(target=handler, args=(connection,), daemon=True).start()
+
+    threading.Thread(target=accept, daemon=True).start()
+    return listener.getsockname()[1]
+
+
+def pipe(source: socket.socket, target: socket.socket):
+    try:
+        while True:
+            data = source.recv(CHUNK_SIZE)
+            if not data:
+                break
+            target.sendall(data)
+    except OSError:
+        pass
+    finally:
+        for s in (source, target):
+            try:
+                s.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+
+def echo(connection: socket.socket):
+    pipe(connection, connection)
+
+
+def sink(connection: socket.socket):
+    """Receives size-prefixed payload, replies `ok` when all is received"""
+    with connection:
+        size, = struct.unpack('>Q', recv_exactly(connection, 8))
+        while size:
+            data = connection.recv(min(size, CHUNK_SIZE))
+            if not data:
+                return
+            size -= len(data)
+        connection.sendall(b'ok')
+
+
+def connect_proxy(connection: socket.socket):
+    """Stand-in of upstream provider: CONNECT to any address goes to local server of the port"""
+    request = b''
+    while b'\r\n\r\n' not in request:
+        data = connection.recv(4096)
+        if not data:
+            return connection.close()
+        request += data
+
+    port = int(request.split(b' ')[1].rsplit(b':', 1)[1])
+    remote = socket.create_connection(('127.0.0.1', port))
+    connection.sendall(b'HTTP/1.1 200 Connection established\r\n\r\n')
+
+    rest = request.split(b'\r\n\r\n', 1)[1]
+    if rest:
+        remote.sendall(rest)
+
+    threading.Thread(target=pipe, args=(remote, connection), daemon=True).start()
+    pipe(connection, remote)
+
+
+def recv_exactly(connection: socket.socket, size: int):
+    data = b''
+    while len(data) < size:
+        chunk = connection.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError('connection closed')
+        data += chunk
+    return data
+
+
+def open_tunnel(proxy_port: int, address: str, port: int, username: str, password: str):
+    """@return: (socket, handshake sec, setup sec)"""
+    started_at = time.perf_counter()
+    connection = socket.create_connection(('127.0.0.1', proxy_port), timeout=30)
+
+    connection.sendall(bytes([5, 1, 2]))
+    assert recv_exactly(connection, 2) == bytes([5, 2])
+    connection.sendall(bytes([1, len(username)]) + username.encode() + bytes([len(password)]) + password.encode())
+    assert recv_exactly(connection, 2) == bytes([1, 0])
+    handshake_s = time.perf_counter() - started_at
+
+    connection.sendall(bytes([5, 1, 0, 1]) + socket.inet_aton(address) + struct.pack('>H', port))
+    reply = recv_exactly(connection, 10)
+    assert reply[1] == 0, f'connection refused: {reply}'
+
+    return connection, handshake_s, time.perf_counter() - started_at
+
+
+def transfer(connection: socket.socket, size: int, mode: str):
+    """@return: seconds"""
+    payload = os.urandom(CHUNK_SIZE)
+    started_at = time.perf_counter()
+
+    if mode == 'sink':
+        connection.sendall(struct.pack('>Q', size))
+        for sent in range(0, size, CHUNK_SIZE):
+            connection.sendall(payload[:min(CHUNK_SIZE, size - sent)])
+        assert recv_exactly(connection, 2) == b'ok'
+
+    else:
+        def send():
+            for sent in range(0, size, CHUNK_SIZE):
+                connection.sendall(payload[:min(CHUNK_SIZE, size - sent)])
+
+        sender = threading.Thread(target=send)
+        sender.start()
+
+        received = 0
+        while received < size:
+            data = connection.recv(CHUNK_SIZE)
+            if not data:
+                raise ConnectionError('connection closed')
+            received += len(data)
+        sender.join()
+
+    return time.perf_counter() - started_at
+
+
+def percentiles(values: list, scale: float = 1000):
+    values = sorted(values)
+    if not values:
+        return {}
+
+    def at(p):
+        return round(values[min(len(values) - 1, int(len(values) * p))] * scale, 3)
+
+    return {'p50': at(0.5), 'p90': at(0.9), 'p99': at(0.99), 'max': round(values[-1] * scale, 3)}
+
+
+def server_processes(pid: int):
+    """Server and its worker processes"""
+    pids = [pid]
+    for child in pids:
+        try:
+            with open(f'/proc/{child}/task/{child}/children') as file:
+                pids.extend(map(int, file.read().split()))
+        except OSError:
+            pass
+    return pids
+
+
+def cpu_seconds(pid: int):
+    total = 0
+    for child in server_processes(pid):
+        try:
+            with open(f'/proc/{child}/stat') as file:
+                fields = file.read().rsplit(')', 1)[1].split()
+            total += (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+        except OSError:
+            pass
+    return total
+
+
+def rss_mb(pid: int):
+    total = 0
+    for child in server_processes(pid):
+        try:
+            with open(f'/proc/{child}/status') as file:
+                total += next(int(line.split()[1]) for line in file if line.startswith('VmRSS:')) / 1024
+        except (OSError, StopIteration):
+            pass
+    return round(total, 1)
+
+
+def run_clients(clients: int, function):
+    """Run function(i) in `clients` threads at once, @return: results"""
+    results = [None] * clients
+    barrier = threading.Barrier(clients)
+
+    def target(i):
+        barrier.wait()
+        try:
+            results[i] = function(i)
+        except Exception as exc:
+            results[i] = exc
+
+    threads = [threading.Thread(target=target, args=(i,)) for i in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return results
+
+
+def main(clients: int = 50, size: int = 10_000_000, mode: str = 'echo', route: str = 'proxy', output: str = None):
+    remote_port = serve(sink if mode == 'sink' else echo)
+    upstream_port = serve(connect_proxy)
+    proxy_port = free_port()
+
+    # settings of server, the same are read by this process to call its methods
+    os.environ.update(
+        PUBLIC_PROXY_PORT=str(proxy_port),
+        INSIDE_SOCKET_PORT=str(free_port()),
+        INSIDE_SOCKET_PATH=os.path.join(tempfile.mkdtemp(), 'pfs.sock'),
+        PROXY_HOST='127.0.0.1',
+        PROXY_PORT=str(upstream_port),
+        PROXY_USERNAME='benchmark',
+        PROXY_BASE_PASSWORD='benchmark',
+        LOG_LEVEL=os.environ.get('LOG_LEVEL', 'WARNING'),
+        MAX_TUNNELS_PER_HOST='0',
+    )
+    from app.server.ProxyForwarderServer import ProxyForwarderServer
+
+    server = subprocess.Popen([sys.executable, os.path.join(os.path.dirname(__file__), '..', 'server', 'ProxyForwarderServer.py')])
+
+    try:
+        # wait for control socket
+        for _ in range(150):
+            try:
+                ProxyForwarderServer.exists_entry_points([])
+                break
+            except ConnectionError:
+                time.sleep(0.1)
+
+        ProxyForwarderServer.create_entry_point(username='benchmark', password='benchmark', proxy_kwargs={'country': 'us'})
+        address = PROXY_TARGET if route == 'proxy' else DIRECT_TARGET
+
+        cpu_started = cpu_seconds(server.pid)
+        started_at = time.perf_counter()
+
+        # all clients open tunnels at once
+        tunnels = run_clients(clients, lambda i: open_tunnel(proxy_port, address, remote_port, 'benchmark', 'benchmark'))
+        setup_s = time.perf_counter() - started_at
+        errors = [repr(tunnel) for tunnel in tunnels if isinstance(tunnel, Exception)]
+        tunnels = [tunnel for tunnel in tunnels if not isinstance(tunnel, Exception)]
+
+        # all tunnels transfer at once
+        transfer_started_at = time.perf_counter()
+        seconds = run_clients(len(tunnels), lambda i: transfer(tunnels[i][0], size, mode))
+        transfer_s = time.perf_counter() - transfer_started_at
+        errors += [repr(s) for s in seconds if isinstance(s, Exception)]
+        seconds = [s for s in seconds if not isinstance(s, Exception)]
+
+        cpu_s = cpu_seconds(server.pid) - cpu_started
+        rss = rss_mb(server.pid)
+        wall_s = time.perf_counter() - started_at
+
+        for tunnel in tunnels:
+            tunnel[0].close()
+
+        # payload crosses the forwarder twice for echo
+        relayed_b = size * len(seconds) * (2 if mode == 'echo' else 1)
+
+        result = {
+            'settings': {
+                'clients': clients,
+                'size_b': size,
+                'mode': mode,
+                'route': route,
+                'engine': os.environ.get('PROXY_ENGINE', 'threading'),
+                'workers': os.environ.get('PROXY_WORKERS', '1'),
+                'splice': os.environ.get('RELAY_SPLICE', 'default'),
+            },
+            'tunnels': len(tunnels),
+            'errors': errors,
+            'handshake_ms': percentiles([tunnel[1] for tunnel in tunnels]),
+            'setup_ms': percentiles([tunnel[2] for tunnel in tunnels]),
+            'setup_per_s': round(len(tunnels) / setup_s, 1),
+            'tunnel_mb_per_s': percentiles([size / s for s in seconds], 1e-6),
+            'aggregate_mb_per_s': round(relayed_b / transfer_s / 1e6, 1),
+            'cpu_s': round(cpu_s, 2),
+            'cpu_percent': round(cpu_s / wall_s * 100, 1),
+            'rss_mb': rss,
+        }
+
+        ProxyForwarderServer.terminate()
+        server.wait(10)
+    finally:
+        if server.poll() is None:
+            server.terminate()
+            server.wait()
+
+    text = json.dumps(result, indent=2)
+    if output:
+        with open(output, 'w') as file:
+            file.write(text)
+    print(text)
+    return result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--clients', type=int, default=50)
+    parser.add_argument('--size', type=int, default=10_000_000, help='bytes per client')
+    parser.add_argument('--mode', choices=['echo', 'sink'], default='echo')
+    parser.add_argument('--route', choices=['proxy', 'direct'], default='proxy')
+    parser.add_argument('--output', help='JSON file of result')
+    main(**vars(parser.parse_args()))
@@ -0,0 +1,88 @@
+"""
+Microbenchmark: SOCKS5 handshakes per second read from a socket (client sends greeting, auth and request at once).
+
+Run: python ./app/benchmarks/socks5_handshake.py [handshakes]
+"""
+import socket
+import struct
+import sys
+import threading
+import timeit
+
+from app.utils.socks5 import Socks5Parser, recv_message
+
+GREETING = bytes([5, 1, 2])
+AUTH = bytes([1, 8]) + b'username' + bytes([8]) + b'password'
+REQUEST = bytes([5, 1, 0, 3, 11]) + b'example.com' + struct.pack('>H', 443)
+HANDSHAKE = GREETING + AUTH + REQUEST
+
+
+def read_per_field(connection: socket.socket):
+    # previous implementation: `recv` per field, short reads are not handled
+    version, nmethods = connection.recv(2)
+    methods = [ord(connection.recv(1)) for i in range(nmethods)]
+    version = ord(connection.recv(1))
+    username = connection.recv(ord(connection.recv(1))).decode('utf-8')
+    password = connection.recv(ord(connection.recv(1))).decode('utf-8')
+    version, cmd, _, address_type = connection.recv(4)
+    domain = connection.recv(connection.recv(1)[0]).decode('utf-8')
+    port = int.from_bytes(connection.recv(2), 'big', signed=False)
+    return domain, port
+
+
+def buffered_reader():
+    leftover = b''
+
+    def read_buffered(connection: socket.socket):
+        nonlocal leftover
+
+        # bytes of the next handshake were read in bulk with the previous one
+        parser = Socks5Parser()
+        parser.buffer += leftover
+
+        recv_message(connection, parser, 10)
+        recv_message(connection, parser, 10)
+        cmd, address_type, domain, port = recv_message(connection, parser, 10)
+
+        leftover = parser.leftover()
+        return domain, port
+
+    return read_buffered
+
+
+def parse_only():
+    parser = Socks5Parser()
+    parser.feed(HANDSHAKE)
+    parser.feed()
+    return parser.feed()[2:]
+
+
+def over_socket(read, handshakes: int):
+    client, server = socket.socketpair()
+
+    # client doesn't wait for replies, so the cost is reading only
+    sender = threading.Thread(target=client.sendall, args=(HANDSHAKE * handshakes,))
+    sender.start()
+
+    for _ in range(handshakes):
+        assert read(server) == ('example.com', 443)
+
+    sender.join()
+    client.close()
+    server.close()
+
+
+def main(handshakes: int = 20000):
+    cases = {
+        'recv per field': lambda: over_socket(read_per_field, handshakes),
+        'buffered parser': lambda: over_socket(buffered_reader(), handshakes),
+        'parser only (no socket)': lambda: [parse_only() for _ in range(handshakes)],
+    }
+
+    for name, case in cases.items():
+        seconds = min(timeit.repeat(case, number=1, repeat=3))
+        print(f'{name:<30} {handshakes / seconds:>12.0f} handshakes/s')
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,51 @@
+"""
+Memory benchmark: python heap per idle tunnel and left by closed tunnels in entry point.
+
+Run: python ./app/benchmarks/tunnel_memory.py [tunnels]
+"""
+import gc
+import socket
+import sys
+import tracemalloc
+
+from app.objetcs.EntryPoint import EntryPoint
+from app.objetcs.ForwarderProxy import ForwarderProxy
+
+
+def main(tunnels: int = 2000):
+    entry_point = EntryPoint('benchmark', 'benchmark', ForwarderProxy(country='us'), '127.0.0.1')
+
+    # sockets are not part of measurement (kernel memory mostly)
+    socket_pairs = [socket.socketpair() for _ in range(tunnels)]
+
+    gc.collect()
+    tracemalloc.start()
+    started_b = tracemalloc.get_traced_memory()[0]
+
+    # idle tunnels: connected, no traffic
+    remote_points = []
+    for i, (client_socket, server_socket) in enumerate(socket_pairs):
+        remote_point = entry_point.create_remote_point(f'10.0.{i // 250}.{i % 250}', 443, client_socket, connect=False)
+        remote_point.server_socket = server_socket
+        remote_point.is_active = True
+        remote_points.append(remote_point)
+
+    gc.collect()
+    idle_b = tracemalloc.get_traced_memory()[0] - started_b
+
+    # closed tunnels: only entry point may keep them
+    for remote_point in remote_points:
+        remote_point.close()
+    remote_points.clear()
+
+    gc.collect()
+    closed_b = tracemalloc.get_traced_memory()[0] - started_b
+    tracemalloc.stop()
+
+    print(f'{"idle tunnel":<30} {idle_b / tunnels:>10.0f} B/tunnel')
+    print(f'{"closed tunnel (kept)":<30} {closed_b / tunnels:>10.0f} B/tunnel')
+    print(f'{"usage":<30} {entry_point.usage()}')
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,131 @@
+import hashlib
+import mmap
+import os
+import re
+import threading
+from typing import Optional
+
+from decouple import config
+
+from app.utils.get_logger import get_logger
+
+CAPTURE_DIR = config('INSPECTOR_CAPTURE_DIR', default='captures') # directory per entry point inside
+CAPTURE_FILE_SIZE = config('INSPECTOR_CAPTURE_FILE_B', default=64 * 1024 * 1024, cast=int) # preallocated size of file
+CAPTURE_FILES = config('INSPECTOR_CAPTURE_FILES', default=16, cast=int) # files kept per entry point, 0 - all
+
+FILE_HEADER = b'PFSC\x00\x01\x00\x00' # magic, version of format
+FILE_NAME = re.compile(r'^capture-(\d+)\.pfsc$')
+SAFE_NAME = re.compile(r'^[A-Za-z0-9_@-][A-Za-z0-9_.@-]*$') # username used as directory name as is
+
+logger = get_logger(__name__)
+
+
+def capture_directory(username: str, worker: int = 0):
+    """
+    Capture directory of entry point: <CAPTURE_DIR>/<username>, workers of supervisor have own <username>/worker-N.
+
+    Username which is not a safe file name is replaced by its safe characters with a hash suffix.
+
+    @raise ValueError: directory is outside of CAPTURE_DIR
+    """
+    name = username
+    if not SAFE_NAME.match(name):
+        name = re.sub(r'[^A-Za-z0-9_@-]', '_', username) + '-' + hashlib.sha256(username.encode()).hexdigest()[:16]
+
+    directory = os.path.join(CAPTURE_DIR, name)
+    if worker:
+        directory = os.path.join(directory, f'worker-{worker}')
+
+    root = os.path.realpath(CAPTURE_DIR)
+    if os.path.commonpath([root, os.path.realpath(directory)]) != root:
+        raise ValueError(f'capture directory of `{username}` is outside of {CAPTURE_DIR}')
+
+    return directory
+
+
+class CaptureFile:
+    """
+    Inspected traffic appended to rotating capture files in directory (see `app.utils.read_capture`).
+
+    File is preallocated and written through mmap, trimmed to the written size when it's rotated or closed.
+    Writes are whole batches of frames, so a frame never spans files. The oldest files over `max_files` are deleted.
+
+    Has `sendall` and `close` of socket, so it's a target of InspectorWriter.
+    """
+
+    directory: str
+    file_size: int
+    max_files: int
+
+    index: int # number of current file
+    file: Optional[object]
+    map: Optional[mmap.mmap]
+    position: int # written bytes of current file
+
+    def __init__(self, directory: str, file_size: int = CAPTURE_FILE_SIZE, max_files: int = CAPTURE_FILES):
+        self.directory = directory
+        self.file_size = file_size
+        self.max_files = max_files
+
+        os.makedirs(directory, exist_ok=True)
+
+        # continue numbering of previous captures
+        self.index = max(self.indexes(), default=0)
+        self.file = None
+        self.map = None
+        self.position = 0
+        self.lock = threading.Lock()
+
+    def indexes(self):
+        return sorted(int(match.group(1)) for match in map(FILE_NAME.match, os.listdir(self.directory)) if match)
+
+    def path(self, index: int):
+        return os.path.join(self.directory, f'capture-{index:06d}.pfsc')
+
+    def sendall(self, data: bytes):
+        with self.lock:
+            if self.map is None or self.position + len(data) > len(self.map):
+                self._rotate(len(data))
+
+            self.map[self.position:self.position + len(data)] = data
+            self.position += len(data)
+
+    def close(self):
+        with self.lock:
+            self._close_file()
+
+    def _rotate(self, size: int):
+        self._close_file()
+
+        self.index += 1
+        self.file = open(self.path(self.index), 'w+b')
+
+        # a batch larger than file gets a file of its own
+        length = max(self.file_size, len(FILE_HEADER) + size)
+        try:
+            os.posix_fallocate(self.file.fileno(), 0, length)
+        except (AttributeError, OSError):
+            self.file.truncate(length)
+
+        self.map = mmap.mmap(self.file.fileno(), length)
+        self.map[:len(FILE_HEADER)] = FILE_HEADER
+        self.position = len(FILE_HEADER)
+
+        # keep the latest files
+        if self.max_files:
+            for index in self.indexes()[:-self.max_files]:
+                try:
+                    os.unlink(self.path(index))
+                except OSError as exc:
+                    logger.error(f'capture file not deleted: {exc}')
+
+    def _close_file(self):
+        if self.map is None:
+            return
+
+        self.map.close()
+        self.file.truncate(self.position)
+        self.file.close()
+
+        self.map = None
+        self.file = None
@@ -1,65 +1,207 @@
 import socket
+import threading
 import time
 from typing import Dict, List, Optional
 
 import socks
 
-from app.objetcs.RemotePoint import RemotePoint
+from app.objetcs.CaptureFile import CaptureFile, capture_directory
+from app.objetcs.InspectorConnection import InspectorConnection, stream_header
+from app.objetcs.InspectorWriter import InspectorWriter
+from app.objetcs.RemotePoint import RemotePoint, WORKER_INDEX
+from app.utils.cidr_matcher import CIDRMatcher
+from app.utils.get_logger import get_logger
+from app.utils.metrics import METRICS
+from app.utils.token_bucket import TokenBucket
+
+CLOSED_TUNNELS = METRICS.counter('pfs_tunnels_closed_total', 'Closed connections')
+CLOSED_RELAYED_BYTES = METRICS.counter('pfs_closed_tunnels_relayed_bytes_total', 'Bytes relayed by closed connections', 'direction')
+RATE_LIMITS = {
+    'outgoing': 0, # bytes per sec of entry point, 0 - unlimited
+    'incoming': 0,
+    'tunnel_outgoing': 0, # bytes per sec of every connection
+    'tunnel_incoming': 0,
+    'burst': None, # bytes, None - one second of rate
+}
+
+logger = get_logger(__name__)
 
 
 class EntryPoint:
+    __slots__ = (
+        'username', 'password', 'proxy', 'client_host', 'inspector', 'inspector_filters',
+        'remote_points', 'closed_usage', 'lock', 'created_at', 'last_activity', 'idle_timeout', 'tunnel_idle_timeout',
+        'rate_limits', 'outgoing_bucket', 'incoming_bucket', 'shaping', 'max_tunnels', 'inspector_writer',
+    )
+
     username: str
     password: str
     proxy: 'ForwarderProxy'
     client_host: str
     inspector: Optional[dict]
+    inspector_filters: Optional[CIDRMatcher]
+    inspector_writer: Optional[InspectorWriter] # frames of all connections (capture, v2), None - connection per tunnel
 
-    remote_points: Dict[str, List[RemotePoint]] # address:port -> RP
+    remote_points: Dict[int, RemotePoint] # tunnel id -> active RP
+    closed_usage: Dict[str, int] # traffic counts of closed connections
+    created_at: float
+    last_activity: float # bumped by relay of every connection
+    idle_timeout: int # sec without activity before entry point is closed, 0 - never
+    tunnel_idle_timeout: int # sec without activity before connection is closed, 0 - never
 
-    def __init__(self, username: str, password: str, proxy: 'ForwarderProxy', client_host: str, inspector: dict = None):
+    rate_limits: dict # see RATE_LIMITS
+    outgoing_bucket: TokenBucket # shared by all connections
+    incoming_bucket: TokenBucket
+    shaping: Dict[str, float] # how often and how long connections waited for rate limits
+    max_tunnels: int # concurrent connections, 0 - unlimited
+
+    def __init__(self, username: str, password: str, proxy: 'ForwarderProxy', client_host: str, inspector: dict = None, idle_timeout: int = 0, tunnel_idle_timeout: int = 0, rate_limits: dict = None, max_tunnels: int = 0):
 
         # set
         self.username = username
         self.password = password
         self.proxy = proxy
         self.client_host = client_host
+        self.idle_timeout = idle_timeout
+        self.tunnel_idle_timeout = tunnel_idle_timeout
+        self.max_tunnels = max_tunnels
+
+        # traffic of all connections to local capture files
+        if inspector and inspector.get('capture'):
+            self.inspector = inspector
+            self.inspector_writer = InspectorWriter(CaptureFile(capture_directory(username, WORKER_INDEX)), inspector.get('policy'))
 
-        if inspector:
+        # v2: one inspector connection for all connections, connected by the first frame
+        elif inspector and inspector.get('version') == 2:
+            self.inspector = inspector
+            inspector_connection = InspectorConnection(inspector['address'], inspector['port'], stream_header(username))
+            self.inspector_writer = InspectorWriter(inspector_connection, inspector.get('policy'), keep_open=True)
+        elif inspector:
+            self.inspector_writer = None
             inspector_socket = socks.socksocket(socket.AF_INET, socket.SOCK_STREAM)
             inspector_socket.settimeout(1)
             if inspector_socket.connect_ex((inspector['address'], inspector['port'])) != 0:
-                print(f"Inspector socket {inspector['address']}:{inspector['port']} is not available")
+                logger.warning(f"inspector socket {inspector['address']}:{inspector['port']} is not available")
             self.inspector = inspector
         else:
             self.inspector = None
+            self.inspector_writer = None
+
+        # compile once, checked for every new connection
+        self.inspector_filters = CIDRMatcher(inspector['filters']) if inspector and inspector.get('filters') else None
 
         # default
         self.remote_points = {}
+        self.closed_usage = {
+            'total_connections': 0,
+            'outgoing_b': 0,
+            'incoming_b': 0,
+            'proxy_outgoing_usage_b': 0,
+            'proxy_incoming_usage_b': 0,
+            'inspector_dropped_b': 0,
+        }
+        self.lock = threading.Lock()
+        self.created_at = self.last_activity = time.time()
+
+        # bandwidth shaping
+        self.rate_limits = dict(RATE_LIMITS)
+        self.outgoing_bucket = TokenBucket()
+        self.incoming_bucket = TokenBucket()
+        self.shaping = {
+            'outgoing_throttled': 0,
+            'outgoing_throttled_seconds': 0,
+            'incoming_throttled': 0,
+            'incoming_throttled_seconds': 0,
+        }
+        self.set_rate_limits(rate_limits or {})
+
+    def create_remote_point(self, server_address: str, port: int, client_socket: socks.socksocket, connect: bool = True, addresses: List[str] = None):
         self.last_activity = time.time()
 
-    def create_remote_point(self, server_address: str, port: int, client_socket: socks.socksocket):
-        address_port = f'{server_address}:{port}'
-
-        # add new remote address
-        if address_port not in self.remote_points:
-            self.remote_points[address_port] = []
+        # create remote point (removed from registry by `release_remote_point` on close)
+        RP = RemotePoint(server_address, port, client_socket, self.proxy, self.inspector, self.inspector_filters, connect=False, entry_point=self, addresses=addresses)
+        RP.set_rate_limits(self.rate_limits['tunnel_outgoing'], self.rate_limits['tunnel_incoming'], self.rate_limits['burst'])
+        self.remote_points[RP.id] = RP
 
-        # create remote point
-        RP = RemotePoint(server_address, port, client_socket, self.proxy, self.inspector)
-        self.remote_points[address_port].append(RP)
+        if connect:
+            try:
+                RP.connect()
+            except BaseException:
+                RP.close()
+                raise
 
         return RP
 
+    def release_remote_point(self, remote_point: RemotePoint):
+        """Remove closed connection from registry, its counts are kept in totals"""
+        with self.lock:
+            if self.remote_points.pop(remote_point.id, None) is None:
+                return
+
+            self.closed_usage['total_connections'] += 1
+            self.closed_usage['outgoing_b'] += remote_point.outgoing_b
+            self.closed_usage['incoming_b'] += remote_point.incoming_b
+            self.closed_usage['proxy_outgoing_usage_b'] += remote_point.proxy_outgoing_usage_b
+            self.closed_usage['proxy_incoming_usage_b'] += remote_point.proxy_incoming_usage_b
+            if remote_point.inspector_writer and remote_point.inspector_writer is not self.inspector_writer:
+                self.closed_usage['inspector_dropped_b'] += remote_point.inspector_writer.dropped_b
+
+        CLOSED_TUNNELS.inc()
+        CLOSED_RELAYED_BYTES.inc(remote_point.outgoing_b, 'outgoing')
+        CLOSED_RELAYED_BYTES.inc(remote_point.incoming_b, 'incoming')
+
+    def set_rate_limits(self, rate_limits: dict):
+        """Change some of RATE_LIMITS, applied to open connections too"""
+        self.rate_limits = self.rate_limits | rate_limits
+
+        self.outgoing_bucket.set(self.rate_limits['outgoing'], self.rate_limits['burst'])
+        self.incoming_bucket.set(self.rate_limits['incoming'], self.rate_limits['burst'])
+
+        for RP in list(self.remote_points.values()):
+            RP.set_rate_limits(self.rate_limits['tunnel_outgoing'], self.rate_limits['tunnel_incoming'], self.rate_limits['burst'])
+
+    def idle_deadline(self):
+        """Unix time when entry point expires without activity (None - never)"""
+        return self.last_activity + self.idle_timeout if self.idle_timeout else None
+
+    def tunnel_idle_deadline(self, remote_point: RemotePoint):
+        """Unix time when connection expires without activity (None - never or closed)"""
+        if not self.tunnel_idle_timeout or not remote_point.is_active:
+            return None
+
+        return remote_point.updated_at + self.tunnel_idle_timeout
+
+    def usage(self):
+        """
+        Live traffic counts of all connections (active and closed).
+        """
+        with self.lock:
+            usage = {'active_connections': 0} | self.closed_usage | self.shaping
+
+            for RP in list(self.remote_points.values()):
+                usage['active_connections'] += RP.is_active
+                usage['total_connections'] += 1
+                usage['outgoing_b'] += RP.outgoing_b
+                usage['incoming_b'] += RP.incoming_b
+                usage['proxy_outgoing_usage_b'] += RP.proxy_outgoing_usage_b
+                usage['proxy_incoming_usage_b'] += RP.proxy_incoming_usage_b
+                if RP.inspector_writer and RP.inspector_writer is not self.inspector_writer:
+                    usage['inspector_dropped_b'] += RP.inspector_writer.dropped_b
+
+            if self.inspector_writer:
+                usage['inspector_dropped_b'] += self.inspector_writer.dropped_b
+
+        return usage
+
     def close(self):
-        total_proxy_outgoing_usage_b = 0
-        total_proxy_incoming_usage_b = 0
-
-        # close connections and get proxy usage counts
-        for RPs in self.remote_points.copy().values():
-            for RP in RPs:
-                if RP.is_active:
-                    proxy_outgoing_usage_b, proxy_incoming_usage_b = RP.close()
-                    total_proxy_outgoing_usage_b += proxy_outgoing_usage_b
-                    total_proxy_incoming_usage_b += proxy_incoming_usage_b
-
-        return total_proxy_outgoing_usage_b, total_proxy_incoming_usage_b
+        # close connections (connecting ones included)
+        for RP in list(self.remote_points.values()):
+            RP.close()
+
+        # queued frames are still written
+        if self.inspector_writer:
+            self.inspector_writer.close()
+
+        # get proxy usage counts (closed connections included)
+        usage = self.usage()
+        return usage['proxy_outgoing_usage_b'], usage['proxy_incoming_usage_b']
@@ -3,18 +3,26 @@ import string
 from typing import Optional
 
 import requests
-from decouple import config
+from decouple import config, Csv
 
-from app.utils.get_proxy_ip import get_proxy_ip
+from app.objetcs.UpstreamGateways import UpstreamGateways
+from app.utils.get_proxy_ip import get_proxy_ip, PROXY_PROBE_DEADLINE
+from app.utils.ttl_cache import TTLCache
 
 PROXY_USERNAME = config('PROXY_USERNAME')
-PROXY_HOST = config('PROXY_HOST')
-PROXY_PORT = config('PROXY_PORT', cast=int)
+PROXY_HOST = config('PROXY_HOST', default='')
+PROXY_PORT = config('PROXY_PORT', default=0, cast=int)
+PROXY_HOSTS = config('PROXY_HOSTS', default='', cast=Csv()) or [f'{PROXY_HOST}:{PROXY_PORT}'] # host:port,... of upstream gateways
 PROXY_BASE_PASSWORD = config('PROXY_BASE_PASSWORD')
+PROXY_IP_CACHE_SIZE = config('PROXY_IP_CACHE_SIZE', default=10000, cast=int) # verified sticky sessions
 
 
 AVAILABLE_COUNTRIES = ['ae', 'al', 'am', 'ao', 'ar', 'at', 'au', 'az', 'ba', 'bb', 'bd', 'be', 'bf', 'bg', 'bh', 'bj', 'bn', 'bo', 'br', 'bw', 'by', 'bz', 'ca', 'ch', 'ci', 'cl', 'cm', 'cn', 'co', 'cr', 'cu', 'cw', 'cy', 'cz', 'de', 'dk', 'dm', 'do', 'dz', 'ec', 'ee', 'eg', 'es', 'et', 'fi', 'fr', 'ga', 'gb', 'ge', 'gh', 'gr', 'gt', 'gy', 'hk', 'hn', 'hr', 'ht', 'hu', 'id', 'ie', 'il', 'in', 'iq', 'ir', 'is', 'it', 'jm', 'jo', 'jp', 'ke', 'kg', 'kh', 'kr', 'kw', 'kz', 'la', 'lb', 'lc', 'lk', 'ls', 'lt', 'lu', 'lv', 'ly', 'ma', 'md', 'me', 'mg', 'mk', 'ml', 'mm', 'mn', 'mo', 'mt', 'mu', 'mv', 'mw', 'mx', 'my', 'mz', 'na', 'ng', 'ni', 'nl', 'no', 'np', 'nz', 'om', 'pa', 'pe', 'ph', 'pk', 'pl', 'pr', 'ps', 'pt', 'py', 'qa', 're', 'ro', 'rs', 'ru', 'rw', 'se', 'sg', 'si', 'sk', 'sn', 'so', 'sr', 'sv', 'sy', 'tg', 'th', 'tj', 'tn', 'tr', 'tt', 'tw', 'tz', 'ua', 'ug', 'us', 'uy', 'uz', 've', 'vn', 'za', 'zm', 'zw']
 DURATION_TYPES = {'s': 59, 'm': 59, 'h': 158}
+DURATION_SECONDS = {'s': 1, 'm': 60, 'h': 3600}
+
+# gateways of upstream proxy with health of this process
+UPSTREAM_GATEWAYS = UpstreamGateways(PROXY_HOSTS)
 
 
 class ForwarderProxy:
@@ -24,6 +32,9 @@ class ForwarderProxy:
 
     SESSION_LEN = 8
 
+    # (country, session, duration) -> exit ip, until session lifetime runs out
+    verified_ips = TTLCache(PROXY_IP_CACHE_SIZE)
+
     host: str
     port: int
     username: str
@@ -58,15 +69,37 @@ class ForwarderProxy:
         self.session = session
         self.duration = duration
 
-        # set credentials
-        self.host = PROXY_HOST
-        self.port = PROXY_PORT
+        # set credentials (tunnels pick a gateway on every connect)
+        gateway = UPSTREAM_GATEWAYS.pick()
+        self.host = gateway.host
+        self.port = gateway.port
         self.username = PROXY_USERNAME
         self.password = password
 
-    def get_ip(self):
-        self.ip = get_proxy_ip(str(self))
+    def get_ip(self, deadline: float = PROXY_PROBE_DEADLINE):
+        key = (self.country, self.session, self.duration)
+
+        # sticky session has the same ip during lifetime
+        if self.lifetime:
+            self.ip = self.verified_ips.get(key)
+            if self.ip:
+                return self.ip
+
+        self.ip = get_proxy_ip(str(self), deadline)
+
+        # lifetime is counted from the first verification
+        if self.ip and self.lifetime and self.verified_ips.get(key) is None:
+            self.verified_ips.set(key, self.ip, self.lifetime)
+
         return self.ip
 
+    @property
+    def lifetime(self) -> Optional[int]:
+        """Seconds of sticky session (None if ip is not sticky)"""
+        if not self.duration:
+            return None
+
+        return int(self.duration[:-1]) * DURATION_SECONDS[self.duration[-1]]
+
     def __str__(self):
         return f'http://{self.username}:{self.password}@{self.host}:{self.port}'
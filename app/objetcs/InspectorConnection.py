@@ -0,0 +1,85 @@
+import socket
+import struct
+import time
+from typing import Optional
+
+from decouple import config
+
+from app.objetcs.InspectorWriter import INSPECTOR_SEND_TIMEOUT
+from app.utils.get_logger import get_logger
+
+INSPECTOR_CONNECT_TIMEOUT = config('INSPECTOR_CONNECT_TIMEOUT', default=1, cast=float) # sec
+INSPECTOR_RETRY_INTERVAL = config('INSPECTOR_RETRY_INTERVAL', default=5, cast=float) # sec between attempts to connect
+
+STREAM_HEADER = b'PFSI\x00\x02' # magic, version of protocol, followed by size-prefixed username
+
+logger = get_logger(__name__)
+
+
+def stream_header(username: str) -> bytes:
+    """Header of v2 stream: magic, version, size-prefixed username"""
+    username = username.encode()
+    return STREAM_HEADER + struct.pack('>H', len(username)) + username
+
+
+class InspectorConnection:
+    """
+    Connection to inspector: v1 - one per tunnel (header is remote address),
+    v2 - shared by all connections of entry point, frames of `app.utils.inspector_frames` (header of `stream_header`).
+
+    Connected lazily by the first write (in the writer thread, so tunnels never wait for inspector),
+    then the header is sent. When inspector is not available, writes fail until the next attempt
+    after `INSPECTOR_RETRY_INTERVAL`, a reconnected v2 inspector gets frames of already opened connections without `open`.
+
+    Has `sendall` and `close` of socket, so it's a target of InspectorWriter.
+    """
+
+    __slots__ = ('address', 'port', 'header', 'socket', 'retry_at')
+
+    address: str
+    port: int
+    header: bytes # sent first on every new connection
+
+    socket: Optional[socket.socket]
+    retry_at: float # no attempt to connect before
+
+    def __init__(self, address: str, port: int, header: bytes):
+        self.address = address
+        self.port = port
+        self.header = header
+
+        self.socket = None
+        self.retry_at = 0
+
+    def sendall(self, data: bytes):
+        # stream of new connection starts with header
+        if self.socket is None:
+            self._connect()
+            data = self.header + data
+
+        try:
+            self.socket.sendall(data)
+        except OSError:
+            logger.error(f'inspector socket {self.address}:{self.port} close connection')
+            self.close()
+            self.retry_at = time.monotonic() + INSPECTOR_RETRY_INTERVAL
+            raise
+
+    def close(self):
+        if self.socket is not None:
+            self.socket.close()
+            self.socket = None
+
+    def _connect(self):
+        if time.monotonic() < self.retry_at:
+            raise ConnectionRefusedError('inspector is not available')
+
+        try:
+            self.socket = socket.create_connection((self.address, self.port), timeout=INSPECTOR_CONNECT_TIMEOUT)
+        except OSError as exc:
+            logger.error(f'inspector socket {self.address}:{self.port} is not available: {exc}')
+            self.retry_at = time.monotonic() + INSPECTOR_RETRY_INTERVAL
+            raise
+
+        # stalled inspector is reconnected
+        self.socket.settimeout(INSPECTOR_SEND_TIMEOUT)
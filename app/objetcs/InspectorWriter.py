@@ -0,0 +1,161 @@
+import socket
+import threading
+from collections import deque
+from typing import Callable, Deque, List, Union
+
+from decouple import config
+
+from app.utils.get_logger import get_logger
+from app.utils.metrics import METRICS
+
+INSPECTOR_QUEUE_SIZE = config('INSPECTOR_QUEUE_B', default=4 * 1024 * 1024, cast=int) # bytes queued per inspector connection
+INSPECTOR_BATCH_SIZE = config('INSPECTOR_BATCH_B', default=256 * 1024, cast=int) # bytes sent in one write
+INSPECTOR_POLICY = config('INSPECTOR_POLICY', default='drop') # drop | backpressure, when inspector falls behind
+INSPECTOR_POLICIES = ('drop', 'backpressure')
+INSPECTOR_SEND_TIMEOUT = config('INSPECTOR_SEND_TIMEOUT', default=5, cast=float) # sec per write to inspector socket
+
+INSPECTOR_DROPPED_BYTES = METRICS.counter('pfs_inspector_dropped_bytes_total', 'Mirrored bytes not delivered to inspector', 'reason')
+
+logger = get_logger(__name__)
+
+
+class InspectorWriter:
+    """
+    Bounded ordered queue of frames to inspector drained by a single writer thread,
+    frames queued meanwhile are sent in one write.
+
+    When the queue is full, a frame is dropped (policy `drop`) or the producer waits for room (policy `backpressure`),
+    so a slow inspector slows down the tunnel instead of piling up memory. A producer which can't block
+    (event loop) is called back by the writer thread when room frees.
+
+    A failed write (socket targets time out after INSPECTOR_SEND_TIMEOUT) closes the writer,
+    with `keep_open` only the batch is dropped (target reconnects by itself).
+    """
+
+    __slots__ = ('target', 'policy', 'max_size', 'keep_open', 'frames', 'size', 'dropped_b', 'is_closed', 'condition', 'room_callbacks')
+
+    target: Union[socket.socket, 'CaptureFile', 'InspectorConnection']
+    policy: str
+    max_size: int # bytes
+    keep_open: bool # failed write drops the batch only
+
+    frames: Deque[bytes]
+    size: int # bytes queued and being written
+    dropped_b: int
+    is_closed: bool # no more frames accepted
+    room_callbacks: List[Callable[[], None]] # producers waiting for room without blocking, called once
+
+    def __init__(self, target: Union[socket.socket, 'CaptureFile', 'InspectorConnection'], policy: str = None, max_size: int = INSPECTOR_QUEUE_SIZE, keep_open: bool = False):
+        self.target = target
+        self.policy = policy or INSPECTOR_POLICY
+        self.max_size = max_size
+        self.keep_open = keep_open
+
+        self.frames = deque()
+        self.size = 0
+        self.dropped_b = 0
+        self.is_closed = False
+        self.condition = threading.Condition()
+        self.room_callbacks = []
+
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def put(self, frame: bytes, block: bool = True, force: bool = False, on_room: Callable[[], None] = None) -> bool:
+        """
+        Queue frame.
+
+        @param block: wait for room with `backpressure` policy
+        @param force: queue over the limit (small event frames)
+        @param on_room: called from writer thread when room frees (if frame is not queued without blocking)
+        @return: False if frame has to be put again later (no room and not blocking), True otherwise
+        """
+        with self.condition:
+            while True:
+                if self.is_closed:
+                    self._drop(len(frame), 'inspector_closed')
+                    return True
+
+                # a frame larger than the queue is taken alone
+                if self.size + len(frame) <= self.max_size or not self.size or force:
+                    self.frames.append(frame)
+                    self.size += len(frame)
+                    self.condition.notify_all()
+                    return True
+
+                if self.policy == 'drop':
+                    self._drop(len(frame), 'queue_full')
+                    return True
+
+                if not block:
+                    if on_room:
+                        self.room_callbacks.append(on_room)
+                    return False
+
+                self.condition.wait()
+
+    def close(self):
+        """Send queued frames and close target"""
+        with self.condition:
+            self.is_closed = True
+            self._notify_room()
+
+    def _notify_room(self):
+        """Wake up producers waiting for room (condition is held)"""
+        self.condition.notify_all()
+
+        room_callbacks, self.room_callbacks = self.room_callbacks, []
+        for on_room in room_callbacks:
+            try:
+                on_room()
+            except RuntimeError:
+                # event loop of producer is closed
+                pass
+
+    def _drop(self, size: int, reason: str):
+        self.dropped_b += size
+        INSPECTOR_DROPPED_BYTES.inc(size, reason)
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while not self.frames and not self.is_closed:
+                    self.condition.wait()
+
+                if not self.frames:
+                    break
+
+                # all queued frames up to batch size in one write
+                batch = [self.frames.popleft()]
+                batch_size = len(batch[0])
+                while self.frames and batch_size + len(self.frames[0]) <= INSPECTOR_BATCH_SIZE:
+                    batch.append(self.frames.popleft())
+                    batch_size += len(batch[-1])
+
+            try:
+                self.target.sendall(b''.join(batch))
+            except OSError:
+                if self.keep_open:
+                    with self.condition:
+                        self._drop(batch_size, 'inspector_unavailable')
+                        self.size -= batch_size
+                        self._notify_room()
+                    continue
+
+                logger.error('inspector socket close connection')
+
+                with self.condition:
+                    self.is_closed = True
+                    self._drop(self.size, 'inspector_closed')
+                    self.frames.clear()
+                    self.size = 0
+                    self._notify_room()
+                break
+
+            with self.condition:
+                self.size -= batch_size
+                self._notify_room()
+
+        try:
+            self.target.close()
+        except OSError:
+            pass
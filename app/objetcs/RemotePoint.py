@@ -1,63 +1,273 @@
+import asyncio
 import base64
-import ipaddress
+import functools
+import itertools
+import os
 import select
 import socket
 import struct
-import threading
 import time
-from typing import Optional
+from typing import List, Optional, Tuple
 
 import socks
-
-from app.settings import GOOGLE_IPS
+from decouple import config
+
+from app.objetcs.ForwarderProxy import UPSTREAM_GATEWAYS
+from app.objetcs.InspectorConnection import InspectorConnection
+from app.objetcs.InspectorWriter import InspectorWriter
+from app.objetcs.UpstreamPool import UPSTREAM_CONNECT_TIMEOUT, UpstreamPool
+from app.settings import GOOGLE_IPS, LOCAL_NETWORKS
+from app.utils.buffer_pool import BufferPool
+from app.utils.cidr_matcher import CIDRMatcher
 from app.utils.get_logger import get_logger
+from app.utils.happy_eyeballs import connect_first, connect_first_async
+from app.utils.inspector_frames import CLOSE, INCOMING, OPEN, OUTGOING, pack_frame
+from app.utils.metrics import METRICS
+from app.utils.token_bucket import TokenBucket
 
 BUFFER_SIZE = 4096
+MAX_PROXY_RESPONSE_SIZE = 16384 # headers of CONNECT response
+UPSTREAM_CONNECT_ATTEMPTS = config('UPSTREAM_CONNECT_ATTEMPTS', default=3, cast=int) # gateways tried per tunnel
+UPSTREAM_RESPONSE_TIMEOUT = config('UPSTREAM_RESPONSE_TIMEOUT', default=10, cast=float) # sec, CONNECT sent until response
+MIN_CHUNK_SIZE = config('RELAY_MIN_CHUNK_B', default=4096, cast=int)
+MAX_CHUNK_SIZE = config('RELAY_MAX_CHUNK_B', default=256 * 1024, cast=int)
+FLUSH_TIMEOUT = 5 # sec
+SPLICE_SIZE = 65536 # default pipe capacity
+WORKER_INDEX = config('PROXY_WORKER_INDEX', default=0, cast=int) # set by supervisor: 1.., 0 - single process
+SPLICE_ENABLED = config('RELAY_SPLICE', default=True, cast=bool) and hasattr(os, 'splice') # Linux, python 3.10+
+BUFFER_POOL = BufferPool(MIN_CHUNK_SIZE, MAX_CHUNK_SIZE)
+GOOGLE_IPS_MATCHER = CIDRMatcher(GOOGLE_IPS)
+LOCAL_NETWORKS_MATCHER = CIDRMatcher(LOCAL_NETWORKS)
+
+UPSTREAM_CONNECT_SECONDS = METRICS.histogram('pfs_upstream_connect_seconds', 'Time to establish connection to remote (via proxy or direct)')
+UPSTREAM_CONNECT_FAILURES = METRICS.counter('pfs_upstream_connect_failures_total', 'Failed connections to remote', 'route')
+CONNECTIONS_ACCEPTED = METRICS.counter('pfs_connections_accepted_total', 'Accepted client connections')
+CONNECTIONS_REFUSED = METRICS.counter('pfs_connections_refused_total', 'Refused client connections', 'reason')
+HANDSHAKE_SECONDS = METRICS.histogram('pfs_handshake_seconds', 'Time of SOCKS5 greeting and authentication')
+# SOCKS5 refusals
+REPLY_AUTH_FAILURE = bytes([1, 0xFF]) # username/password rejected
+REPLY_NO_METHODS = bytes([5, 0xFF]) # greeting refused
+REPLY_GENERAL_FAILURE = bytes([5, 1, 0, 1, 0, 0, 0, 0, 0, 0]) # request refused: server failure
+REPLY_NOT_ALLOWED = bytes([5, 2, 0, 1, 0, 0, 0, 0, 0, 0]) # request refused: not allowed by ruleset
+REPLY_HOST_UNREACHABLE = bytes([5, 4, 0, 1, 0, 0, 0, 0, 0, 0]) # request refused: domain not resolved
+REPLY_ADDRESS_TYPE_NOT_SUPPORTED = bytes([5, 8, 0, 1, 0, 0, 0, 0, 0, 0]) # request refused: not IPv4 or domain
+
+THROTTLED_SECONDS = METRICS.counter('pfs_throttled_seconds_total', 'Time connections waited for rate limits', 'direction')
+
 logger = get_logger(__name__)
 
 
+class RelayDirection:
+    """
+    One direction of relay: reads from `source` into a pooled buffer and writes to `target`.
+
+    Chunk size grows for bulk transfers and shrinks back for interactive ones.
+    """
+
+    __slots__ = ('source', 'target', 'is_outgoing', 'chunk_size', 'last_size', 'buffer', 'view', 'pending', 'resume_at')
+
+    source: socket.socket
+    target: socket.socket
+    is_outgoing: bool
+
+    chunk_size: int
+    last_size: int
+    buffer: Optional[bytearray]
+    view: Optional[memoryview]
+    pending: Optional[memoryview] # not yet written part of last chunk
+    resume_at: float # monotonic time when throttled direction can read again
+
+    def __init__(self, source: socket.socket, target: socket.socket, is_outgoing: bool):
+        self.source = source
+        self.target = target
+        self.is_outgoing = is_outgoing
+
+        self.chunk_size = self.last_size = MIN_CHUNK_SIZE
+        self.buffer = BUFFER_POOL.acquire(self.chunk_size)
+        self.view = memoryview(self.buffer)
+        self.pending = None
+        self.resume_at = 0
+
+    def next_view(self):
+        """
+        Buffer for next read. Must not be called while `pending` refers to the buffer.
+        """
+
+        # full read - bulk transfer, grow
+        if self.last_size >= self.chunk_size and self.chunk_size < MAX_CHUNK_SIZE:
+            self._resize(self.chunk_size * 2)
+
+        # small read - interactive transfer, shrink
+        elif self.last_size <= self.chunk_size // 4 and self.chunk_size > MIN_CHUNK_SIZE:
+            self._resize(self.chunk_size // 2)
+
+        return self.view[:self.chunk_size]
+
+    def receive(self, limit: int = 0):
+        """@param limit: max size of read, 0 - chunk size"""
+        view = self.next_view()
+        size = self.source.recv_into(view[:limit] if limit else view)
+        self.last_size = size
+
+        # connection closed
+        if not size:
+            return None
+
+        return self.view[:size]
+
+    def send(self, data: memoryview):
+        try:
+            sent = self.target.send(data)
+        except BlockingIOError:
+            sent = 0
+
+        self.pending = data[sent:] if sent < len(data) else None
+
+    def release(self):
+        if self.buffer is not None:
+            BUFFER_POOL.release(self.buffer)
+            self.buffer = self.view = self.pending = None
+
+    def _resize(self, chunk_size: int):
+        self.release()
+        self.chunk_size = chunk_size
+        self.buffer = BUFFER_POOL.acquire(chunk_size)
+        self.view = memoryview(self.buffer)
+
+
+class SpliceDirection:
+    """
+    One direction of zero-copy relay: `source` -> pipe -> `target` inside the kernel (sockets are non-blocking).
+
+    Bytes not yet accepted by target stay in the pipe (`pending`), source is read only into the empty pipe,
+    so a read never blocks on the pipe.
+    """
+
+    __slots__ = ('source', 'target', 'is_outgoing', 'read_fd', 'write_fd', 'pending', 'resume_at')
+
+    source: socket.socket
+    target: socket.socket
+    is_outgoing: bool
+
+    read_fd: int
+    write_fd: int
+    pending: int # bytes in pipe not yet written to target
+    resume_at: float # monotonic time when throttled direction can read again
+
+    def __init__(self, source: socket.socket, target: socket.socket, is_outgoing: bool):
+        self.source = source
+        self.target = target
+        self.is_outgoing = is_outgoing
+
+        self.read_fd, self.write_fd = os.pipe()
+        self.pending = 0
+        self.resume_at = 0
+
+    def receive(self, limit: int = SPLICE_SIZE):
+        """@return: bytes moved from source to pipe, 0 - connection closed, None - nothing to read"""
+        try:
+            size = os.splice(self.source.fileno(), self.write_fd, min(limit, SPLICE_SIZE), flags=os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK)
+        except BlockingIOError:
+            return None
+
+        self.pending += size
+        return size
+
+    def send(self):
+        """Move pending bytes from pipe to target as much as it accepts"""
+        try:
+            self.pending -= os.splice(self.read_fd, self.target.fileno(), self.pending, flags=os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK)
+        except BlockingIOError:
+            pass
+
+    def release(self):
+        if self.read_fd is not None:
+            os.close(self.read_fd)
+            os.close(self.write_fd)
+            self.read_fd = self.write_fd = None
+
+
 class RemotePoint:
+    __slots__ = (
+        'id', 'remote_address', 'addresses', 'port', 'client_socket', 'server_socket', 'proxy', 'entry_point',
+        'is_active', 'created_at', 'updated_at', 'reason_skip_proxy', 'outgoing_b', 'incoming_b',
+        'inspector', 'is_inspected', 'inspector_writer', 'is_multiplexed', 'loop', 'task',
+        'outgoing_bucket', 'incoming_bucket',
+    )
+
+    ids = itertools.count((WORKER_INDEX << 48) + 1) # unique between workers of supervisor
+
+    id: int # tunnel id
     remote_address: str
+    addresses: List[str] # remote address and other addresses of the same domain, tried by direct connect
     port: int
     client_socket: socks.socksocket
     server_socket: socks.socksocket
+    proxy: 'ForwarderProxy'
+    entry_point: Optional['EntryPoint'] # owner, its last activity is bumped by relay
 
     is_active: bool
     created_at: float
     updated_at: float
 
     reason_skip_proxy: Optional[str]
-    proxy_outgoing_usage_b: int # total bytes size (only proxy usage)
-    proxy_incoming_usage_b: int # total bytes size (only proxy usage)
+    outgoing_b: int # total bytes size sent to remote
+    incoming_b: int # total bytes size received from remote
 
     inspector: Optional[dict]
-    inspector_socket: Optional[socks.socksocket]
-    inspector_lock: threading.Lock
+    is_inspected: bool # remote address matches inspector filters
+    inspector_writer: Optional[InspectorWriter] # queue of frames to inspector socket
+    is_multiplexed: bool # inspector writer of entry point is shared by its connections (frames with tunnel id)
+
+    loop: Optional[asyncio.AbstractEventLoop]
+    task: Optional[asyncio.Task]
+
+    outgoing_bucket: Optional[TokenBucket] # rate limit of connection (entry point has its own)
+    incoming_bucket: Optional[TokenBucket]
 
-    def __init__(self, remote_address: str, port: int, client_socket: socks.socksocket, proxy: 'ForwarderProxy', inspector: dict = None):
+    def __init__(self, remote_address: str, port: int, client_socket: socks.socksocket, proxy: 'ForwarderProxy', inspector: dict = None, inspector_filters: CIDRMatcher = None, connect: bool = True, entry_point: 'EntryPoint' = None, addresses: List[str] = None):
+        self.id = next(self.ids)
         self.remote_address = remote_address
         self.port = port
         self.client_socket = client_socket
-
-        # connect to inspector socket (if necessary)
-        if inspector:
-            self.inspector_socket = socks.socksocket(socket.AF_INET, socket.SOCK_STREAM)
-            self.inspector_socket.connect((inspector['address'], inspector['port']))
-            self.inspector_socket.sendall(bytes(remote_address.ljust(18), 'utf-8'))
-            self.inspector_lock = threading.Lock()
+        self.proxy = proxy
+        self.entry_point = entry_point
+
+        # frames of all connections of entry point in one stream
+        if inspector and entry_point and entry_point.inspector_writer:
+            self.inspector_writer = entry_point.inspector_writer
+            self.is_multiplexed = True
+
+        # inspector connection of tunnel, connected by the first write of writer thread (never blocks the relay)
+        elif inspector:
+            inspector_connection = InspectorConnection(inspector['address'], inspector['port'], bytes(remote_address.ljust(18), 'utf-8'))
+            self.inspector_writer = InspectorWriter(inspector_connection, inspector.get('policy'))
+            self.inspector_writer.put(b'', force=True) # inspector gets the header even without traffic
+            self.is_multiplexed = False
         else:
-            self.inspector_socket = None
-            self.inspector_lock = None
+            self.inspector_writer = None
+            self.is_multiplexed = False
 
         self.inspector = inspector
+        self.is_inspected = inspector_filters is None or remote_address in inspector_filters
+
+        if self.is_multiplexed and self.is_inspected:
+            self.inspector_writer.put(pack_frame(OPEN, self.id, f'{remote_address}:{port}'.encode()), force=True)
 
-        self.proxy_outgoing_usage_b = 0
-        self.proxy_incoming_usage_b = 0
+        self.outgoing_b = 0
+        self.incoming_b = 0
         self.is_active = False
         self.created_at = self.updated_at = time.time()
 
-        # connecting to remote
-        self.server_socket = socks.socksocket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server_socket = None
+
+        # set by asyncio engine
+        self.loop = None
+        self.task = None
+
+        # set by entry point
+        self.outgoing_bucket = None
+        self.incoming_bucket = None
 
         # don't use proxy for local network and Google servers
         if self.is_local_ip(remote_address):
@@ -67,24 +277,212 @@ class RemotePoint:
         else:
             self.reason_skip_proxy = None
 
-        # default connection for local network
+        # other addresses of domain are tried if they are of the same route
+        self.addresses = [remote_address] + [
+            address for address in addresses or []
+            if address != remote_address and self.reason_skip_proxy and (self.is_local_ip(address) or self.is_google_ip(address))
+        ]
+
+        if connect:
+            self.connect()
+
+    def connect(self):
+        started_at = time.monotonic()
+
+        try:
+            self._connect()
+        except Exception:
+            UPSTREAM_CONNECT_FAILURES.inc(label_value=self.route)
+            raise
+
+        UPSTREAM_CONNECT_SECONDS.observe(time.monotonic() - started_at)
+
+    def _connect(self):
+        # direct connection for local network, addresses of domain are raced
+        if self.reason_skip_proxy:
+            try:
+                self.server_socket = connect_first(self.addresses, self.port)
+            except OSError as exc:
+                raise self.refuse_connection(self.client_socket, f'failed connection to {self.remote_address}: {exc}', 'direct', REPLY_GENERAL_FAILURE)
+            logger.info(f'Connected to {self.server_socket.getpeername()[0]}:{self.port} ({self.reason_skip_proxy})')
+
+            early_data = None
+
+        # connect proxy, client is replied when proxy confirmed the connection
+        else:
+            early_data = self.connect_upstream()
+            logger.info(f'Connected to {self.remote_address}:{self.port} (via proxy - {self.proxy.country})')
+
+        reply = self.success_reply()
+        self.client_socket.sendall(reply)
+
+        # establish data exchange
+        if reply[1] != 0:
+            raise self.refuse_connection(self.client_socket, reason='upstream')
+
+        if early_data:
+            self.receive_early_data(early_data)
+
+        # connected via proxy
+        self.is_active = True
+
+    def connect_upstream(self) -> bytes:
+        """
+        CONNECT to remote via upstream gateways in order of health (see `UpstreamGateways`),
+        a failed gateway (not available, connection closed, no response in time) is recorded and the next one is tried.
+
+        @return: remote payload received together with proxy response
+        """
+        for gateway in UPSTREAM_GATEWAYS.candidates(UPSTREAM_CONNECT_ATTEMPTS):
+            upstream_pool = UpstreamPool.get(gateway.host, gateway.port)
+            started_at = time.monotonic()
+            server_socket = None
+
+            try:
+                server_socket = upstream_pool.acquire() or upstream_pool.connect()
+                server_socket.settimeout(UPSTREAM_RESPONSE_TIMEOUT)
+                server_socket.sendall(self.connect_request())
+
+                response = b''
+                while (proxy_response := self.parse_proxy_response(response)) is None:
+                    data = server_socket.recv(BUFFER_SIZE)
+                    if not data:
+                        raise ConnectionResetError('connection closed by proxy')
+                    response += data
+
+                server_socket.settimeout(None)
+            except OSError as exc:
+                gateway.record_failure()
+                logger.warning(f'upstream gateway {gateway.host}:{gateway.port} failed to connect {self.remote_address}:{self.port}: {exc}')
+                if server_socket:
+                    server_socket.close()
+                continue
+
+            gateway.record_success(time.monotonic() - started_at)
+            self.server_socket = server_socket
+            return self.confirmed_response(proxy_response)
+
+        raise self.refuse_connection(self.client_socket, f'no upstream gateway connected to {self.remote_address}', 'upstream', REPLY_GENERAL_FAILURE)
+
+    async def connect_async(self, loop: asyncio.AbstractEventLoop):
+        """
+        Same as `connect`, but with non-blocking sockets on the event loop.
+        """
+        started_at = time.monotonic()
+
+        try:
+            await self._connect_async(loop)
+        except Exception:
+            UPSTREAM_CONNECT_FAILURES.inc(label_value=self.route)
+            raise
+
+        UPSTREAM_CONNECT_SECONDS.observe(time.monotonic() - started_at)
+
+    async def _connect_async(self, loop: asyncio.AbstractEventLoop):
+        # direct connection for local network, addresses of domain are raced
         if self.reason_skip_proxy:
-            self.server_socket.connect((self.remote_address, port))
-            logger.info(f'Connected to {self.remote_address}:{self.port} ({self.reason_skip_proxy})')
+            try:
+                self.server_socket = await connect_first_async(loop, self.addresses, self.port)
+            except OSError as exc:
+                raise self.refuse_connection(self.client_socket, f'failed connection to {self.remote_address}: {exc}', 'direct', REPLY_GENERAL_FAILURE)
+            logger.info(f'Connected to {self.server_socket.getpeername()[0]}:{self.port} ({self.reason_skip_proxy})')
 
-        # connect proxy
+            early_data = None
+
+        # connect proxy, client is replied when proxy confirmed the connection
         else:
-            self.server_socket.connect((proxy.host, proxy.port))
-            self.server_socket.sendall(b'CONNECT %s:%s HTTP/1.1\r\n'
-                                       b'Proxy-Authorization: Basic %s\r\n\r\n' %
-                                       (self.remote_address.encode(), str(self.port).encode(), base64.b64encode(bytes(f'{proxy.username}:{proxy.password}', 'utf-8'))))
-            logger.info(f'Connected to {self.remote_address}:{self.port} (via proxy - {proxy.country})')
+            early_data = await self.connect_upstream_async(loop)
+            logger.info(f'Connected to {self.remote_address}:{self.port} (via proxy - {self.proxy.country})')
+
+        await loop.sock_sendall(self.client_socket, self.success_reply())
+
+        if early_data:
+            await self.receive_early_data_async(loop, early_data)
+
+        # connected via proxy
+        self.is_active = True
+
+    async def connect_upstream_async(self, loop: asyncio.AbstractEventLoop) -> bytes:
+        """Same as `connect_upstream`, but with non-blocking sockets on the event loop"""
+        for gateway in UPSTREAM_GATEWAYS.candidates(UPSTREAM_CONNECT_ATTEMPTS):
+            started_at = time.monotonic()
+
+            # pre-connected if available
+            server_socket = UpstreamPool.get(gateway.host, gateway.port).acquire()
+
+            try:
+                if server_socket:
+                    server_socket.setblocking(False)
+                else:
+                    server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                    server_socket.setblocking(False)
+                    await asyncio.wait_for(loop.sock_connect(server_socket, (gateway.host, gateway.port)), UPSTREAM_CONNECT_TIMEOUT)
+
+                await loop.sock_sendall(server_socket, self.connect_request())
+                proxy_response = await asyncio.wait_for(self._recv_proxy_response_async(loop, server_socket), UPSTREAM_RESPONSE_TIMEOUT)
+            except (OSError, asyncio.TimeoutError) as exc:
+                gateway.record_failure()
+                logger.warning(f'upstream gateway {gateway.host}:{gateway.port} failed to connect {self.remote_address}:{self.port}: {exc!r}')
+                server_socket.close()
+                continue
+
+            gateway.record_success(time.monotonic() - started_at)
+            self.server_socket = server_socket
+            return self.confirmed_response(proxy_response)
+
+        raise self.refuse_connection(self.client_socket, f'no upstream gateway connected to {self.remote_address}', 'upstream', REPLY_GENERAL_FAILURE)
+
+    async def _recv_proxy_response_async(self, loop: asyncio.AbstractEventLoop, server_socket: socket.socket):
+        response = b''
+        while (proxy_response := self.parse_proxy_response(response)) is None:
+            data = await loop.sock_recv(server_socket, BUFFER_SIZE)
+            if not data:
+                raise ConnectionResetError('connection closed by proxy')
+            response += data
+
+        return proxy_response
+
+    @staticmethod
+    def parse_proxy_response(response: bytes) -> Optional[Tuple[int, bytes]]:
+        """
+        Status and remote payload after headers of CONNECT response, None if headers are not received yet.
+
+        Invalid response raises ConnectionError (gateway failure).
+        """
+        headers, separator, payload = response.partition(b'\r\n\r\n')
+        if not separator:
+            if len(response) > MAX_PROXY_RESPONSE_SIZE:
+                raise ConnectionError('too long proxy response')
+            return None
+
+        try:
+            status = int(headers.split(b' ', 2)[1])
+        except (IndexError, ValueError):
+            raise ConnectionError('invalid proxy response')
+
+        return status, payload
 
+    def confirmed_response(self, proxy_response: Tuple[int, bytes]) -> bytes:
+        """
+        Remote payload of response, proxy refusal (it's an answer of working gateway, so not retried) refuses client.
+        """
+        status, payload = proxy_response
+        if status != 200:
+            raise self.refuse_connection(self.client_socket, f'the proxy did not confirm the connection to {self.remote_address} ({status})', 'upstream', REPLY_GENERAL_FAILURE)
+
+        return payload
+
+    def connect_request(self):
+        return (b'CONNECT %s:%s HTTP/1.1\r\n'
+                b'Proxy-Authorization: Basic %s\r\n\r\n' %
+                (self.remote_address.encode(), str(self.port).encode(), base64.b64encode(bytes(f'{self.proxy.username}:{self.proxy.password}', 'utf-8'))))
+
+    def success_reply(self):
         bind_address = self.server_socket.getsockname()
         addr = int.from_bytes(socket.inet_aton(bind_address[0]), 'big', signed=False)
         port = bind_address[1]
 
-        reply = b''.join([
+        return b''.join([
             int(5).to_bytes(1, 'big'), # socket version
             int(0).to_bytes(1, 'big'),
             int(0).to_bytes(1, 'big'),
@@ -92,111 +490,411 @@ class RemotePoint:
             addr.to_bytes(4, 'big'),
             port.to_bytes(2, 'big')
         ])
-        self.client_socket.sendall(reply)
 
-        # establish data exchange
-        if reply[1] != 0:
-            raise self.refuse_connection(self.client_socket)
+    def send_early_data(self, data: bytes):
+        """Client payload received together with SOCKS5 request, before the reply"""
+        self.server_socket.sendall(data)
+        self.outgoing_b += len(data)
 
-        # get proxy response
-        if not self.reason_skip_proxy:
-            proxy_response = self.server_socket.recv(BUFFER_SIZE).decode('utf-8')
-            if not proxy_response.startswith('HTTP/1.1 200'):
-                raise self.refuse_connection(self.client_socket, f'the proxy did not confirm the connection to {remote_address}')
+        if self.inspector_writer and self.is_inspected:
+            self.process_package(data, True)
 
-        # connected via proxy
-        self.is_active = True
+    async def send_early_data_async(self, loop: asyncio.AbstractEventLoop, data: bytes):
+        await loop.sock_sendall(self.server_socket, data)
+        self.outgoing_b += len(data)
+
+        if self.inspector_writer and self.is_inspected:
+            await self.process_package_async(data, True)
+
+    def receive_early_data(self, data: bytes):
+        """Remote payload received together with proxy response, before the relay"""
+        self.client_socket.sendall(data)
+        self.incoming_b += len(data)
+
+        if self.inspector_writer and self.is_inspected:
+            self.process_package(data, False)
+
+    async def receive_early_data_async(self, loop: asyncio.AbstractEventLoop, data: bytes):
+        await loop.sock_sendall(self.client_socket, data)
+        self.incoming_b += len(data)
+
+        if self.inspector_writer and self.is_inspected:
+            await self.process_package_async(data, False)
 
     def watch(self):
+        # payload doesn't have to be seen by python without inspector
+        if SPLICE_ENABLED and not (self.inspector_writer and self.is_inspected):
+            return self.watch_splice()
+
+        directions = [
+            RelayDirection(self.client_socket, self.server_socket, True),
+            RelayDirection(self.server_socket, self.client_socket, False),
+        ]
+
+        # partial writes are kept in `pending` until peer is writable
+        self.client_socket.setblocking(False)
+        self.server_socket.setblocking(False)
+
         try:
             # communicate
             while True:
+                now = time.monotonic()
+
+                # read only directions without pending data and not throttled, wait for writable peer otherwise
+                readers = [direction.source for direction in directions if direction.pending is None and direction.resume_at <= now]
+                writers = [direction.target for direction in directions if direction.pending is not None]
+
+                # throttled directions are resumed by timeout
+                resume_at = min((direction.resume_at for direction in directions if direction.resume_at > now), default=None)
 
-                # wait until client or remote is available for read
                 try:
-                    r, w, e = select.select([self.client_socket, self.server_socket], [], [])
-                except OSError:
+                    r, w, e = select.select(readers, writers, [], None if resume_at is None else resume_at - now)
+                except (OSError, ValueError):
                     break
 
+                if not r and not w:
+                    continue
+
                 # update last activity
                 self.updated_at = time.time()
+                if self.entry_point:
+                    self.entry_point.last_activity = self.updated_at
 
-                # send from client
-                if self.client_socket in r:
-                    data = self.client_socket.recv(BUFFER_SIZE)
+                for direction in directions:
 
-                    if self.server_socket.send(data) <= 0:
-                        break
+                    # continue partial write
+                    if direction.target in w:
+                        direction.send(direction.pending)
 
-                    # process
-                    threading.Thread(target=self.process_package, args=(data, True), daemon=True).start()
+                    if direction.source not in r:
+                        continue
 
-                # receive from remote
-                if self.server_socket in r:
-                    data = self.server_socket.recv(BUFFER_SIZE)
+                    try:
+                        data = direction.receive(self.read_limit(direction.is_outgoing))
+                    except BlockingIOError:
+                        continue
 
-                    if self.client_socket.send(data) <= 0:
-                        break
+                    # connection closed
+                    if data is None:
+                        return self._flush(directions)
+
+                    direction.send(data)
+
+                    if direction.is_outgoing:
+                        self.outgoing_b += len(data)
+                    else:
+                        self.incoming_b += len(data)
 
-                    # process
-                    threading.Thread(target=self.process_package, args=(data, False), daemon=True).start()
+                    # wait for rate limits
+                    delay = self.throttle(len(data), direction.is_outgoing)
+                    if delay:
+                        direction.resume_at = time.monotonic() + delay
+
+                    # mirror to inspector (buffer is reused, so queue a copy)
+                    if self.inspector_writer and self.is_inspected:
+                        self.process_package(bytes(data), direction.is_outgoing)
+        except OSError:
+            pass
         finally:
+            for direction in directions:
+                direction.release()
+
             # close connection
             self.close()
 
-    def close(self):
+    def _flush(self, directions: list):
+        """Deliver pending data of still open directions before close"""
+        for direction in directions:
+            if direction.pending is not None:
+                direction.target.settimeout(FLUSH_TIMEOUT)
+                direction.target.sendall(direction.pending)
+
+    def watch_splice(self):
+        """
+        Zero-copy relay: data moves socket -> pipe -> socket inside the kernel.
+
+        Bytes not yet accepted by a slow peer stay in the pipe of their direction, its source is not read
+        until they're written (the other direction goes on), as `watch` does with `pending`.
+        """
+        directions = [
+            SpliceDirection(self.client_socket, self.server_socket, True),
+            SpliceDirection(self.server_socket, self.client_socket, False),
+        ]
+
+        # splice to a blocking socket would wait for the whole chunk
+        self.client_socket.setblocking(False)
+        self.server_socket.setblocking(False)
+
         try:
-            self.client_socket.close()
-        except:
+            # communicate
+            while True:
+                now = time.monotonic()
+
+                # read only directions with empty pipe and not throttled, wait for writable peer otherwise
+                readers = [direction.source for direction in directions if not direction.pending and direction.resume_at <= now]
+                writers = [direction.target for direction in directions if direction.pending]
+
+                # throttled directions are resumed by timeout
+                resume_at = min((direction.resume_at for direction in directions if direction.resume_at > now), default=None)
+
+                try:
+                    r, w, e = select.select(readers, writers, [], None if resume_at is None else resume_at - now)
+                except (OSError, ValueError):
+                    break
+
+                if not r and not w:
+                    continue
+
+                # update last activity
+                self.updated_at = time.time()
+                if self.entry_point:
+                    self.entry_point.last_activity = self.updated_at
+
+                for direction in directions:
+
+                    # continue partial write
+                    if direction.target in w:
+                        direction.send()
+
+                    if direction.source not in r:
+                        continue
+
+                    size = direction.receive(self.read_limit(direction.is_outgoing) or SPLICE_SIZE)
+                    if size is None:
+                        continue
+
+                    # connection closed
+                    if not size:
+                        return self._flush_splice(directions)
+
+                    direction.send()
+
+                    if direction.is_outgoing:
+                        self.outgoing_b += size
+                    else:
+                        self.incoming_b += size
+
+                    # wait for rate limits
+                    delay = self.throttle(size, direction.is_outgoing)
+                    if delay:
+                        direction.resume_at = time.monotonic() + delay
+        except OSError:
             pass
+        finally:
+            for direction in directions:
+                direction.release()
+
+            # close connection
+            self.close()
+
+    @staticmethod
+    def _flush_splice(directions: list):
+        """Deliver bytes left in pipes of still open directions before close"""
+        deadline = time.monotonic() + FLUSH_TIMEOUT
+
+        while writers := [direction.target for direction in directions if direction.pending]:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+
+            r, w, e = select.select([], writers, [], remaining)
+            for direction in directions:
+                if direction.target in w:
+                    direction.send()
+
+    async def watch_async(self, loop: asyncio.AbstractEventLoop):
+        relays = [
+            loop.create_task(self._relay_async(loop, self.client_socket, self.server_socket, True)),
+            loop.create_task(self._relay_async(loop, self.server_socket, self.client_socket, False)),
+        ]
+
+        try:
+            # tunnel is over when any direction is over
+            await asyncio.wait(relays, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for relay in relays:
+                relay.cancel()
+            await asyncio.gather(*relays, return_exceptions=True)
+
+            # close connection
+            self.close()
+
+    async def _relay_async(self, loop: asyncio.AbstractEventLoop, source: socket.socket, target: socket.socket, is_outgoing: bool):
+        direction = RelayDirection(source, target, is_outgoing)
 
         try:
-            self.server_socket.close()
-        except:
+            while True:
+                limit = self.read_limit(is_outgoing)
+                view = direction.next_view()
+                size = await loop.sock_recv_into(source, view[:limit] if limit else view)
+                if not size:
+                    break
+
+                direction.last_size = size
+                data = direction.view[:size]
+
+                # update last activity
+                self.updated_at = time.time()
+                if self.entry_point:
+                    self.entry_point.last_activity = self.updated_at
+
+                # sendall keeps the rest of partial write until target is writable
+                await loop.sock_sendall(target, data)
+
+                if is_outgoing:
+                    self.outgoing_b += size
+                else:
+                    self.incoming_b += size
+
+                # wait for rate limits
+                delay = self.throttle(size, is_outgoing)
+                if delay:
+                    await asyncio.sleep(delay)
+
+                # mirror to inspector (buffer is reused, so queue a copy)
+                if self.inspector_writer and self.is_inspected:
+                    await self.process_package_async(bytes(data), is_outgoing)
+        except OSError:
             pass
+        finally:
+            direction.release()
+
+    def close(self):
+        # tunnel driven by asyncio engine: cancel it on its loop, sockets are closed by `watch_async`
+        if self.task and not self.task.done() and self.task is not self._current_task():
+            self.is_active = False
+            self.loop.call_soon_threadsafe(self.task.cancel)
+            return self.proxy_outgoing_usage_b, self.proxy_incoming_usage_b
+
+        for sock in (self.client_socket, self.server_socket):
+            try:
+                # shutdown wakes up `watch` blocked in select from another thread
+                sock.shutdown(socket.SHUT_RDWR)
+            except:
+                pass
+
+            try:
+                sock.close()
+            except:
+                pass
 
         self.is_active = False
 
-        return (self.proxy_outgoing_usage_b, self.proxy_incoming_usage_b) if not self.reason_skip_proxy else (0, 0)
+        # fold counts into entry point totals
+        if self.entry_point:
+            self.entry_point.release_remote_point(self)
 
-    def process_package(self, data, is_outgoing: bool):
-        package_size = len(data)
-        key = 'outgoing' if is_outgoing else 'incoming'
+        # queued frames are still sent
+        inspector_writer, self.inspector_writer = self.inspector_writer, None
+        if inspector_writer and self.is_multiplexed:
+            if self.is_inspected:
+                inspector_writer.put(pack_frame(CLOSE, self.id), force=True)
+        elif inspector_writer:
+            inspector_writer.close()
 
-        # counting proxy usage
-        if not self.reason_skip_proxy:
-            setattr(self, f'proxy_{key}_usage_b', getattr(self, f'proxy_{key}_usage_b') + package_size)
+        return self.proxy_outgoing_usage_b, self.proxy_incoming_usage_b
 
-        if self.inspector_socket:
+    def set_rate_limits(self, outgoing: int, incoming: int, burst: int = None):
+        """Rate limits of connection in bytes per sec (0 - unlimited)"""
+        self.outgoing_bucket = TokenBucket(outgoing, burst) if outgoing else None
+        self.incoming_bucket = TokenBucket(incoming, burst) if incoming else None
 
-            # filters
-            if self.inspector['filters'] and not any([ipaddress.IPv4Address(self.remote_address) in ipaddress.IPv4Network(ip_mask) for ip_mask in self.inspector['filters']]):
-                return
+    def throttle(self, size: int, is_outgoing: bool) -> float:
+        """Take relayed bytes from rate limits of entry point and connection, return seconds to wait before next read"""
+        buckets = (self.outgoing_bucket, self.entry_point and self.entry_point.outgoing_bucket) if is_outgoing else \
+            (self.incoming_bucket, self.entry_point and self.entry_point.incoming_bucket)
 
-            with self.inspector_lock:
-                package_size = struct.pack('>I', package_size)
-                is_outgoing = int(is_outgoing).to_bytes(1, 'little')
+        delay = max(bucket.consume(size) if bucket else 0 for bucket in buckets)
 
-                try:
-                    self.inspector_socket.sendall(package_size + is_outgoing + data)
-                except BrokenPipeError:
-                    self.inspector_socket = None
-                    logger.error('inspector socket close connection')
+        if delay:
+            direction = 'outgoing' if is_outgoing else 'incoming'
+            THROTTLED_SECONDS.inc(delay, direction)
+
+            if self.entry_point:
+                self.entry_point.shaping[f'{direction}_throttled'] += 1
+                self.entry_point.shaping[f'{direction}_throttled_seconds'] += delay
+
+        return delay
+
+    def read_limit(self, is_outgoing: bool) -> int:
+        """Max bytes of one read under rate limits (0 - unlimited)"""
+        buckets = (self.outgoing_bucket, self.entry_point and self.entry_point.outgoing_bucket) if is_outgoing else \
+            (self.incoming_bucket, self.entry_point and self.entry_point.incoming_bucket)
+
+        return min((bucket.burst for bucket in buckets if bucket and bucket.rate), default=0)
+
+    @property
+    def route(self):
+        return 'direct' if self.reason_skip_proxy else 'proxy'
+
+    @property
+    def proxy_outgoing_usage_b(self):
+        # total bytes size (only proxy usage)
+        return self.outgoing_b if not self.reason_skip_proxy else 0
+
+    @property
+    def proxy_incoming_usage_b(self):
+        # total bytes size (only proxy usage)
+        return self.incoming_b if not self.reason_skip_proxy else 0
+
+    def inspector_frame(self, data, is_outgoing: bool):
+        if self.is_multiplexed:
+            return pack_frame(OUTGOING if is_outgoing else INCOMING, self.id, data)
+
+        return struct.pack('>I', len(data)) + int(is_outgoing).to_bytes(1, 'little') + data
+
+    def process_package(self, data, is_outgoing: bool):
+        """Queue payload to inspector, waits for room with backpressure policy"""
+        inspector_writer = self.inspector_writer # cleared by close from another thread
+        if inspector_writer and self.is_inspected:
+            inspector_writer.put(self.inspector_frame(data, is_outgoing))
+
+    async def process_package_async(self, data, is_outgoing: bool):
+        """Same as `process_package`, but waits for room without blocking the loop"""
+        inspector_writer = self.inspector_writer
+        if inspector_writer and self.is_inspected:
+            frame = self.inspector_frame(data, is_outgoing)
+            loop = asyncio.get_running_loop()
+
+            try:
+                while True:
+                    # writer thread wakes up the loop when room frees
+                    room = asyncio.Event()
+                    if inspector_writer.put(frame, block=False, on_room=functools.partial(loop.call_soon_threadsafe, room.set)):
+                        break
+                    await room.wait()
+            except asyncio.CancelledError:
+                # tunnel is closed while waiting, payload is already relayed
+                inspector_writer.put(frame, force=True)
+                raise
+
+    def _current_task(self):
+        try:
+            if asyncio.get_running_loop() is self.loop:
+                return asyncio.current_task()
+        except RuntimeError:
+            # not in event loop thread
+            pass
+
+        return None
 
     @staticmethod
-    def refuse_connection(connection: socks.socksocket, message: str = 'connection refused'):
+    def refuse_connection(connection: socks.socksocket, message: str = 'connection refused', reason: str = 'other', reply: bytes = REPLY_AUTH_FAILURE):
+        CONNECTIONS_REFUSED.inc(label_value=reason)
+
         try:
-            connection.sendall(bytes([1, 0xFF]))
+            connection.sendall(reply)
             connection.close()
-            return ConnectionError(message)
         except OSError:
             # connection already closed
-            return
+            pass
+
+        return ConnectionError(message)
 
     @staticmethod
     def is_local_ip(ip: str):
-        return ip.startswith('192.168.') or ip.startswith('127.0.')
+        return ip in LOCAL_NETWORKS_MATCHER
 
     @staticmethod
     def is_google_ip(ip: str):
-        return any([ipaddress.IPv4Address(ip) in ipaddress.IPv4Network(ip_mask) for ip_mask in GOOGLE_IPS])
+        return ip in GOOGLE_IPS_MATCHER
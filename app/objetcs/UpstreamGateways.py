@@ -0,0 +1,171 @@
+import random
+import threading
+import time
+from typing import List, Optional
+
+from decouple import config
+
+from app.utils.get_logger import get_logger
+
+GATEWAY_EWMA_ALPHA = config('GATEWAY_EWMA_ALPHA', default=0.2, cast=float) # weight of the latest CONNECT in latency/failure rate
+GATEWAY_EJECT_FAILURES = config('GATEWAY_EJECT_FAILURES', default=3, cast=int) # consecutive failures
+GATEWAY_EJECT_TIME = config('GATEWAY_EJECT_TIME', default=10, cast=int) # sec, doubles on every ejection in a row
+GATEWAY_MAX_EJECT_TIME = config('GATEWAY_MAX_EJECT_TIME', default=300, cast=int) # sec
+GATEWAY_READMIT_TIME = config('GATEWAY_READMIT_TIME', default=30, cast=int) # sec, traffic share grows back to full
+GATEWAY_MIN_SHARE = 0.1 # traffic share of gateway just readmitted
+
+logger = get_logger(__name__)
+
+
+class Gateway:
+    """
+    Upstream proxy endpoint with health of recent CONNECTs: EWMA of latency and failure rate.
+
+    Consecutive failures eject the gateway for a while (doubling on every ejection in a row),
+    after that it's readmitted with a small share of tunnels growing to full during `GATEWAY_READMIT_TIME`.
+    A failure while readmitted ejects it again.
+    """
+
+    __slots__ = (
+        'host', 'port', 'latency', 'failure_rate', 'consecutive_failures', 'ejections_in_row',
+        'ejected_until', 'readmitted_at', 'connects', 'failures', 'ejections', 'lock',
+    )
+
+    host: str
+    port: int
+
+    latency: Optional[float] # sec, EWMA of successful CONNECTs, None - no data
+    failure_rate: float # EWMA of failures 0..1
+    consecutive_failures: int
+    ejections_in_row: int
+    ejected_until: float # monotonic time
+    readmitted_at: Optional[float] # monotonic time, None - not ejected since readmission completed
+
+    connects: int
+    failures: int
+    ejections: int
+
+    def __init__(self, host: str, port: int):
+        self.host = host
+        self.port = port
+
+        self.latency = None
+        self.failure_rate = 0
+        self.consecutive_failures = 0
+        self.ejections_in_row = 0
+        self.ejected_until = 0
+        self.readmitted_at = None
+
+        self.connects = 0
+        self.failures = 0
+        self.ejections = 0
+        self.lock = threading.Lock()
+
+    @property
+    def is_ejected(self):
+        return time.monotonic() < self.ejected_until
+
+    @property
+    def share(self):
+        """Share of tunnels 0..1: 0 while ejected, grows while readmitted"""
+        now = time.monotonic()
+
+        if now < self.ejected_until:
+            return 0
+
+        if self.readmitted_at is None:
+            return 1
+
+        progress = (now - self.ejected_until) / GATEWAY_READMIT_TIME if GATEWAY_READMIT_TIME else 1
+        if progress >= 1:
+            return 1
+
+        return GATEWAY_MIN_SHARE + (1 - GATEWAY_MIN_SHARE) * progress
+
+    def weight(self, default_latency: float):
+        """Higher is better: share of healthy, fast gateway"""
+        return self.share * (1 - self.failure_rate) / max(self.latency or default_latency, 0.001)
+
+    def record_success(self, latency: float):
+        with self.lock:
+            self.connects += 1
+            self.latency = latency if self.latency is None else GATEWAY_EWMA_ALPHA * latency + (1 - GATEWAY_EWMA_ALPHA) * self.latency
+            self.failure_rate *= 1 - GATEWAY_EWMA_ALPHA
+            self.consecutive_failures = 0
+
+            # readmission completed
+            if self.readmitted_at is not None and self.share == 1:
+                self.readmitted_at = None
+                self.ejections_in_row = 0
+
+    def record_failure(self):
+        with self.lock:
+            self.connects += 1
+            self.failures += 1
+            self.failure_rate = GATEWAY_EWMA_ALPHA + (1 - GATEWAY_EWMA_ALPHA) * self.failure_rate
+            self.consecutive_failures += 1
+
+            # readmitted gateway has no credit
+            if self.consecutive_failures >= GATEWAY_EJECT_FAILURES or (self.readmitted_at is not None and not self.is_ejected):
+                self._eject()
+
+    def _eject(self):
+        eject_time = min(GATEWAY_EJECT_TIME * 2 ** self.ejections_in_row, GATEWAY_MAX_EJECT_TIME)
+        self.ejected_until = time.monotonic() + eject_time
+        self.readmitted_at = self.ejected_until
+        self.ejections_in_row += 1
+        self.ejections += 1
+        self.consecutive_failures = 0
+
+        logger.warning(f'upstream gateway {self.host}:{self.port} ejected for {eject_time} sec')
+
+    def stats(self):
+        return {
+            'gateway': f'{self.host}:{self.port}',
+            'connects': self.connects,
+            'failures': self.failures,
+            'ejections': self.ejections,
+            'latency': self.latency,
+            'failure_rate': self.failure_rate,
+            'share': self.share,
+            'is_ejected': self.is_ejected,
+        }
+
+
+class UpstreamGateways:
+    """
+    Upstream proxy endpoints of this process (.env :: PROXY_HOSTS, or PROXY_HOST:PROXY_PORT), picked by health.
+    """
+
+    gateways: List[Gateway]
+
+    def __init__(self, addresses: List[str]):
+        self.gateways = []
+        for address in addresses:
+            host, port = address.strip().rsplit(':', 1)
+            self.gateways.append(Gateway(host, int(port)))
+
+    def candidates(self, attempts: int) -> List[Gateway]:
+        """
+        Gateways to try in order: the first is random by weight (tunnels are spread over healthy gateways),
+        the rest by weight. If all are ejected, they're tried anyway in order of readmission.
+        """
+        known_latencies = [gateway.latency for gateway in self.gateways if gateway.latency is not None]
+        default_latency = min(known_latencies, default=1) # unknown gateway is tried as the fastest
+        weights = {gateway: gateway.weight(default_latency) for gateway in self.gateways}
+
+        available = [gateway for gateway in self.gateways if weights[gateway] > 0]
+        if not available:
+            return sorted(self.gateways, key=lambda gateway: gateway.ejected_until)[:max(attempts, 1)]
+
+        first = random.choices(available, [weights[gateway] for gateway in available])[0]
+        rest = sorted((gateway for gateway in available if gateway is not first), key=weights.get, reverse=True)
+
+        return [first] + rest[:max(attempts - 1, 0)]
+
+    def pick(self) -> Gateway:
+        return self.candidates(1)[0]
+
+    def stats(self):
+        return [gateway.stats() for gateway in self.gateways]
+
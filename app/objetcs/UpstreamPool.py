@@ -0,0 +1,127 @@
+import socket
+import threading
+import time
+from collections import deque
+from typing import Deque, Dict, Optional, Tuple
+
+from decouple import config
+
+from app.utils.get_logger import get_logger
+
+UPSTREAM_POOL_SIZE = config('UPSTREAM_POOL_SIZE', default=8, cast=int) # 0 - disabled
+UPSTREAM_POOL_MAX_AGE = config('UPSTREAM_POOL_MAX_AGE', default=30, cast=int) # sec
+UPSTREAM_CONNECT_TIMEOUT = config('UPSTREAM_CONNECT_TIMEOUT', default=10, cast=float) # sec
+UPSTREAM_RETRY_DELAY = 1 # sec, doubles on every failure up to UPSTREAM_POOL_MAX_AGE
+
+logger = get_logger(__name__)
+
+
+class UpstreamPool:
+    """
+    Idle TCP connections to an upstream proxy, established in advance.
+
+    Upstream authorizes every CONNECT request by itself, so a connection can be taken
+    by any tunnel and used for CONNECT immediately.
+    """
+
+    pools: Dict[Tuple[str, int], 'UpstreamPool'] = {} # (host, port) -> pool of this process
+    pools_lock = threading.Lock()
+
+    host: str
+    port: int
+    size: int
+    max_age: int
+
+    idle: Deque[Tuple[socket.socket, float]] # (connection, connected at)
+    hits: int
+    misses: int
+
+    def __init__(self, host: str, port: int, size: int = UPSTREAM_POOL_SIZE, max_age: int = UPSTREAM_POOL_MAX_AGE):
+        self.host = host
+        self.port = port
+        self.size = size
+        self.max_age = max_age
+
+        self.idle = deque()
+        self.hits = 0
+        self.misses = 0
+        self.refill_event = threading.Event()
+
+        if self.size > 0:
+            threading.Thread(target=self._refill, daemon=True).start()
+
+    @classmethod
+    def get(cls, host: str, port: int):
+        """Pool of upstream (created on first call)"""
+        pool = cls.pools.get((host, port))
+
+        if pool is None:
+            with cls.pools_lock:
+                pool = cls.pools.get((host, port))
+                if pool is None:
+                    pool = cls.pools[(host, port)] = cls(host, port)
+
+        return pool
+
+    def acquire(self) -> Optional[socket.socket]:
+        """Healthy idle connection or None if pool is empty"""
+        try:
+            while True:
+                connection, connected_at = self.idle.pop()
+
+                if time.time() - connected_at < self.max_age and self.is_healthy(connection):
+                    self.hits += 1
+                    return connection
+
+                connection.close()
+        except IndexError:
+            self.misses += 1
+            return None
+        finally:
+            self.refill_event.set()
+
+    def connect(self) -> socket.socket:
+        """New connection to upstream"""
+        connection = socket.create_connection((self.host, self.port), timeout=UPSTREAM_CONNECT_TIMEOUT)
+        connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        connection.settimeout(None)
+        return connection
+
+    @staticmethod
+    def is_healthy(connection: socket.socket):
+        # idle upstream connection must have nothing to read: any data or EOF means it is closed
+        try:
+            connection.recv(1, socket.MSG_PEEK | socket.MSG_DONTWAIT)
+        except BlockingIOError:
+            return True
+        except OSError:
+            return False
+
+        return False
+
+    def _refill(self):
+        retry_delay = UPSTREAM_RETRY_DELAY
+
+        while True:
+            self.refill_event.clear()
+
+            # drop expired connections (the oldest are on the left)
+            while self.idle and time.time() - self.idle[0][1] >= self.max_age:
+                try:
+                    self.idle.popleft()[0].close()
+                except IndexError:
+                    break
+
+            # fill up to size
+            while len(self.idle) < self.size:
+                try:
+                    self.idle.append((self.connect(), time.time()))
+                except OSError as exc:
+                    logger.warning(f'upstream {self.host}:{self.port} is not available: {exc}')
+                    time.sleep(retry_delay)
+                    retry_delay = min(retry_delay * 2, self.max_age)
+                else:
+                    retry_delay = UPSTREAM_RETRY_DELAY
+
+            # wait for taken or expiring connections
+            self.refill_event.wait(self.max_age / 2)
@@ -0,0 +1,152 @@
+import threading
+import time
+from collections import deque
+from typing import Deque, Dict, Optional, Tuple
+
+from decouple import config
+
+from app.objetcs.ForwarderProxy import ForwarderProxy
+from app.utils.get_logger import get_logger
+
+PROXY_WARM_POOL = config('PROXY_WARM_POOL', default='') # country:duration:size,... (e.g. us:10m:4,de:30m:2), empty - disabled
+PROXY_WARM_POOL_MAX_AGE = config('PROXY_WARM_POOL_MAX_AGE', default=0.5, cast=float) # part of session lifetime
+WARM_POOL_RETRY_DELAY = 1 # sec, doubles on every failed probe up to 60
+
+logger = get_logger(__name__)
+
+
+class WarmProxyPool:
+    """
+    Sticky sessions (country + session + duration) verified in advance.
+
+    Session is given out only during the first `max_age` part of its lifetime,
+    older sessions are replaced by new verified ones in background.
+    """
+
+    sizes: Dict[Tuple[str, str], int] # (country, duration) -> number of sessions
+    max_age: float
+
+    sessions: Dict[Tuple[str, str], Deque[Tuple[ForwarderProxy, float]]] # (country, duration) -> (proxy, verified at)
+    hits: int
+    misses: int
+    refills: Dict[Tuple[str, str], dict] # (country, duration) -> refill stats
+
+    def __init__(self, spec: str, max_age: float = PROXY_WARM_POOL_MAX_AGE):
+        self.sizes = self.parse(spec)
+        self.max_age = max_age
+
+        self.sessions = {key: deque() for key in self.sizes}
+        self.hits = 0
+        self.misses = 0
+        self.refills = {key: {'count': 0, 'failures': 0, 'last_latency': None, 'total_latency': 0} for key in self.sizes}
+        self.events = {key: threading.Event() for key in self.sizes}
+
+        for key in self.sizes:
+            threading.Thread(target=self._refill, args=key, daemon=True).start()
+
+    @staticmethod
+    def parse(spec: str):
+        sizes = {}
+
+        for item in filter(None, (item.strip() for item in spec.split(','))):
+            country, duration, size = item.split(':')
+            sizes[(country, duration)] = int(size)
+
+        return sizes
+
+    def take(self, country: Optional[str], duration: str) -> Optional[ForwarderProxy]:
+        """
+        Verified session or None if pool has no sessions of country and duration.
+
+        @param country: None - session of any country
+        """
+        keys = [key for key in self.sizes if key[1] == duration and country in (None, key[0])]
+
+        for key in keys:
+            sessions = self.sessions[key]
+
+            try:
+                while True:
+                    proxy, verified_at = sessions.popleft()
+
+                    # the oldest session first, but enough lifetime must remain
+                    if not self.is_expired(proxy, verified_at):
+                        self.hits += 1
+                        return proxy
+            except IndexError:
+                pass
+            finally:
+                self.events[key].set()
+
+        self.misses += 1
+        return None
+
+    def is_expired(self, proxy: ForwarderProxy, verified_at: float):
+        return time.monotonic() - verified_at >= proxy.lifetime * self.max_age
+
+    def stats(self):
+        requests_count = self.hits + self.misses
+
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / requests_count if requests_count else None,
+            'pools': [{
+                'country': country,
+                'duration': duration,
+                'size': size,
+                'ready': len(self.sessions[(country, duration)]),
+                'refills': self.refills[(country, duration)]['count'],
+                'refill_failures': self.refills[(country, duration)]['failures'],
+                'refill_last_latency': self.refills[(country, duration)]['last_latency'],
+                'refill_avg_latency': (
+                    self.refills[(country, duration)]['total_latency'] / self.refills[(country, duration)]['count']
+                    if self.refills[(country, duration)]['count'] else None
+                ),
+            } for (country, duration), size in self.sizes.items()]
+        }
+
+    def _refill(self, country: str, duration: str):
+        key = (country, duration)
+        sessions = self.sessions[key]
+        stats = self.refills[key]
+        retry_delay = WARM_POOL_RETRY_DELAY
+
+        while True:
+            self.events[key].clear()
+
+            # drop old sessions (the oldest are on the left)
+            while sessions and self.is_expired(*sessions[0]):
+                try:
+                    sessions.popleft()
+                except IndexError:
+                    break
+
+            # fill up to size
+            while len(sessions) < self.sizes[key]:
+                started_at = time.monotonic()
+                proxy = ForwarderProxy(country=country, duration=duration)
+
+                if not proxy.get_ip():
+                    stats['failures'] += 1
+                    logger.warning(f'warm pool {country}:{duration}: no valid proxy, retry in {retry_delay} sec')
+                    time.sleep(retry_delay)
+                    retry_delay = min(retry_delay * 2, 60)
+                    continue
+
+                retry_delay = WARM_POOL_RETRY_DELAY
+                sessions.append((proxy, time.monotonic()))
+                stats['count'] += 1
+                stats['last_latency'] = time.monotonic() - started_at
+                stats['total_latency'] += stats['last_latency']
+
+            # wait for taken or expiring sessions
+            timeout = None
+            if sessions:
+                proxy, verified_at = sessions[0]
+                timeout = max(verified_at + proxy.lifetime * self.max_age - time.monotonic(), 1)
+
+            self.events[key].wait(timeout)
+
+
+WARM_PROXY_POOL = WarmProxyPool(PROXY_WARM_POOL)
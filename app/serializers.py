@@ -3,12 +3,16 @@ import ipaddress
 from marshmallow import Schema, fields, ValidationError, validates, validate
 
 from app.objetcs.ForwarderProxy import AVAILABLE_COUNTRIES, DURATION_TYPES
+from app.objetcs.InspectorWriter import INSPECTOR_POLICIES
 
 
 class InspectorSchema(Schema):
     address = fields.String()
     port = fields.Int()
     filters = fields.List(fields.String(), default=None, required=False)
+    policy = fields.String(validate=validate.OneOf(INSPECTOR_POLICIES), required=False) # when inspector falls behind
+    version = fields.Int(validate=validate.OneOf([1, 2]), required=False) # protocol: 1 - connection per tunnel, 2 - one connection per entry point
+    capture = fields.Bool(required=False) # write frames to local capture files instead of inspector socket
 
     @validates('address')
     def validate_address(self, value):
@@ -26,6 +30,14 @@ class InspectorSchema(Schema):
                 raise ValidationError(str(exc))
 
 
+class RateLimitsSchema(Schema):
+    outgoing = fields.Int(validate=validate.Range(min=0)) # bytes per sec of entry point, 0 - unlimited
+    incoming = fields.Int(validate=validate.Range(min=0))
+    tunnel_outgoing = fields.Int(validate=validate.Range(min=0)) # bytes per sec of every connection
+    tunnel_incoming = fields.Int(validate=validate.Range(min=0))
+    burst = fields.Int(validate=validate.Range(min=1), allow_none=True) # bytes
+
+
 class EntryPointSchema(Schema):
     username = fields.String(required=True, validate=validate.Length(min=1, max=64)) # as session identification
     password = fields.String(required=True, validate=validate.Length(min=1, max=64))
@@ -34,6 +46,10 @@ class EntryPointSchema(Schema):
     ip_duration = fields.String()
     client_host = fields.String()
     inspector = fields.Nested(InspectorSchema(), default=None, required=False)
+    idle_timeout = fields.Int(validate=validate.Range(min=0)) # sec, 0 - never
+    tunnel_idle_timeout = fields.Int(validate=validate.Range(min=0)) # sec, 0 - never
+    rate_limits = fields.Nested(RateLimitsSchema(), required=False)
+    max_tunnels = fields.Int(validate=validate.Range(min=0)) # concurrent connections, 0 - unlimited
 
     @validates('ip_country')
     def validate_ip_country(self, value):
@@ -61,4 +77,12 @@ class EntryPointSchema(Schema):
         try:
             ipaddress.ip_address(value)
         except ValueError as exc:
-            raise ValidationError(str(exc))
\ No newline at end of file
+            raise ValidationError(str(exc))
+
+
+class EntryPointUpdateSchema(Schema):
+    username = fields.String(required=True, validate=validate.Length(min=1, max=64))
+    idle_timeout = fields.Int(validate=validate.Range(min=0))
+    tunnel_idle_timeout = fields.Int(validate=validate.Range(min=0))
+    rate_limits = fields.Nested(RateLimitsSchema(), required=False)
+    max_tunnels = fields.Int(validate=validate.Range(min=0)) # concurrent connections, 0 - unlimited
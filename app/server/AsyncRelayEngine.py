@@ -0,0 +1,260 @@
+import asyncio
+import socket
+import threading
+import time
+import traceback
+from typing import Set
+
+from app.objetcs.RemotePoint import RemotePoint, CONNECTIONS_ACCEPTED, HANDSHAKE_SECONDS, REPLY_ADDRESS_TYPE_NOT_SUPPORTED, REPLY_GENERAL_FAILURE, REPLY_HOST_UNREACHABLE, REPLY_NOT_ALLOWED, REPLY_NO_METHODS
+from app.utils.admission_control import CONNECT_WORKERS, HANDSHAKE_TIMEOUT, HANDSHAKE_WORKERS
+from app.utils.dns_cache import DNS_CACHE
+from app.utils.get_logger import get_logger
+from app.utils.socks5 import Socks5Parser, recv_message_async
+
+logger = get_logger(__name__)
+
+
+class AsyncRelayEngine:
+    """
+    Asyncio engine for ProxyForwarderServer.
+
+    SOCKS5 handshake, upstream connect and bidirectional relay run as coroutines
+    on a single event loop, so a tunnel costs a few objects instead of a thread.
+    """
+
+    server: 'ProxyForwarderServer'
+    loop: asyncio.AbstractEventLoop
+    accept_task: asyncio.Task
+    tasks: Set[asyncio.Task] # handshake and relay task per connection
+    handshakes: int # in progress, bounded by HANDSHAKE_WORKERS
+    connects: int # in progress, bounded by CONNECT_WORKERS
+
+    def __init__(self, server: 'ProxyForwarderServer'):
+        self.server = server
+        self.loop = asyncio.new_event_loop()
+        self.tasks = set()
+        self.handshakes = 0
+        self.connects = 0
+
+    def run(self):
+        """Run event loop until `stop`"""
+        asyncio.set_event_loop(self.loop)
+
+        listening_socket = self.server.listening_socket
+        listening_socket.setblocking(False)
+        self.accept_task = self.loop.create_task(self._watch_new_connections(listening_socket))
+
+        try:
+            self.loop.run_forever()
+        finally:
+            self.loop.close()
+
+    def stop(self):
+        """Close listener and all tunnels (thread-safe)"""
+        asyncio.run_coroutine_threadsafe(self._stop(), self.loop)
+
+    async def _stop(self):
+        tasks = [self.accept_task, *self.tasks]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+        self.server.listening_socket.close()
+        self.loop.stop()
+
+    def run_blocking(self, func, *args):
+        """
+        Run blocking `func` in a daemon thread and return awaitable result.
+
+        Default executor is not used: it refuses new jobs once the main thread is finished.
+        """
+        future = self.loop.create_future()
+
+        def set_result(result, exc):
+            if future.done():
+                return
+            if exc:
+                future.set_exception(exc)
+            else:
+                future.set_result(result)
+
+        def target():
+            try:
+                result = func(*args)
+            except Exception as exc:
+                self.loop.call_soon_threadsafe(set_result, None, exc)
+            else:
+                self.loop.call_soon_threadsafe(set_result, result, None)
+
+        threading.Thread(target=target, daemon=True).start()
+        return future
+
+    async def _watch_new_connections(self, listening_socket: socket.socket):
+        while True:
+            try:
+                conn, addr = await self.loop.sock_accept(listening_socket)
+            except (ConnectionAbortedError, OSError):
+                logger.debug('listener closed')
+                return
+
+            conn.setblocking(False)
+            CONNECTIONS_ACCEPTED.inc()
+
+            # refuse unrecognized entry hosts
+            if addr[0] not in self.server.allowed_hosts:
+                RemotePoint.refuse_connection(conn, reason='host')
+                continue
+
+            # bounded handshake stage
+            if self.handshakes >= HANDSHAKE_WORKERS:
+                RemotePoint.refuse_connection(conn, reason='handshake_overload', reply=REPLY_NO_METHODS)
+                continue
+            self.handshakes += 1
+
+            task = self.loop.create_task(self._connection(conn, addr[0]))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def _connection(self, connection: socket.socket, entry_address: str):
+        started_at = time.monotonic()
+        parser = Socks5Parser()
+
+        try:
+            username = await self._validate_new_connection(connection, parser, entry_address)
+        except (ConnectionError, ValueError, AssertionError, OSError):
+            # invalid or silent request
+            return RemotePoint.refuse_connection(connection, reason='handshake')
+        finally:
+            self.handshakes -= 1
+
+        HANDSHAKE_SECONDS.observe(time.monotonic() - started_at)
+
+        # bounded connect stage
+        if self.connects >= CONNECT_WORKERS:
+            return RemotePoint.refuse_connection(connection, reason='connect_overload', reply=REPLY_GENERAL_FAILURE)
+
+        admitted = False
+        try:
+            self.connects += 1
+            try:
+                remote_point = await self._open_tunnel(connection, parser, username, entry_address)
+            finally:
+                self.connects -= 1
+
+            if remote_point is None:
+                return
+            admitted = True
+
+            # watch while connected
+            self.server.schedule_tunnel_expiry(remote_point)
+            try:
+                await remote_point.watch_async(self.loop)
+            finally:
+                self.server.expiry_scheduler.cancel(remote_point.id)
+        except asyncio.CancelledError:
+            pass
+        except OSError:
+            RemotePoint.refuse_connection(connection, reason='upstream')
+        except:
+            traceback.print_exc()
+            RemotePoint.refuse_connection(connection)
+        finally:
+            if admitted:
+                self.server.admission.release(entry_address, username)
+
+    async def _validate_new_connection(self, connection: socket.socket, parser: Socks5Parser, entry_address: str):
+        methods = await recv_message_async(self.loop, connection, parser, HANDSHAKE_TIMEOUT)
+        assert 2 in methods
+
+        # send welcome message (5 - is socket version)
+        await self.loop.sock_sendall(connection, bytes([5, 2]))
+
+        # verify username and password
+        version, username, password = await recv_message_async(self.loop, connection, parser, HANDSHAKE_TIMEOUT)
+        assert self.server.is_authorized(username, password, entry_address)
+
+        await self.loop.sock_sendall(connection, bytes([version, 0]))
+        return username
+
+    async def _open_tunnel(self, connection: socket.socket, parser: Socks5Parser, username: str, entry_address: str):
+        """
+        Read SOCKS5 request and connect to remote.
+
+        @return: connected RP (admitted, must be released) or None if connection is refused or failed
+        """
+        entry_point = self.server.entry_points.get(username)
+
+        try:
+            cmd, address_type, address, port = await recv_message_async(self.loop, connection, parser, HANDSHAKE_TIMEOUT)
+        except (ConnectionError, ValueError, TimeoutError):
+            # silent or invalid request
+            RemotePoint.refuse_connection(connection, reason='handshake', reply=REPLY_GENERAL_FAILURE)
+            return None
+
+        if cmd != 1 or not entry_point:
+            RemotePoint.refuse_connection(connection, reason='command', reply=REPLY_NOT_ALLOWED)
+            return None
+
+        domain = address if address_type == 3 else None
+
+        if address_type == 3:  # Domain name
+            try:
+                address = self.server.cached_address(address, entry_point) or (await self.run_blocking(DNS_CACHE.resolve, address))[0]
+            except socket.gaierror:
+                RemotePoint.refuse_connection(connection, reason='dns', reply=REPLY_HOST_UNREACHABLE)
+                return None
+        elif address_type != 1:  # IPv4 only
+            RemotePoint.refuse_connection(connection, reason='address_type', reply=REPLY_ADDRESS_TYPE_NOT_SUPPORTED)
+            return None
+
+        # remote address disallowed
+        if address in self.server.DISALLOW_ADDRESSES:
+            RemotePoint.refuse_connection(connection, reason='disallowed', reply=REPLY_NOT_ALLOWED)
+            return None
+
+        # limits of concurrent tunnels
+        reason = self.server.admission.acquire(entry_address, username, entry_point.max_tunnels)
+        if reason:
+            RemotePoint.refuse_connection(connection, reason=reason, reply=REPLY_NOT_ALLOWED)
+            return None
+
+        try:
+            remote_point = entry_point.create_remote_point(
+                server_address=address,
+                port=port,
+                client_socket=connection,
+                addresses=DNS_CACHE.peek(domain) if domain else None,
+                connect=False,
+            )
+        except Exception as exc:
+            logger.error(f'tunnel to {address}:{port} not created: {exc}')
+            RemotePoint.refuse_connection(connection, reason='tunnel', reply=REPLY_GENERAL_FAILURE)
+            self.server.admission.release(entry_address, username)
+            return None
+        except BaseException:
+            connection.close()
+            self.server.admission.release(entry_address, username)
+            raise
+
+        remote_point.loop = self.loop
+        remote_point.task = asyncio.current_task()
+
+        try:
+            # create connection to remote
+            await remote_point.connect_async(self.loop)
+
+            # client didn't wait for reply
+            early_data = parser.leftover()
+            if early_data:
+                await remote_point.send_early_data_async(self.loop, early_data)
+        except (ConnectionError, TimeoutError) as exc:
+            logger.error(f'failed connection to {address}:{port} ({type(exc)}): {exc}')
+            remote_point.close()
+            self.server.admission.release(entry_address, username)
+            return None
+        except BaseException:
+            remote_point.close()
+            self.server.admission.release(entry_address, username)
+            raise
+
+        return remote_point
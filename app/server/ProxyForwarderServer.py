@@ -2,31 +2,51 @@ import socket
 import threading
 import time
 import traceback
-from typing import Dict, List
+from typing import Dict, List, Optional
 
 from decouple import config
 
-from app.objetcs.EntryPoint import EntryPoint
-from app.objetcs.ForwarderProxy import ForwarderProxy
-from app.objetcs.RemotePoint import RemotePoint
+from app.objetcs.EntryPoint import EntryPoint, CLOSED_RELAYED_BYTES
+from app.objetcs.ForwarderProxy import ForwarderProxy, UPSTREAM_GATEWAYS
+from app.objetcs.RemotePoint import RemotePoint, CONNECTIONS_ACCEPTED, HANDSHAKE_SECONDS, REPLY_ADDRESS_TYPE_NOT_SUPPORTED, REPLY_GENERAL_FAILURE, REPLY_HOST_UNREACHABLE, REPLY_NOT_ALLOWED, REPLY_NO_METHODS
+from app.objetcs.UpstreamPool import UpstreamPool
 from app.server import SocketCommunication
+from app.server.AsyncRelayEngine import AsyncRelayEngine
+from app.settings import LOCAL_DOMAINS
+from app.utils.admission_control import AdmissionControl, CONNECT_WORKERS, HANDSHAKE_TIMEOUT, HANDSHAKE_WORKERS, MAX_TUNNELS, MAX_TUNNELS_PER_HOST
+from app.utils.cidr_matcher import CIDRMatcher
+from app.utils.dns_cache import DNS_CACHE
+from app.utils.expiry_scheduler import ExpiryScheduler
 from app.utils.get_logger import get_logger
+from app.utils.metrics import METRICS
+from app.utils.socks5 import Socks5Parser, recv_message
 
 PUBLIC_PROXY_PORT = config('PUBLIC_PROXY_PORT', cast=int)
 INSIDE_SOCKET_PORT = config('INSIDE_SOCKET_PORT', cast=int)
+INSIDE_SOCKET_PATH = config('INSIDE_SOCKET_PATH', default=None) # unix domain socket instead of port
+INSIDE_SOCKET_ADDRESS = INSIDE_SOCKET_PATH or INSIDE_SOCKET_PORT
+PROXY_ENGINE = config('PROXY_ENGINE', default='threading') # threading | asyncio
+DNS_PASSTHROUGH = config('DNS_PASSTHROUGH', default=False, cast=bool) # send domain names to upstream proxy unresolved
+ENTRY_POINT_IDLE_TIMEOUT = config('ENTRY_POINT_IDLE_TIMEOUT', default=300, cast=int) # sec, 0 - never
+TUNNEL_IDLE_TIMEOUT = config('TUNNEL_IDLE_TIMEOUT', default=0, cast=int) # sec, 0 - never
+PROXY_WORKERS = config('PROXY_WORKERS', default=1, cast=int) # processes sharing PUBLIC_PROXY_PORT, 0 - CPU count
+PROXY_REUSE_PORT = config('PROXY_REUSE_PORT', default=False, cast=bool) # set for worker processes by supervisor
 
 logger = get_logger(__name__)
 
 
-@SocketCommunication.listen(INSIDE_SOCKET_PORT)
+@SocketCommunication.listen(INSIDE_SOCKET_ADDRESS)
 class ProxyForwarderServer:
-    INACTIVE_TIMEOUT = 300 # sec
-
-    DISALLOW_ADDRESSES = [
+    DISALLOW_ADDRESSES = CIDRMatcher([
         '8.8.8.8'
-    ]
+    ])
 
     listening_socket: socket
+    engine: Optional[AsyncRelayEngine]
+    expiry_scheduler: ExpiryScheduler # idle entry points and connections
+    admission: AdmissionControl # limits of concurrent tunnels
+    handshake_slots: threading.BoundedSemaphore # threading engine stages
+    connect_slots: threading.BoundedSemaphore
 
     entry_points: Dict[str, EntryPoint] # username as entry point identificator
     allowed_hosts: Dict[str, List[str]] # host as key, list of usernames on host as value
@@ -39,10 +59,18 @@ class ProxyForwarderServer:
         # default init
         self.entry_points = {}
         self.allowed_hosts = {}
+        self.expiry_scheduler = ExpiryScheduler()
+        self.admission = AdmissionControl(MAX_TUNNELS, MAX_TUNNELS_PER_HOST)
+        self.handshake_slots = threading.BoundedSemaphore(HANDSHAKE_WORKERS)
+        self.connect_slots = threading.BoundedSemaphore(CONNECT_WORKERS)
 
         # init listener socket
         self.listening_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 
+        # worker of supervisor: kernel balances connections between processes on the same port
+        if PROXY_REUSE_PORT:
+            self.listening_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+
         # Bind proxy server on special port
         self.listening_socket.bind(('0.0.0.0', PUBLIC_PROXY_PORT))
 
@@ -50,12 +78,32 @@ class ProxyForwarderServer:
         self.listening_socket.listen(socket.SOMAXCONN)
 
         # monitoring connections
-        threading.Thread(target=self._watch_new_connections).start()
-
-        # monitoring inactive connection
-        threading.Thread(target=self._inactive_connection_monitoring, daemon=True).start()
-
-        logger.info(f'Proxy forwarder server launched on port ::{PUBLIC_PROXY_PORT}')
+        if PROXY_ENGINE == 'asyncio':
+            self.engine = AsyncRelayEngine(self)
+            threading.Thread(target=self.engine.run).start()
+        else:
+            self.engine = None
+            threading.Thread(target=self._watch_new_connections).start()
+
+        # pre-connect to upstream gateways
+        for gateway in UPSTREAM_GATEWAYS.gateways:
+            UpstreamPool.get(gateway.host, gateway.port)
+
+        # metrics computed on scrape
+        METRICS.gauge('pfs_entry_points', 'Entry points', lambda: len(self.entry_points))
+        METRICS.gauge('pfs_tunnels', 'Open connections', lambda: sum(len(entry_point.remote_points) for entry_point in list(self.entry_points.values())))
+        METRICS.gauge('pfs_threads', 'Live threads', threading.active_count)
+        METRICS.gauge('pfs_admitted_tunnels', 'Tunnels admitted by limits', lambda: self.admission.tunnels)
+        METRICS.gauge('pfs_relayed_bytes_total', 'Bytes relayed by all connections', self._relayed_bytes, 'direction', 'counter')
+        METRICS.gauge('pfs_upstream_pool_hits_total', 'Connections taken from upstream pool', lambda: {f'{host}:{port}': pool.hits for (host, port), pool in UpstreamPool.pools.items()}, 'upstream', 'counter')
+        METRICS.gauge('pfs_upstream_pool_misses_total', 'Connections missed in upstream pool', lambda: {f'{host}:{port}': pool.misses for (host, port), pool in UpstreamPool.pools.items()}, 'upstream', 'counter')
+        METRICS.gauge('pfs_upstream_pool_idle', 'Idle connections in upstream pool', lambda: {f'{host}:{port}': len(pool.idle) for (host, port), pool in UpstreamPool.pools.items()}, 'upstream')
+        METRICS.gauge('pfs_upstream_gateway_connects_total', 'CONNECTs via upstream gateway', lambda: {f'{gateway.host}:{gateway.port}': gateway.connects for gateway in UPSTREAM_GATEWAYS.gateways}, 'upstream', 'counter')
+        METRICS.gauge('pfs_upstream_gateway_failures_total', 'Failed CONNECTs via upstream gateway', lambda: {f'{gateway.host}:{gateway.port}': gateway.failures for gateway in UPSTREAM_GATEWAYS.gateways}, 'upstream', 'counter')
+        METRICS.gauge('pfs_upstream_gateway_ejections_total', 'Ejections of upstream gateway', lambda: {f'{gateway.host}:{gateway.port}': gateway.ejections for gateway in UPSTREAM_GATEWAYS.gateways}, 'upstream', 'counter')
+        METRICS.gauge('pfs_dns_cache_entries', 'Cached DNS answers', lambda: len(DNS_CACHE.cache))
+
+        logger.info(f'Proxy forwarder server launched on port ::{PUBLIC_PROXY_PORT} ({PROXY_ENGINE} engine)')
 
     def _watch_new_connections(self):
 
@@ -63,10 +111,16 @@ class ProxyForwarderServer:
         while True:
             try:
                 conn, addr = self.listening_socket.accept()
+                CONNECTIONS_ACCEPTED.inc()
 
                 # refuse unrecognized entry hosts
                 if addr[0] not in self.allowed_hosts:
-                    RemotePoint.refuse_connection(conn)
+                    RemotePoint.refuse_connection(conn, reason='host')
+                    continue
+
+                # bounded handshake stage
+                if not self.handshake_slots.acquire(blocking=False):
+                    RemotePoint.refuse_connection(conn, reason='handshake_overload', reply=REPLY_NO_METHODS)
                     continue
 
                 # send to validation
@@ -77,87 +131,180 @@ class ProxyForwarderServer:
                 return
 
     def _validate_new_connection(self, connection, entry_address):
+        started_at = time.monotonic()
+        parser = Socks5Parser()
+
         try:
-            version, nmethods = connection.recv(2)
-            methods = [ord(connection.recv(1)) for i in range(nmethods)]
-            assert 2 in set(methods)
+            methods = recv_message(connection, parser, HANDSHAKE_TIMEOUT)
+            assert 2 in methods
 
             # send welcome message (5 - is socket version)
             connection.sendall(bytes([5, 2]))
 
             # verify username and password
-            version = ord(connection.recv(1))  # should be 1
-            username_len = ord(connection.recv(1))
-            username = connection.recv(username_len).decode('utf-8')
-            password_len = ord(connection.recv(1))
-            password = connection.recv(password_len).decode('utf-8')
+            version, username, password = recv_message(connection, parser, HANDSHAKE_TIMEOUT)
+            assert self.is_authorized(username, password, entry_address)
 
-            # validation: has in entry points
-            assert username in self.entry_points
+            connection.sendall(bytes([version, 0]))
+        except:
+            # invalid or silent request
+            return RemotePoint.refuse_connection(connection, reason='handshake')
+        finally:
+            self.handshake_slots.release()
 
-            # validation: password match
-            assert self.entry_points[username].password == password
+        HANDSHAKE_SECONDS.observe(time.monotonic() - started_at)
 
-            # validation: entry hosts match
-            assert self.entry_points[username].client_host == entry_address
+        # bounded connect stage
+        if not self.connect_slots.acquire(blocking=False):
+            return RemotePoint.refuse_connection(connection, reason='connect_overload', reply=REPLY_GENERAL_FAILURE)
 
-            connection.sendall(bytes([version, 0]))
-        except:
-            # invalid request
-            return RemotePoint.refuse_connection(connection)
-        
         # send to connection thread
-        threading.Thread(target=self._connection_thread, args=(connection, username)).start()
+        threading.Thread(target=self._connection_thread, args=(connection, parser, username, entry_address)).start()
 
-    def _connection_thread(self, connection, username):
-        version, cmd, _, address_type = connection.recv(4)
+    def is_authorized(self, username: str, password: str, entry_address: str):
+        entry_point = self.entry_points.get(username)
 
-        if cmd != 1:
-            return RemotePoint.refuse_connection(connection)
+        # validation: has in entry points
+        if not entry_point:
+            return False
 
-        if address_type == 1:  # IPv4
-            address = socket.inet_ntoa(connection.recv(4))
-        elif address_type == 3:  # Domain name
-            domain_length = connection.recv(1)[0]
-            address = connection.recv(domain_length)
-            address = socket.gethostbyname(address)
-        else:
-            return RemotePoint.refuse_connection(connection)
+        # validation: password and entry hosts match
+        return entry_point.password == password and entry_point.client_host == entry_address
+
+    def cached_address(self, domain: str, entry_point: EntryPoint):
+        """
+        Address of domain without local lookup: cached answer or domain itself passed through to upstream proxy.
+
+        None if domain has to be resolved.
+        """
+        addresses = DNS_CACHE.peek(domain)
+        if addresses:
+            return addresses[0]
+
+        # local names are never passed to upstream, inspector filters need an address
+        if DNS_PASSTHROUGH and not domain.endswith(LOCAL_DOMAINS) and not entry_point.inspector:
+
+            # next connections decide local network/google bypass by cached address
+            DNS_CACHE.prefetch(domain)
+            return domain
+
+        return None
+
+    def _connection_thread(self, connection, parser, username, entry_address):
+        try:
+            remote_point = self._open_tunnel(connection, parser, username, entry_address)
+        finally:
+            self.connect_slots.release()
+
+        if remote_point is None:
+            return
+
+        # watch while connected
+        self.schedule_tunnel_expiry(remote_point)
+        try:
+            remote_point.watch()
+        finally:
+            self.expiry_scheduler.cancel(remote_point.id)
+            self.admission.release(entry_address, username)
+
+    def _open_tunnel(self, connection, parser, username, entry_address):
+        """
+        Read SOCKS5 request and connect to remote.
+
+        @return: connected RP or None if connection is refused or failed
+        """
+        entry_point = self.entry_points.get(username)
+
+        try:
+            cmd, address_type, address, port = recv_message(connection, parser, HANDSHAKE_TIMEOUT)
+        except (OSError, ValueError):
+            # silent or invalid request
+            RemotePoint.refuse_connection(connection, reason='handshake', reply=REPLY_GENERAL_FAILURE)
+            return None
+
+        if cmd != 1 or not entry_point:
+            RemotePoint.refuse_connection(connection, reason='command', reply=REPLY_NOT_ALLOWED)
+            return None
+
+        domain = address if address_type == 3 else None
+
+        if address_type == 3:  # Domain name
+            try:
+                address = self.cached_address(address, entry_point) or DNS_CACHE.resolve(address)[0]
+            except socket.gaierror:
+                RemotePoint.refuse_connection(connection, reason='dns', reply=REPLY_HOST_UNREACHABLE)
+                return None
+        elif address_type != 1:  # IPv4 only
+            RemotePoint.refuse_connection(connection, reason='address_type', reply=REPLY_ADDRESS_TYPE_NOT_SUPPORTED)
+            return None
 
         # remote address disallowed
         if address in self.DISALLOW_ADDRESSES:
-            return RemotePoint.refuse_connection(connection)
+            RemotePoint.refuse_connection(connection, reason='disallowed', reply=REPLY_NOT_ALLOWED)
+            return None
+
+        # limits of concurrent tunnels
+        reason = self.admission.acquire(entry_address, username, entry_point.max_tunnels)
+        if reason:
+            RemotePoint.refuse_connection(connection, reason=reason, reply=REPLY_NOT_ALLOWED)
+            return None
 
-        # convert bytes to unsigned short array
-        port = int.from_bytes(connection.recv(2), 'big', signed=False)
+        # relay works with blocking socket
+        connection.settimeout(None)
 
         try:
             # create connection to remote
-            remote_point = self.entry_points[username].create_remote_point(
+            remote_point = entry_point.create_remote_point(
                 server_address=address,
                 port=port,
                 client_socket=connection,
+                addresses=DNS_CACHE.peek(domain) if domain else None,
             )
         except (ConnectionError, TimeoutError) as exc:
             logger.error(f'failed connection to {address}:{port} ({type(exc)}): {exc}')
         except:
             traceback.print_exc()
+
+            # tunnel not created: client is not replied yet
+            RemotePoint.refuse_connection(connection, reason='tunnel', reply=REPLY_GENERAL_FAILURE)
         else:
-            # watch while connected
-            remote_point.watch()
+            # client didn't wait for reply
+            early_data = parser.leftover()
 
-    def _inactive_connection_monitoring(self):
-        while True:
-            inactive_entry_points = [username for username in self.entry_points.keys() if time.time() - self.entry_points[username].last_activity > self.INACTIVE_TIMEOUT]
+            try:
+                if early_data:
+                    remote_point.send_early_data(early_data)
+            except OSError:
+                remote_point.close()
+            else:
+                return remote_point
 
-            for username in inactive_entry_points:
-                self.delete_entry_point(username)
-                logger.info(f'entry point `{username}` closed due to inactivity')
+        self.admission.release(entry_address, username)
+        return None
 
-            time.sleep(self.INACTIVE_TIMEOUT)
+    def schedule_entry_point_expiry(self, entry_point: EntryPoint):
+        self.expiry_scheduler.schedule(entry_point.username, entry_point.idle_deadline, lambda: self._expire_entry_point(entry_point))
 
-    @SocketCommunication.method(INSIDE_SOCKET_PORT)
-    def create_entry_point(self, username: str, password: str, proxy_kwargs: dict, client_host: str = None, inspector: dict = None):
+    def schedule_tunnel_expiry(self, remote_point: RemotePoint):
+        entry_point = remote_point.entry_point
+
+        if entry_point.tunnel_idle_timeout:
+            self.expiry_scheduler.schedule(remote_point.id, lambda: entry_point.tunnel_idle_deadline(remote_point), lambda: self._expire_tunnel(remote_point))
+        else:
+            self.expiry_scheduler.cancel(remote_point.id)
+
+    def _expire_entry_point(self, entry_point: EntryPoint):
+        # entry point could be recreated with the same username
+        if self.entry_points.get(entry_point.username) is entry_point:
+            self.delete_entry_point(entry_point.username)
+            logger.info(f'entry point `{entry_point.username}` closed due to inactivity')
+
+    def _expire_tunnel(self, remote_point: RemotePoint):
+        remote_point.close()
+        logger.info(f'connection to {remote_point.remote_address}:{remote_point.port} closed due to inactivity')
+
+    @SocketCommunication.method(INSIDE_SOCKET_ADDRESS)
+    def create_entry_point(self, username: str, password: str, proxy_kwargs: dict, client_host: str = None, inspector: dict = None, idle_timeout: int = None, tunnel_idle_timeout: int = None, rate_limits: dict = None, max_tunnels: int = 0):
 
         # check duplicate
         if username in self.entry_points:
@@ -174,7 +321,11 @@ class ProxyForwarderServer:
             password=password,
             proxy=proxy,
             client_host=client_host,
-            inspector=inspector
+            inspector=inspector,
+            idle_timeout=ENTRY_POINT_IDLE_TIMEOUT if idle_timeout is None else idle_timeout,
+            tunnel_idle_timeout=TUNNEL_IDLE_TIMEOUT if tunnel_idle_timeout is None else tunnel_idle_timeout,
+            rate_limits=rate_limits,
+            max_tunnels=max_tunnels,
         )
 
         # allow host
@@ -187,9 +338,12 @@ class ProxyForwarderServer:
         # set entry point object
         self.entry_points[username] = entry_point
 
+        # close when inactive
+        self.schedule_entry_point_expiry(entry_point)
+
         return time.time()
 
-    @SocketCommunication.method(INSIDE_SOCKET_PORT)
+    @SocketCommunication.method(INSIDE_SOCKET_ADDRESS)
     def delete_entry_point(self, username: str):
 
         if username not in self.entry_points:
@@ -208,6 +362,7 @@ class ProxyForwarderServer:
 
         # delete entry point
         del self.entry_points[username]
+        self.expiry_scheduler.cancel(username)
 
         return {
             'deleted_at': time.time(),
@@ -215,25 +370,142 @@ class ProxyForwarderServer:
             'total_proxy_incoming_usage_b': total_proxy_incoming_usage_b
         }
 
-    @SocketCommunication.method(INSIDE_SOCKET_PORT)
+    @SocketCommunication.method(INSIDE_SOCKET_ADDRESS)
     def exists_entry_point(self, username: str):
         return username in self.entry_points
 
-    @SocketCommunication.method(INSIDE_SOCKET_PORT)
+    @SocketCommunication.method(INSIDE_SOCKET_ADDRESS)
+    def update_entry_point(self, username: str, idle_timeout: int = None, tunnel_idle_timeout: int = None, rate_limits: dict = None, max_tunnels: int = None):
+        """
+        Change settings of entry point (None - keep current value).
+
+        @return: current settings or None if entry point not exists
+        """
+        entry_point = self.entry_points.get(username)
+
+        if not entry_point:
+            return None
+
+        if idle_timeout is not None:
+            entry_point.idle_timeout = idle_timeout
+            self.schedule_entry_point_expiry(entry_point)
+
+        if tunnel_idle_timeout is not None:
+            entry_point.tunnel_idle_timeout = tunnel_idle_timeout
+            for RP in list(entry_point.remote_points.values()):
+                if RP.is_active:
+                    self.schedule_tunnel_expiry(RP)
+
+        if rate_limits:
+            entry_point.set_rate_limits(rate_limits)
+
+        if max_tunnels is not None:
+            entry_point.max_tunnels = max_tunnels
+
+        return {
+            'idle_timeout': entry_point.idle_timeout,
+            'tunnel_idle_timeout': entry_point.tunnel_idle_timeout,
+            'rate_limits': entry_point.rate_limits,
+            'max_tunnels': entry_point.max_tunnels,
+        }
+
+    @SocketCommunication.method(INSIDE_SOCKET_ADDRESS)
+    def create_entry_points(self, entry_points: List[dict]):
+        """
+        Create many entry points in one call.
+
+        @param entry_points: list of `create_entry_point` kwargs
+        @return: list of {'username', 'created_at'} in the same order (created_at is None if exists),
+            {'username', 'error'} if entry point can't be created
+        """
+        results = []
+
+        for entry_point in entry_points:
+            try:
+                results.append({
+                    'username': entry_point['username'],
+                    'created_at': self.create_entry_point(**entry_point),
+                })
+            except Exception as exc:
+                logger.exception(exc)
+                results.append({
+                    'username': entry_point.get('username'),
+                    'error': repr(exc),
+                })
+
+        return results
+
+    @SocketCommunication.method(INSIDE_SOCKET_ADDRESS)
+    def delete_entry_points(self, usernames: List[str]):
+        """@return: username -> result of `delete_entry_point`"""
+        return {username: self.delete_entry_point(username) for username in usernames}
+
+    @SocketCommunication.method(INSIDE_SOCKET_ADDRESS)
+    def exists_entry_points(self, usernames: List[str]):
+        """@return: username -> exists"""
+        return {username: username in self.entry_points for username in usernames}
+
+    @SocketCommunication.method(INSIDE_SOCKET_ADDRESS)
+    def entry_point_usage(self, username: str):
+        entry_point = self.entry_points.get(username)
+
+        if not entry_point:
+            return None
+
+        return {
+            'created_at': entry_point.created_at,
+            'last_activity': entry_point.last_activity,
+            'idle_timeout': entry_point.idle_timeout,
+            'tunnel_idle_timeout': entry_point.tunnel_idle_timeout,
+            'rate_limits': entry_point.rate_limits,
+            'max_tunnels': entry_point.max_tunnels,
+        } | entry_point.usage()
+
+    def _relayed_bytes(self):
+        relayed_bytes = {'outgoing': 0, 'incoming': 0} | CLOSED_RELAYED_BYTES.values
+
+        # open connections
+        for entry_point in list(self.entry_points.values()):
+            for RP in list(entry_point.remote_points.values()):
+                relayed_bytes['outgoing'] += RP.outgoing_b
+                relayed_bytes['incoming'] += RP.incoming_b
+
+        return relayed_bytes
+
+    @SocketCommunication.method(INSIDE_SOCKET_ADDRESS)
+    def metrics(self):
+        """Snapshot of metrics (see `app.utils.metrics.to_prometheus`)"""
+        return METRICS.snapshot()
+
+    @SocketCommunication.method(INSIDE_SOCKET_ADDRESS)
+    def gateway_stats(self):
+        """Health and usage of upstream gateways"""
+        return UPSTREAM_GATEWAYS.stats()
+
+    @SocketCommunication.method(INSIDE_SOCKET_ADDRESS)
     def terminate(self):
         # response until socket alive and close all sockets
-        return threading.Thread(target=self._terminate).start()
+        return threading.Thread(target=self._terminate, daemon=False).start()
 
     def _terminate(self):
         # close all active connections
         [self.delete_entry_point(entry_points) for entry_points in self.entry_points.copy().keys()]
 
         # close listener
-        self.listening_socket.close()
+        if self.engine:
+            self.engine.stop()
+        else:
+            # shutdown wakes up blocked accept
+            self.listening_socket.shutdown(socket.SHUT_RDWR)
+            self.listening_socket.close()
 
         # close socket communicator
-        self._socket_communication.listener.close()
+        self._socket_communication.close()
 
 
 if __name__ == '__main__':
-    ProxyForwarderServer()
\ No newline at end of file
+    if PROXY_WORKERS == 1:
+        ProxyForwarderServer()
+    else:
+        from app.server.ProxyForwarderSupervisor import ProxyForwarderSupervisor
+        ProxyForwarderSupervisor().run()
\ No newline at end of file
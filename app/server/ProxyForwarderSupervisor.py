@@ -0,0 +1,420 @@
+import os
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Union
+
+from app.objetcs.EntryPoint import RATE_LIMITS
+from app.server import SocketCommunication
+from app.server.ProxyForwarderServer import ENTRY_POINT_IDLE_TIMEOUT, INSIDE_SOCKET_ADDRESS, INSIDE_SOCKET_PATH, INSIDE_SOCKET_PORT, PROXY_WORKERS, PUBLIC_PROXY_PORT, TUNNEL_IDLE_TIMEOUT
+from app.utils.admission_control import MAX_TUNNELS, MAX_TUNNELS_PER_HOST
+from app.utils.expiry_scheduler import ExpiryScheduler
+from app.utils.get_logger import get_logger
+from app.utils.metrics import merge_snapshots
+
+WORKER_START_TIMEOUT = 15 # sec
+WORKER_RESTART_DELAY = 1 # sec
+
+logger = get_logger(__name__)
+
+
+class ShardedEntryPoint:
+    """
+    Entry point of supervisor: the same entry point exists in every worker.
+    """
+
+    __slots__ = ('username', 'settings', 'worker_kwargs', 'last_activity')
+
+    settings: dict # idle_timeout, tunnel_idle_timeout, rate_limits and max_tunnels as requested
+    worker_kwargs: dict # `create_entry_point` kwargs of worker (shares of limits, no idle timeout)
+    last_activity: float # the latest of workers, refreshed on expiry check
+
+    def __init__(self, username: str, settings: dict, worker_kwargs: dict):
+        self.username = username
+        self.settings = settings
+        self.worker_kwargs = worker_kwargs
+        self.last_activity = time.time()
+
+    def idle_deadline(self):
+        idle_timeout = self.settings['idle_timeout']
+        return self.last_activity + idle_timeout if idle_timeout else None
+
+
+@SocketCommunication.listen(INSIDE_SOCKET_ADDRESS)
+class ProxyForwarderSupervisor:
+    """
+    Runs ProxyForwarderServer in worker processes bound on PUBLIC_PROXY_PORT with SO_REUSEPORT
+    and serves the same control methods: entry points are created in every worker
+    (kernel can give a connection to any of them), usage is summed.
+
+    Workers don't share state, so every worker enforces its own share of entry point `max_tunnels` and
+    `outgoing`/`incoming` rates (limit // workers): connections of a client on one worker get only that share.
+    Idle expiry is decided by supervisor on the latest activity of all workers.
+    """
+
+    workers: List[subprocess.Popen]
+    worker_addresses: List[Union[int, str]] # control socket of worker
+    entry_points: Dict[str, ShardedEntryPoint]
+    expiry_scheduler: ExpiryScheduler
+    terminating: bool
+
+    def __init__(self, workers: int = PROXY_WORKERS):
+        workers = workers or os.cpu_count()
+
+        self.entry_points = {}
+        self.expiry_scheduler = ExpiryScheduler()
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.lock = threading.Lock()
+        self.terminating = False
+
+        # worker control sockets next to supervisor one
+        if INSIDE_SOCKET_PATH:
+            self.worker_addresses = [f'{INSIDE_SOCKET_PATH}.{i}' for i in range(workers)]
+        else:
+            self.worker_addresses = [INSIDE_SOCKET_PORT + 1 + i for i in range(workers)]
+
+        self.workers = [self._start_worker(i) for i in range(workers)]
+        for i in range(workers):
+            self._wait_worker(i)
+
+        logger.info(f'Proxy forwarder supervisor launched on port ::{PUBLIC_PROXY_PORT} ({workers} workers)')
+
+    def _start_worker(self, i: int):
+        address = self.worker_addresses[i]
+
+        env = dict(
+            os.environ,
+            PROXY_WORKERS='1',
+            PROXY_REUSE_PORT='1',
+            PROXY_WORKER_INDEX=str(i + 1),
+            MAX_TUNNELS=str(self._split(MAX_TUNNELS, 'MAX_TUNNELS')),
+            MAX_TUNNELS_PER_HOST=str(self._split(MAX_TUNNELS_PER_HOST, 'MAX_TUNNELS_PER_HOST')),
+        )
+        if isinstance(address, str):
+            env['INSIDE_SOCKET_PATH'] = address
+        else:
+            env['INSIDE_SOCKET_PORT'] = str(address)
+
+        return subprocess.Popen([sys.executable, os.path.join(os.path.dirname(__file__), 'ProxyForwarderServer.py')], env=env)
+
+    def _wait_worker(self, i: int):
+        """Wait until control socket of worker answers"""
+        started_at = time.monotonic()
+
+        while True:
+            try:
+                return self._call(i, 'exists_entry_points', [])
+            except ConnectionError:
+                if self.workers[i].poll() is not None or time.monotonic() - started_at > WORKER_START_TIMEOUT:
+                    raise
+                time.sleep(0.1)
+
+    def run(self):
+        """Restart exited workers until `terminate`"""
+        while not self.terminating:
+            for i, worker in enumerate(self.workers):
+                if worker.poll() is None or self.terminating:
+                    continue
+
+                logger.error(f'worker {i} exited with code {worker.returncode}, restarting')
+                time.sleep(WORKER_RESTART_DELAY)
+
+                try:
+                    with self.lock:
+                        self.workers[i] = self._start_worker(i)
+                        self._wait_worker(i)
+
+                        # new process knows nothing about entry points
+                        self._call(i, 'create_entry_points', [entry_point.worker_kwargs for entry_point in self.entry_points.values()])
+                except ConnectionError as exc:
+                    logger.error(f'worker {i} not started: {exc}')
+
+            time.sleep(0.5)
+
+        for worker in self.workers:
+            worker.wait()
+
+    def _call(self, i: int, method_name: str, *args, **kwargs):
+        return SocketCommunication.SocketListener.send(self.worker_addresses[i], {
+            'method_name': method_name,
+            'args': args,
+            'kwargs': kwargs,
+        })
+
+    def _fan_out(self, method_name: str, *args, **kwargs) -> list:
+        """
+        Call method of all workers concurrently.
+
+        @return: results in order of workers, None for a dead worker (restart replays entry points)
+        """
+        futures = [self.executor.submit(self._call, i, method_name, *args, **kwargs) for i in range(len(self.workers))]
+        results = []
+
+        for i, future in enumerate(futures):
+            try:
+                results.append(future.result())
+            except ConnectionError:
+                if self.workers[i].poll() is None:
+                    raise
+                results.append(None)
+
+        return results
+
+    def _split(self, limit: int, name: str = 'limit'):
+        """
+        Share of limit for one worker (workers never admit more than limit in total), 0 - unlimited.
+
+        @raise ValueError: limit is less than workers (share would be 0 - unlimited)
+        """
+        if 0 < limit < len(self.worker_addresses):
+            raise ValueError(f'{name} {limit} is less than {len(self.worker_addresses)} workers')
+
+        return limit // len(self.worker_addresses)
+
+    def _worker_rate_limits(self, rate_limits: dict):
+        # limits of every connection are not split
+        return rate_limits and {key: self._split(value, key) if key in ('outgoing', 'incoming') else value for key, value in rate_limits.items()}
+
+    def _sharded_entry_point(self, username: str, idle_timeout: int = None, tunnel_idle_timeout: int = None, rate_limits: dict = None, max_tunnels: int = 0, **kwargs):
+        settings = {
+            'idle_timeout': ENTRY_POINT_IDLE_TIMEOUT if idle_timeout is None else idle_timeout,
+            'tunnel_idle_timeout': TUNNEL_IDLE_TIMEOUT if tunnel_idle_timeout is None else tunnel_idle_timeout,
+            'rate_limits': RATE_LIMITS | (rate_limits or {}),
+            'max_tunnels': max_tunnels,
+        }
+
+        return ShardedEntryPoint(username, settings, kwargs | {
+            'username': username,
+            'idle_timeout': 0,
+            'tunnel_idle_timeout': settings['tunnel_idle_timeout'],
+            'rate_limits': self._worker_rate_limits(settings['rate_limits']),
+            'max_tunnels': self._split(max_tunnels, 'max_tunnels'),
+        })
+
+    def schedule_entry_point_expiry(self, entry_point: ShardedEntryPoint):
+        self.expiry_scheduler.schedule(entry_point.username, entry_point.idle_deadline, lambda: self._expire_entry_point(entry_point))
+
+    def _expire_entry_point(self, entry_point: ShardedEntryPoint):
+        # entry point could be recreated with the same username
+        if self.entry_points.get(entry_point.username) is not entry_point:
+            return
+
+        # activity in workers moves deadline
+        activities = [usage['last_activity'] for usage in self._fan_out('entry_point_usage', entry_point.username) if usage]
+        entry_point.last_activity = max(activities + [entry_point.last_activity])
+
+        deadline = entry_point.idle_deadline()
+        if deadline is not None and deadline > time.time():
+            return self.schedule_entry_point_expiry(entry_point)
+
+        self.delete_entry_point(entry_point.username)
+        logger.info(f'entry point `{entry_point.username}` closed due to inactivity')
+
+    @SocketCommunication.method(INSIDE_SOCKET_ADDRESS)
+    def create_entry_point(self, username: str, **kwargs):
+        # invalid limits are raised as by worker
+        self._sharded_entry_point(username, **kwargs)
+
+        result = self.create_entry_points([{'username': username} | kwargs])[0]
+        if 'error' in result:
+            raise RuntimeError(result['error'])
+
+        return result['created_at']
+
+    @SocketCommunication.method(INSIDE_SOCKET_ADDRESS)
+    def create_entry_points(self, entry_points: List[dict]):
+        """See `ProxyForwarderServer.create_entry_points`"""
+        with self.lock:
+            results = [None] * len(entry_points)
+            created = {} # index in batch -> entry point
+            usernames = set()
+
+            for i, kwargs in enumerate(entry_points):
+                username = kwargs.get('username')
+
+                # duplicate in batch exists as the first one
+                if username in self.entry_points or username in usernames:
+                    results[i] = {'username': username, 'created_at': None}
+                    continue
+
+                try:
+                    created[i] = self._sharded_entry_point(**kwargs)
+                    usernames.add(username)
+                except Exception as exc:
+                    results[i] = {'username': username, 'error': repr(exc)}
+
+            # the same entry points in all workers
+            worker_results = [result for result in self._fan_out('create_entry_points', [entry_point.worker_kwargs for entry_point in created.values()]) if result is not None]
+            rollback = []
+
+            for j, (i, entry_point) in enumerate(created.items()):
+                item_results = [result[j] for result in worker_results]
+                failed = [result for result in item_results if not result.get('created_at')]
+
+                if not item_results:
+                    results[i] = {'username': entry_point.username, 'error': repr(ConnectionError('no workers'))}
+                    continue
+
+                # entry point must exist in every worker, otherwise it is deleted in all of them
+                if failed:
+                    results[i] = failed[0] if 'error' in failed[0] else {'username': entry_point.username, 'error': repr(RuntimeError('not created by all workers'))}
+                    if len(failed) < len(item_results):
+                        rollback.append(entry_point.username)
+                    continue
+
+                results[i] = item_results[0]
+                self.entry_points[entry_point.username] = entry_point
+                self.schedule_entry_point_expiry(entry_point)
+
+            if rollback:
+                try:
+                    self._fan_out('delete_entry_points', rollback)
+                except ConnectionError as exc:
+                    logger.error(f'entry points {rollback} not deleted in workers: {exc}')
+
+        return results
+
+    @SocketCommunication.method(INSIDE_SOCKET_ADDRESS)
+    def delete_entry_point(self, username: str):
+        return self.delete_entry_points([username])[username]
+
+    @SocketCommunication.method(INSIDE_SOCKET_ADDRESS)
+    def delete_entry_points(self, usernames: List[str]):
+        """@return: username -> result of `delete_entry_point` with usage of all workers"""
+        with self.lock:
+            results = {username: None for username in usernames}
+
+            for worker_results in self._fan_out('delete_entry_points', usernames):
+                for username, result in (worker_results or {}).items():
+                    if not result:
+                        continue
+
+                    if results[username] is None:
+                        results[username] = result
+                    else:
+                        results[username]['total_proxy_outgoing_usage_b'] += result['total_proxy_outgoing_usage_b']
+                        results[username]['total_proxy_incoming_usage_b'] += result['total_proxy_incoming_usage_b']
+
+            for username in usernames:
+                self.entry_points.pop(username, None)
+                self.expiry_scheduler.cancel(username)
+
+        return results
+
+    @SocketCommunication.method(INSIDE_SOCKET_ADDRESS)
+    def exists_entry_point(self, username: str):
+        return username in self.entry_points
+
+    @SocketCommunication.method(INSIDE_SOCKET_ADDRESS)
+    def exists_entry_points(self, usernames: List[str]):
+        """@return: username -> exists"""
+        return {username: username in self.entry_points for username in usernames}
+
+    @SocketCommunication.method(INSIDE_SOCKET_ADDRESS)
+    def update_entry_point(self, username: str, idle_timeout: int = None, tunnel_idle_timeout: int = None, rate_limits: dict = None, max_tunnels: int = None):
+        """
+        See `ProxyForwarderServer.update_entry_point`
+
+        @raise ValueError: limit is less than workers
+        """
+        with self.lock:
+            entry_point = self.entry_points.get(username)
+
+            if not entry_point:
+                return None
+
+            self._fan_out(
+                'update_entry_point',
+                username,
+                tunnel_idle_timeout=tunnel_idle_timeout,
+                rate_limits=self._worker_rate_limits(rate_limits),
+                max_tunnels=None if max_tunnels is None else self._split(max_tunnels, 'max_tunnels'),
+            )
+
+            # replayed to restarted workers
+            settings = {'idle_timeout': idle_timeout, 'tunnel_idle_timeout': tunnel_idle_timeout, 'max_tunnels': max_tunnels}
+            for key, value in settings.items():
+                if value is not None:
+                    entry_point.settings[key] = value
+            if rate_limits:
+                entry_point.settings['rate_limits'] = entry_point.settings['rate_limits'] | rate_limits
+
+            entry_point.worker_kwargs = self._sharded_entry_point(**entry_point.worker_kwargs | entry_point.settings).worker_kwargs
+
+            if idle_timeout is not None:
+                self.schedule_entry_point_expiry(entry_point)
+
+            return self._settings(entry_point)
+
+    @SocketCommunication.method(INSIDE_SOCKET_ADDRESS)
+    def entry_point_usage(self, username: str):
+        """Usage summed over workers, settings as requested"""
+        entry_point = self.entry_points.get(username)
+
+        if not entry_point:
+            return None
+
+        usage = {}
+        for worker_usage in self._fan_out('entry_point_usage', username):
+            for key, value in (worker_usage or {}).items():
+                if key == 'created_at':
+                    usage[key] = min(usage.get(key, value), value)
+                elif key == 'last_activity':
+                    usage[key] = max(usage.get(key, value), value)
+                elif isinstance(value, (int, float)) and key not in entry_point.settings:
+                    usage[key] = usage.get(key, 0) + value
+
+        return usage | self._settings(entry_point)
+
+    def _settings(self, entry_point: ShardedEntryPoint):
+        """Settings as requested and shares of limits enforced by every worker"""
+        return entry_point.settings | {
+            'worker_limits': {
+                'workers': len(self.worker_addresses),
+                'rate_limits': entry_point.worker_kwargs['rate_limits'],
+                'max_tunnels': entry_point.worker_kwargs['max_tunnels'],
+            },
+        }
+
+    @SocketCommunication.method(INSIDE_SOCKET_ADDRESS)
+    def metrics(self):
+        """Metrics summed over workers"""
+        return merge_snapshots([snapshot for snapshot in self._fan_out('metrics') if snapshot])
+
+    @SocketCommunication.method(INSIDE_SOCKET_ADDRESS)
+    def gateway_stats(self):
+        """Counts summed over workers, health averaged (every worker scores gateways by itself)"""
+        gateways = {}
+        for worker_stats in self._fan_out('gateway_stats'):
+            for stats in worker_stats or []:
+                gateways.setdefault(stats['gateway'], []).append(stats)
+
+        merged = []
+        for gateway, worker_stats in gateways.items():
+            latencies = [stats['latency'] for stats in worker_stats if stats['latency'] is not None]
+            merged.append({
+                'gateway': gateway,
+                'connects': sum(stats['connects'] for stats in worker_stats),
+                'failures': sum(stats['failures'] for stats in worker_stats),
+                'ejections': sum(stats['ejections'] for stats in worker_stats),
+                'latency': sum(latencies) / len(latencies) if latencies else None,
+                'failure_rate': sum(stats['failure_rate'] for stats in worker_stats) / len(worker_stats),
+                'share': sum(stats['share'] for stats in worker_stats) / len(worker_stats),
+                'is_ejected': any(stats['is_ejected'] for stats in worker_stats),
+            })
+
+        return merged
+
+    @SocketCommunication.method(INSIDE_SOCKET_ADDRESS)
+    def terminate(self):
+        # response until socket alive
+        return threading.Thread(target=self._terminate, daemon=False).start()
+
+    def _terminate(self):
+        self.terminating = True
+        self._fan_out('terminate')
+
+        # close socket communicator
+        self._socket_communication.close()
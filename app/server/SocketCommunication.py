@@ -1,27 +1,46 @@
 import functools
-import inspect
+import itertools
 import json
+import os
 import pickle
+import queue
 import struct
 
 import socket
 import threading
 import traceback
-from typing import Type
+from concurrent.futures import Future
+from typing import Dict, Tuple, Type, Union
+
+from decouple import config
 
 from app.utils.get_logger import get_logger
 
 EXCEPTION = b'x8742365__exc__'
-BUF_SIZE = 4096
+HEADER = struct.Struct('>II') # package size, request id
 ENCODING = 'utf-8'
+WORKERS = config('INSIDE_SOCKET_WORKERS', default=8, cast=int) # methods executed concurrently
 
 
 logger = get_logger(__name__)
 
 
+def create_socket(address: Union[int, str]):
+    """
+    Socket for listener address: port on localhost or path of unix domain socket.
+    """
+    if isinstance(address, str):
+        return socket.socket(socket.AF_UNIX, socket.SOCK_STREAM), address
+
+    return socket.socket(socket.AF_INET, socket.SOCK_STREAM), ('127.0.0.1', address)
+
+
 class SocketData:
     """
     Wrapper for encode/decode data between sockets.
+
+    Every package has id of request, so many requests can be sent over one connection
+    without waiting for responses.
     """
 
     method_name: str
@@ -34,7 +53,7 @@ class SocketData:
         self.kwargs = kwargs
 
     @staticmethod
-    def send(result, connection: socket.socket):
+    def send(result, connection: socket.socket, request_id: int = 0):
 
         # exception
         if isinstance(result, Exception):
@@ -44,45 +63,59 @@ class SocketData:
         else:
             bytes_package = json.dumps(result).encode(ENCODING)
 
-        package_size = struct.pack('>I', len(bytes_package))
-        connection.sendall(package_size + bytes_package)
+        connection.sendall(HEADER.pack(len(bytes_package), request_id) + bytes_package)
         return True
 
     @staticmethod
     def receive(connection: socket.socket):
-        packet_size = struct.unpack('>I', connection.recv(4))[0]
-
-        data = b""
-        while len(data) < packet_size:
-            chunk = connection.recv(BUF_SIZE)
-            if not chunk: break
-            data += chunk
+        """
+        @return: (request id, data or exception)
+        """
+        package_size, request_id = HEADER.unpack(SocketData.receive_exactly(connection, HEADER.size))
+        data = SocketData.receive_exactly(connection, package_size)
 
         # exception
         if data.startswith(EXCEPTION):
-            exc = data.replace(EXCEPTION, b'')
-            exc = pickle.loads(exc)
-            raise exc
+            return request_id, pickle.loads(data[len(EXCEPTION):])
 
         # decode result
-        data = json.loads(data.decode(ENCODING))
+        return request_id, json.loads(data.decode(ENCODING))
+
+    @staticmethod
+    def receive_exactly(connection: socket.socket, size: int):
+        data = bytearray(size)
+        view = memoryview(data)
+
+        received = 0
+        while received < size:
+            chunk_size = connection.recv_into(view[received:])
+            if not chunk_size:
+                raise ConnectionError('connection closed')
+            received += chunk_size
 
         return data
 
 
 class SocketListener:
     instance: Type[object]
-    port: int
-    methods: list
+    address: Union[int, str]
+    methods: set
 
     listener: socket
+    requests: queue.SimpleQueue # (connection, send lock, request id, socket action)
 
-    def __init__(self, instance: Type[object], port: int, methods: list):
+    def __init__(self, instance: Type[object], address: Union[int, str], methods: set):
         self.instance = instance
-        self.port = port
+        self.address = address
         self.methods = methods
+        self.requests = queue.SimpleQueue()
+        self.processing = 0 # requests taken by workers
+        self.processed = threading.Condition()
+
+        logger.debug(f'inited for {type(instance).__name__} on {address}')
 
-        logger.debug(f'inited for {type(instance).__name__} on port ::{port}')
+        for i in range(WORKERS):
+            threading.Thread(target=self.worker, daemon=True).start()
 
         threading.Thread(target=self.start_listener, daemon=True).start()
 
@@ -90,16 +123,22 @@ class SocketListener:
         """Launch socket listener"""
         logger.debug('starting...')
 
+        listener, bind_address = create_socket(self.address)
+
         # Create socket
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as self.listener:
+        with listener as self.listener:
             logger.debug('socket created')
 
             # faster terminate (pass `Address already in use` exc)
-            self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if isinstance(self.address, str):
+                if os.path.exists(self.address):
+                    os.unlink(self.address)
+            else:
+                self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
 
-            # Bind localhost listener on special port
-            self.listener.bind(('127.0.0.1', self.port))
-            logger.debug(f'socket bound on :{self.port}')
+            # Bind localhost listener on special address
+            self.listener.bind(bind_address)
+            logger.debug(f'socket bound on {self.address}')
 
             # Start listener
             self.listener.listen()
@@ -108,11 +147,11 @@ class SocketListener:
             while True:
 
                 try:
-                    # waiting for request
+                    # waiting for client
                     conn, _addr = self.listener.accept()
 
-                except ConnectionAbortedError:
-                    logger.critical('listener closed')
+                except (ConnectionAbortedError, OSError):
+                    logger.debug('listener closed')
                     self.listener = None
                     break
 
@@ -120,75 +159,212 @@ class SocketListener:
                     logger.critical(traceback.format_exc())
                     return
 
-                # delegate connection to thread
-                threading.Thread(target=self.connection, args=(conn, _addr)).start()
+                # one reader per client connection
+                threading.Thread(target=self.connection, args=(conn, _addr), daemon=True).start()
+
+    def close(self, timeout: float = 5):
+        """Stop listener when processing requests are answered"""
+        with self.processed:
+            self.processed.wait_for(lambda: not self.processing, timeout)
+
+        listener = self.listener
+
+        if listener:
+            try:
+                # wakes up blocked accept
+                listener.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+            listener.close()
 
     def connection(self, conn, _addr):
         logger.debug(f'connection accepted from {_addr}')
+        send_lock = threading.Lock()
 
-        try:
-            # get method and data
-            socket_action = SocketData.receive(conn)
-            logger.debug(f'request: method `{socket_action["method_name"]}` args `{socket_action["args"]}` kwargs `{socket_action["kwargs"]}`')
+        with conn:
+            while True:
+                try:
+                    # get method and data
+                    request_id, socket_action = SocketData.receive(conn)
+                except (ConnectionError, OSError):
+                    logger.debug(f'connection closed {_addr}')
+                    return
+
+                # process method by workers (requests of one connection are processed concurrently)
+                self.requests.put((conn, send_lock, request_id, socket_action))
+
+    def worker(self):
+        while True:
+            conn, send_lock, request_id, socket_action = self.requests.get()
+
+            with self.processed:
+                self.processing += 1
+
+            try:
+                logger.debug(f'request #{request_id}: method `{socket_action["method_name"]}` args `{socket_action["args"]}` kwargs `{socket_action["kwargs"]}`')
+
+                # process method
+                assert socket_action['method_name'] in self.methods
+
+                result = getattr(self.instance, socket_action['method_name'])(*socket_action['args'], **socket_action['kwargs'])
+                logger.debug(f'result #{request_id}: `{result}`')
 
-            # process method
-            assert socket_action['method_name'] in self.methods
+            except Exception as exc:
+                logger.exception(exc)
+                result = exc
 
-            result = getattr(self.instance, socket_action['method_name'])(*socket_action['args'], **socket_action['kwargs'])
-            logger.debug(f'result: `{result}`')
+            try:
+                with send_lock:
+                    try:
+                        SocketData.send(result, conn, request_id)
+                    except (TypeError, ValueError, pickle.PicklingError) as exc:
+                        # result can't be encoded
+                        logger.exception(exc)
+                        SocketData.send(RuntimeError(repr(exc)), conn, request_id)
+                logger.debug(f'result #{request_id} sent successfully')
+            except OSError:
+                logger.debug(f'result #{request_id} not sent: connection closed')
+
+            with self.processed:
+                self.processing -= 1
+                self.processed.notify_all()
+
+    @classmethod
+    def send(cls, address: Union[int, str], action_data: dict):
+        return SocketClient.get(address).call(action_data)
+
+
+class SocketClient:
+    """
+    Persistent connection to listener, shared by all threads of the process.
+    """
+
+    clients: Dict[Union[int, str], 'SocketClient'] = {} # address -> client of this process
+    clients_lock = threading.Lock()
 
-            with conn:
-                SocketData.send(result, conn)
-                logger.debug('result sent successfully')
+    address: Union[int, str]
+    pid: int
+    connection: socket.socket
+    responses: Dict[int, Tuple[socket.socket, Future]] # request id -> (connection, response)
 
-        except Exception as exc:
-            logger.exception(exc)
-            SocketData.send(exc, conn)
+    def __init__(self, address: Union[int, str]):
+        self.address = address
+        self.pid = os.getpid()
+        self.connection = None
+        self.responses = {}
+        self.request_ids = itertools.count(1)
+        self.lock = threading.Lock()
 
     @classmethod
-    def send(cls, port: int, action_data: dict):
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+    def get(cls, address: Union[int, str]):
+        client = cls.clients.get(address)
+
+        # connections are not shared with forked processes (gunicorn workers)
+        if client is None or client.pid != os.getpid():
+            with cls.clients_lock:
+                client = cls.clients.get(address)
+                if client is None or client.pid != os.getpid():
+                    client = cls.clients[address] = cls(address)
+
+        return client
+
+    def call(self, action_data: dict):
+        response = Future()
+
+        with self.lock:
+            for attempt in range(2):
+                connection = self.connect()
+                request_id = next(self.request_ids)
+                self.responses[request_id] = (connection, response)
+
+                # Send request
+                try:
+                    SocketData.send(action_data, connection, request_id)
+                    break
+                except OSError:
+                    # listener was restarted, try with new connection
+                    del self.responses[request_id]
+                    self.disconnect(connection)
+                    if attempt:
+                        raise
+
+        # Get response
+        result = response.result()
+
+        if isinstance(result, Exception):
+            raise result
+
+        return result
+
+    def connect(self):
+        if self.connection is None:
+            connection, connect_address = create_socket(self.address)
 
             # Try to connect
             try:
-                s.connect(('127.0.0.1', port))
-            except ConnectionRefusedError:
-                raise ConnectionRefusedError(f'lister down on 127.0.0.1:{port}')
+                connection.connect(connect_address)
+            except (ConnectionRefusedError, FileNotFoundError):
+                connection.close()
+                raise ConnectionRefusedError(f'lister down on {self.address}')
+
+            self.connection = connection
+            threading.Thread(target=self.receiver, args=(connection,), daemon=True).start()
 
-            # Send request
-            SocketData.send(action_data, s)
+        return self.connection
 
-            # Get response
-            result = SocketData.receive(s)
+    def disconnect(self, connection: socket.socket):
+        if self.connection is connection:
+            self.connection = None
 
-            return result
+        try:
+            connection.close()
+        except OSError:
+            pass
 
+    def receiver(self, connection: socket.socket):
+        while True:
+            try:
+                request_id, result = SocketData.receive(connection)
+            except (ConnectionError, OSError):
+                break
 
-def listen(port: int):
+            _connection, response = self.responses.pop(request_id, (None, None))
+            if response:
+                response.set_result(result)
+
+        with self.lock:
+            self.disconnect(connection)
+
+            # fail requests waiting for response on this connection (next call reconnects)
+            for request_id, (request_connection, response) in list(self.responses.items()):
+                if request_connection is connection:
+                    del self.responses[request_id]
+                    response.set_result(ConnectionError(f'connection to {self.address} closed'))
+
+
+def listen(address: Union[int, str]):
     """
     Make a class as socket listener with a public methods.
 
-    @param int port:
-        Port of listener. Should be the same with port of public methods.
+    @param int|str address:
+        Port of listener on localhost or path of unix domain socket. Should be the same with address of public methods.
     """
 
     def decorator(cls):
+
+        # registry of public methods
+        cls.socket_methods = {name for name, attr in vars(cls).items() if getattr(attr, 'is_socket_method', False)}
+
         @functools.wraps(cls)
         def wrapper(*args, **kwargs):
             inited_cls = cls(*args, **kwargs)
 
-            # get decorated methods of cls (by source)
-            methods = []
-            source_lines = inspect.getsourcelines(cls)[0]
-            for i, line in enumerate(source_lines):
-                if line.strip().split('(')[0].strip() == '@SocketCommunication.method':
-                    methods.append(source_lines[i+1].split('def')[1].split('(')[0].strip())
-
             # set listener object
             inited_cls._socket_communication = SocketListener(
                 instance=inited_cls,
-                port=port,
-                methods=methods,
+                address=address,
+                methods=cls.socket_methods,
             )
 
             return inited_cls
@@ -196,28 +372,30 @@ def listen(port: int):
     return decorator
 
 
-def method(port: int):
+def method(address: Union[int, str]):
     """
     Use only as @SocketCommunication.method for make the method public.
 
-    @param int port:
-        Set port of listener.
+    @param int|str address:
+        Set address of listener.
     """
 
     def decorator(cls_method):
+        @functools.wraps(cls_method)
         def wrapper(*args, **kwargs):
 
             # call from inside class
-            if args and hasattr(args[0], '__class__') and hasattr(args[0], '_socket_communication'):
-                return cls_method(args[0], *args[1:], **kwargs)
+            if args and hasattr(args[0], 'socket_methods'):
+                return cls_method(*args, **kwargs)
 
             # call as static method
             else:
-                return SocketListener.send(port, {
+                return SocketListener.send(address, {
                     'method_name': cls_method.__name__,
                     'args': args,
                     'kwargs': kwargs
                 })
 
+        wrapper.is_socket_method = True
         return wrapper
     return decorator
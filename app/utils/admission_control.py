@@ -0,0 +1,66 @@
+import threading
+from typing import Dict, Optional
+
+from decouple import config
+
+HANDSHAKE_WORKERS = config('HANDSHAKE_WORKERS', default=256, cast=int) # concurrent SOCKS5 handshakes
+CONNECT_WORKERS = config('CONNECT_WORKERS', default=256, cast=int) # concurrent connects to remote
+HANDSHAKE_TIMEOUT = config('HANDSHAKE_TIMEOUT', default=10, cast=float) # sec per stage: greeting, auth, request
+MAX_TUNNELS = config('MAX_TUNNELS', default=10000, cast=int) # 0 - unlimited
+MAX_TUNNELS_PER_HOST = config('MAX_TUNNELS_PER_HOST', default=0, cast=int) # per client host, 0 - unlimited
+
+
+class AdmissionControl:
+    """
+    Limits of concurrent tunnels: total, per client host and per entry point (0 - unlimited).
+    """
+
+    max_tunnels: int
+    max_tunnels_per_host: int
+
+    tunnels: int
+    host_tunnels: Dict[str, int] # client host -> tunnels
+    entry_point_tunnels: Dict[str, int] # username -> tunnels
+
+    def __init__(self, max_tunnels: int = 0, max_tunnels_per_host: int = 0):
+        self.max_tunnels = max_tunnels
+        self.max_tunnels_per_host = max_tunnels_per_host
+
+        self.tunnels = 0
+        self.host_tunnels = {}
+        self.entry_point_tunnels = {}
+        self.lock = threading.Lock()
+
+    def acquire(self, client_host: str, username: str, max_entry_point_tunnels: int = 0) -> Optional[str]:
+        """
+        Take place of tunnel (must be released by `release`).
+
+        @return: reason of refusal or None if tunnel is admitted
+        """
+        with self.lock:
+            if self.max_tunnels and self.tunnels >= self.max_tunnels:
+                return 'max_tunnels'
+
+            if self.max_tunnels_per_host and self.host_tunnels.get(client_host, 0) >= self.max_tunnels_per_host:
+                return 'host_max_tunnels'
+
+            if max_entry_point_tunnels and self.entry_point_tunnels.get(username, 0) >= max_entry_point_tunnels:
+                return 'entry_point_max_tunnels'
+
+            self.tunnels += 1
+            self.host_tunnels[client_host] = self.host_tunnels.get(client_host, 0) + 1
+            self.entry_point_tunnels[username] = self.entry_point_tunnels.get(username, 0) + 1
+
+        return None
+
+    def release(self, client_host: str, username: str):
+        with self.lock:
+            self.tunnels -= 1
+
+            self.host_tunnels[client_host] -= 1
+            if not self.host_tunnels[client_host]:
+                del self.host_tunnels[client_host]
+
+            self.entry_point_tunnels[username] -= 1
+            if not self.entry_point_tunnels[username]:
+                del self.entry_point_tunnels[username]
@@ -0,0 +1,53 @@
+from collections import deque
+from typing import Deque, Dict
+
+
+class BufferPool:
+    """
+    Reusable bytearrays in power of two size classes.
+
+    Relay reads with `recv_into` into buffers from the pool, so a tunnel doesn't
+    allocate a new bytes object for every chunk.
+    """
+
+    min_size: int
+    max_size: int
+    free: Dict[int, Deque[bytearray]] # size class -> free buffers
+    max_free: Dict[int, int] # size class -> limit of free buffers
+
+    def __init__(self, min_size: int, max_size: int, max_free_b: int = 64 * 1024 * 1024):
+        self.min_size = min_size
+        self.max_size = max_size
+        self.free = {}
+        self.max_free = {}
+
+        size = min_size
+        while size <= max_size:
+            self.free[size] = deque()
+            size *= 2
+
+        # share memory limit equally between size classes
+        for size in self.free:
+            self.max_free[size] = max(1, max_free_b // len(self.free) // size)
+
+    def acquire(self, size: int):
+        size = self.size_class(size)
+
+        try:
+            return self.free[size].pop()
+        except IndexError:
+            return bytearray(size)
+
+    def release(self, buffer: bytearray):
+        free = self.free.get(len(buffer))
+
+        # drop buffers over the limit (GC will collect them)
+        if free is not None and len(free) < self.max_free[len(buffer)]:
+            free.append(buffer)
+
+    def size_class(self, size: int):
+        size_class = self.min_size
+        while size_class < size and size_class < self.max_size:
+            size_class *= 2
+
+        return size_class
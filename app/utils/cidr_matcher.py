@@ -0,0 +1,50 @@
+import bisect
+import ipaddress
+import socket
+from typing import Iterable
+
+
+class CIDRMatcher:
+    """
+    Compiled set of IPv4 networks.
+
+    Networks are merged into sorted integer intervals once, so a lookup is
+    a single binary search instead of parsing every network again.
+    """
+
+    __slots__ = ('starts', 'ends')
+
+    def __init__(self, networks: Iterable[str]):
+        intervals = []
+        for network in networks:
+            network = ipaddress.ip_network(network, strict=False)
+
+            # only IPv4 addresses are relayed
+            if network.version != 4:
+                continue
+
+            intervals.append((int(network.network_address), int(network.broadcast_address)))
+
+        # merge overlapping and adjacent networks
+        merged = []
+        for start, end in sorted(intervals):
+            if merged and start <= merged[-1][1] + 1:
+                merged[-1][1] = max(merged[-1][1], end)
+            else:
+                merged.append([start, end])
+
+        self.starts = [start for start, _ in merged]
+        self.ends = [end for _, end in merged]
+
+    def __contains__(self, ip: str):
+        try:
+            value = int.from_bytes(socket.inet_pton(socket.AF_INET, ip), 'big')
+        except (OSError, TypeError):
+            # not an IPv4 address (domain name, IPv6)
+            return False
+
+        i = bisect.bisect_right(self.starts, value) - 1
+        return i >= 0 and value <= self.ends[i]
+
+    def __len__(self):
+        return len(self.starts)
@@ -0,0 +1,91 @@
+import socket
+import threading
+from concurrent.futures import Future
+from typing import Dict, List, Optional
+
+from decouple import config
+
+from app.utils.ttl_cache import TTLCache
+
+DNS_CACHE_TTL = config('DNS_CACHE_TTL', default=60, cast=int) # sec
+DNS_NEGATIVE_TTL = config('DNS_NEGATIVE_TTL', default=10, cast=int) # sec
+DNS_CACHE_SIZE = config('DNS_CACHE_SIZE', default=10000, cast=int)
+
+
+class DNSCache:
+    """
+    Resolver of domain names to IPv4 addresses with cache.
+
+    Answers are kept for `ttl` seconds, failures for `negative_ttl` seconds.
+    Concurrent lookups of the same name wait for a single query.
+    """
+
+    ttl: int
+    negative_ttl: int
+    cache: TTLCache # domain -> list of addresses or gaierror args
+    inflight: Dict[str, Future] # domain -> result of running lookup
+
+    def __init__(self, ttl: int, negative_ttl: int, max_size: int):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.cache = TTLCache(max_size)
+        self.inflight = {}
+        self.lock = threading.Lock()
+
+    def resolve(self, domain: str) -> List[str]:
+        """
+        Addresses of domain (blocking on cache miss).
+
+        @raise socket.gaierror: domain can't be resolved
+        """
+        result = self.cache.get(domain)
+        if result is None:
+            result = self._lookup(domain)
+
+        # negative answer
+        if isinstance(result, tuple):
+            raise socket.gaierror(*result)
+
+        return result
+
+    def peek(self, domain: str) -> Optional[List[str]]:
+        """Cached addresses of domain without lookup"""
+        result = self.cache.get(domain)
+        return result if isinstance(result, list) else None
+
+    def prefetch(self, domain: str):
+        """Resolve domain in background"""
+        if self.cache.get(domain) is None and domain not in self.inflight:
+            threading.Thread(target=self._lookup, args=(domain,), daemon=True).start()
+
+    def _lookup(self, domain: str):
+        with self.lock:
+            future = self.inflight.get(domain)
+            is_leader = future is None
+            if is_leader:
+                future = self.inflight[domain] = Future()
+
+        # same domain is already resolving
+        if not is_leader:
+            return future.result()
+
+        try:
+            addresses = socket.getaddrinfo(domain, None, socket.AF_INET, socket.SOCK_STREAM)
+            result = list(dict.fromkeys(address[4][0] for address in addresses))
+            self.cache.set(domain, result, self.ttl)
+        except (OSError, UnicodeError) as exc:
+            result = exc.args
+            self.cache.set(domain, result, self.negative_ttl)
+        except BaseException as exc:
+            # waiters must not block forever
+            future.set_exception(exc)
+            raise
+        finally:
+            with self.lock:
+                del self.inflight[domain]
+
+        future.set_result(result)
+        return result
+
+
+DNS_CACHE = DNSCache(DNS_CACHE_TTL, DNS_NEGATIVE_TTL, DNS_CACHE_SIZE)
@@ -0,0 +1,96 @@
+import heapq
+import itertools
+import threading
+import time
+from typing import Callable, Dict, Hashable, List, Optional, Tuple
+
+from app.utils.get_logger import get_logger
+
+logger = get_logger(__name__)
+
+
+class ExpiryScheduler:
+    """
+    Calls `on_expire` of items close to their deadlines (heap ordered by deadline).
+
+    Deadline is computed lazily by `get_deadline` of item, so activity only moves a timestamp:
+    when the old deadline comes, item is put back to the heap with the new one.
+    """
+
+    heap: List[Tuple[float, int, Hashable]] # (deadline, token, key)
+    items: Dict[Hashable, Tuple[int, Callable[[], Optional[float]], Callable]] # key -> (token, get_deadline, on_expire)
+
+    def __init__(self):
+        self.heap = []
+        self.items = {}
+        self.tokens = itertools.count()
+        self.condition = threading.Condition()
+
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def schedule(self, key: Hashable, get_deadline: Callable[[], Optional[float]], on_expire: Callable):
+        """
+        Call `on_expire` when `get_deadline()` (unix time) is in the past, replaces previous schedule of key.
+
+        Deadline None means never.
+        """
+        deadline = get_deadline()
+
+        with self.condition:
+            if deadline is None:
+                self.items.pop(key, None)
+                return
+
+            token = next(self.tokens)
+            self.items[key] = (token, get_deadline, on_expire)
+            heapq.heappush(self.heap, (deadline, token, key))
+
+            # wake up to wait for earlier deadline
+            if self.heap[0][1] == token:
+                self.condition.notify()
+
+    def cancel(self, key: Hashable):
+        with self.condition:
+            self.items.pop(key, None)
+
+            # drop entries of cancelled items when they are the majority
+            if len(self.heap) > 1024 and len(self.heap) > 2 * len(self.items):
+                self.heap = [entry for entry in self.heap if self.items.get(entry[2], (None,))[0] == entry[1]]
+                heapq.heapify(self.heap)
+
+    def __len__(self):
+        return len(self.items)
+
+    def _run(self):
+        while True:
+            expired = []
+
+            with self.condition:
+                now = time.time()
+
+                while self.heap and self.heap[0][0] <= now:
+                    deadline, token, key = heapq.heappop(self.heap)
+                    item = self.items.get(key)
+
+                    # cancelled or rescheduled
+                    if item is None or item[0] != token:
+                        continue
+
+                    # activity moved deadline
+                    deadline = item[1]()
+                    if deadline is not None and deadline > now:
+                        heapq.heappush(self.heap, (deadline, token, key))
+                        continue
+
+                    del self.items[key]
+                    if deadline is not None:
+                        expired.append(item[2])
+
+                if not expired:
+                    self.condition.wait(self.heap[0][0] - now if self.heap else None)
+
+            for on_expire in expired:
+                try:
+                    on_expire()
+                except Exception as exc:
+                    logger.exception(exc)
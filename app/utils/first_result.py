@@ -0,0 +1,46 @@
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Callable, List
+
+
+def first_result(functions: List[Callable], hedge_delay: float, deadline: float):
+    """
+    Result of the first function which returns not None (hedged calls).
+
+    Functions are started one by one: the next function starts when previous ones failed
+    or didn't answer in `hedge_delay` seconds. When the result is found or `deadline` seconds
+    are over, still running functions are abandoned. Exception of a function is raised immediately.
+
+    @return: result or None if all functions failed or deadline is over
+    """
+    functions = iter(functions)
+    expires_at = time.monotonic() + deadline
+    executor = ThreadPoolExecutor()
+    pending = set()
+
+    try:
+        while True:
+
+            remaining = expires_at - time.monotonic()
+            if remaining <= 0:
+                return None
+
+            # start next function
+            function = next(functions, None)
+            if function:
+                pending.add(executor.submit(function))
+
+            if not pending:
+                return None
+
+            # wait for result (the last function waits until deadline)
+            done, pending = wait(pending, min(hedge_delay, remaining) if function else remaining, FIRST_COMPLETED)
+
+            for future in done:
+                result = future.result()
+                if result is not None:
+                    return result
+
+    finally:
+        # don't wait for abandoned functions
+        executor.shutdown(wait=False, cancel_futures=True)
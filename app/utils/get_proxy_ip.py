@@ -1,4 +1,12 @@
+import functools
+import threading
+from typing import Dict
+from urllib.parse import urlsplit
+
 import requests
+from decouple import config
+
+from app.utils.first_result import first_result
 
 GET_IP_URLS = {
     'http://ip-api.com/json/?fields=61439': 'query',
@@ -7,9 +15,17 @@ GET_IP_URLS = {
     'https://api.my-ip.io/ip.json': 'ip',
     'https://api.bigdatacloud.net/data/client-ip': 'ipString',
 }
+PROXY_PROBE_DEADLINE = config('PROXY_PROBE_DEADLINE', default=15, cast=float) # sec
+PROXY_PROBE_HEDGE_DELAY = config('PROXY_PROBE_HEDGE_DELAY', default=2, cast=float) # sec before asking the next url
+PROBE_POOL_SIZE = 32 # keep-alive connections per url host
+PROBE_MAX_PROXY_MANAGERS = 64 # proxy urls (sticky sessions) with kept-alive connections per upstream
+
+SESSIONS: Dict[str, requests.Session] = {} # upstream host:port -> session with connection pool
+SESSIONS_LOCK = threading.Lock()
 
 BROKEN_URL_EXCEPTIONS = (
     requests.exceptions.JSONDecodeError,
+    KeyError,
 )
 
 BROKEN_PROXY_EXCEPTIONS = (
@@ -19,27 +35,78 @@ BROKEN_PROXY_EXCEPTIONS = (
 )
 
 
-def get_proxy_ip(proxy: str):
-    for url, ip_json_key in GET_IP_URLS.items():
-        try:
+def get_proxy_ip(proxy: str, deadline: float = PROXY_PROBE_DEADLINE):
+    """
+    Exit IP of proxy from the fastest of GET_IP_URLS.
+
+    Urls are asked with hedging: the next url is asked when previous ones failed
+    or didn't answer in PROXY_PROBE_HEDGE_DELAY seconds.
+    """
+    try:
+        return first_result([
+            functools.partial(request_ip, url, ip_json_key, proxy, deadline) for url, ip_json_key in GET_IP_URLS.items()
+        ], PROXY_PROBE_HEDGE_DELAY, deadline)
+
+    except BROKEN_PROXY_EXCEPTIONS:
+        # proxy not available
+        return None
+
+
+def request_ip(url: str, ip_json_key: str, proxy: str, timeout: float):
+    try:
+
+        # send request
+        response = get_session(proxy).get(url, proxies={
+            'http': proxy,
+            'https': proxy
+        }, timeout=timeout)
+
+        return response.json()[ip_json_key]
+
+    except BROKEN_URL_EXCEPTIONS:
+        # url not available
+        return None
+
+
+class ProbeAdapter(requests.adapters.HTTPAdapter):
+    """
+    Adapter with the least recently used proxy managers only.
+
+    Every proxy url (password with random sticky session) has its own manager with connection pools,
+    so managers over `max_proxy_managers` are closed instead of growing with every probed session.
+    """
+
+    def __init__(self, *args, max_proxy_managers: int = PROBE_MAX_PROXY_MANAGERS, **kwargs):
+        self.max_proxy_managers = max_proxy_managers
+        self.proxy_managers_lock = threading.Lock()
+        super().__init__(*args, **kwargs)
+
+    def proxy_manager_for(self, proxy, **proxy_kwargs):
+        with self.proxy_managers_lock:
+            manager = super().proxy_manager_for(proxy, **proxy_kwargs)
 
-            # send request
-            response = requests.get(url, proxies={
-                'http': proxy,
-                'https': proxy
-            }, timeout=15)
+            # the latest used is the last
+            self.proxy_manager[proxy] = self.proxy_manager.pop(proxy)
+            while len(self.proxy_manager) > self.max_proxy_managers:
+                self.proxy_manager.pop(next(iter(self.proxy_manager))).clear()
 
-            proxy_ip = response.json()[ip_json_key]
+        return manager
 
-            # success
-            return proxy_ip
 
-        except BROKEN_PROXY_EXCEPTIONS:
-            # proxy not available
-            break
+def get_session(proxy: str):
+    """Shared session of upstream, so probes reuse connections instead of a new one per request"""
+    proxy_url = urlsplit(proxy)
+    upstream = f'{proxy_url.hostname}:{proxy_url.port}'
 
-        except BROKEN_URL_EXCEPTIONS:
-            # url not available
-            continue
+    session = SESSIONS.get(upstream)
+    if session is None:
+        with SESSIONS_LOCK:
+            session = SESSIONS.get(upstream)
+            if session is None:
+                session = requests.Session()
+                adapter = ProbeAdapter(pool_connections=len(GET_IP_URLS), pool_maxsize=PROBE_POOL_SIZE)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                session = SESSIONS[upstream] = session
 
-    return None
+    return session
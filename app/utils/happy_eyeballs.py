@@ -0,0 +1,135 @@
+import asyncio
+import errno
+import os
+import selectors
+import socket
+import time
+from typing import Dict, List, Tuple
+
+from decouple import config
+
+DIRECT_CONNECT_DELAY = config('DIRECT_CONNECT_DELAY', default=0.25, cast=float) # sec before the next address is tried
+DIRECT_CONNECT_TIMEOUT = config('DIRECT_CONNECT_TIMEOUT', default=5, cast=float) # sec per address
+DIRECT_CONNECT_DEADLINE = config('DIRECT_CONNECT_DEADLINE', default=10, cast=float) # sec for all addresses
+
+
+def connect_first(addresses: List[str], port: int, delay: float = DIRECT_CONNECT_DELAY, attempt_timeout: float = DIRECT_CONNECT_TIMEOUT, deadline: float = DIRECT_CONNECT_DEADLINE) -> socket.socket:
+    """
+    Connection to the first address that answers (happy eyeballs, RFC 8305).
+
+    Attempts are started one by one: the next when previous ones failed or didn't connect in `delay` seconds.
+    The first connected socket is returned (blocking), the rest are closed.
+
+    @raise OSError: error of the last failed attempt, TimeoutError when attempts or `deadline` are over
+    """
+    expires_at = time.monotonic() + deadline
+    pending = list(addresses)
+    attempts: Dict[socket.socket, Tuple[str, float]] = {} # connection -> (address, expires at)
+    error = None
+
+    with selectors.DefaultSelector() as selector:
+        try:
+            while pending or attempts:
+                now = time.monotonic()
+                if now >= expires_at:
+                    raise TimeoutError(f'connection to {", ".join(addresses)} port {port} timed out')
+
+                # start next attempt
+                if pending:
+                    address = pending.pop(0)
+                    connection = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                    connection.setblocking(False)
+                    code = connection.connect_ex((address, port))
+
+                    if code not in (0, errno.EINPROGRESS):
+                        error = OSError(code, f'{os.strerror(code)} ({address}:{port})')
+                        connection.close()
+                        continue
+
+                    attempts[connection] = (address, now + attempt_timeout)
+                    selector.register(connection, selectors.EVENT_WRITE)
+
+                # wait for attempts, the next address is tried after delay
+                timeout = min([expires_at] + [attempt_expires_at for _, attempt_expires_at in attempts.values()]) - now
+                if pending:
+                    timeout = min(timeout, delay)
+
+                for key, _ in selector.select(max(timeout, 0)):
+                    connection = key.fileobj
+                    address, _ = attempts.pop(connection)
+                    selector.unregister(connection)
+
+                    code = connection.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                    if code == 0:
+                        connection.setblocking(True)
+                        return connection
+
+                    error = OSError(code, f'{os.strerror(code)} ({address}:{port})')
+                    connection.close()
+
+                # drop attempts out of time
+                now = time.monotonic()
+                for connection, (address, attempt_expires_at) in list(attempts.items()):
+                    if now >= attempt_expires_at:
+                        del attempts[connection]
+                        selector.unregister(connection)
+                        connection.close()
+                        error = TimeoutError(f'connection to {address}:{port} timed out')
+
+        finally:
+            for connection in attempts:
+                connection.close()
+
+    raise error or OSError('no address to connect')
+
+
+async def connect_first_async(loop: asyncio.AbstractEventLoop, addresses: List[str], port: int, delay: float = DIRECT_CONNECT_DELAY, attempt_timeout: float = DIRECT_CONNECT_TIMEOUT, deadline: float = DIRECT_CONNECT_DEADLINE) -> socket.socket:
+    """Same as `connect_first`, but attempts are coroutines on the event loop (returned socket is non-blocking)"""
+    expires_at = loop.time() + deadline
+    pending = list(addresses)
+    attempts: Dict[asyncio.Task, Tuple[socket.socket, str]] = {} # attempt -> (connection, address)
+    error = None
+
+    try:
+        while pending or attempts:
+            remaining = expires_at - loop.time()
+            if remaining <= 0:
+                raise TimeoutError(f'connection to {", ".join(addresses)} port {port} timed out')
+
+            # start next attempt
+            if pending:
+                connection = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                connection.setblocking(False)
+                address = pending.pop(0)
+                attempt = asyncio.wait_for(loop.sock_connect(connection, (address, port)), attempt_timeout)
+                attempts[loop.create_task(attempt)] = (connection, address)
+
+            # wait for attempts, the next address is tried after delay
+            done, _ = await asyncio.wait(attempts, timeout=min(delay, remaining) if pending else remaining, return_when=asyncio.FIRST_COMPLETED)
+
+            winner = None
+            for task in done:
+                connection, address = attempts.pop(task)
+
+                if winner is None and not task.exception():
+                    winner = connection
+                    continue
+
+                if isinstance(task.exception(), asyncio.TimeoutError):
+                    error = TimeoutError(f'connection to {address}:{port} timed out')
+                elif task.exception():
+                    error = task.exception()
+                connection.close()
+
+            if winner:
+                return winner
+
+    finally:
+        # sockets are closed when their attempts are finished (loop has no readers of closed descriptors)
+        for task in attempts:
+            task.cancel()
+        await asyncio.gather(*attempts, return_exceptions=True)
+        for connection, _ in attempts.values():
+            connection.close()
+
+    raise error or OSError('no address to connect')
@@ -0,0 +1,44 @@
+import struct
+import time
+from typing import Iterator, NamedTuple
+
+FRAME = struct.Struct('>BQdI') # kind, tunnel id, unix time, payload size
+
+# kinds of frame (0 - end of data)
+OUTGOING = 1 # payload sent to remote
+INCOMING = 2 # payload received from remote
+OPEN = 3 # connection opened, payload is `address:port` of remote
+CLOSE = 4 # connection closed, no payload
+
+KINDS = {OUTGOING: 'outgoing', INCOMING: 'incoming', OPEN: 'open', CLOSE: 'close'}
+
+
+class Frame(NamedTuple):
+    kind: int
+    tunnel_id: int
+    timestamp: float
+    payload: bytes
+
+
+def pack_frame(kind: int, tunnel_id: int, payload: bytes = b'') -> bytes:
+    return FRAME.pack(kind, tunnel_id, time.time(), len(payload)) + payload
+
+
+def iter_frames(buffer, position: int = 0) -> Iterator[Frame]:
+    """Frames of bytes-like buffer from position until its end or zero padding, payload is copied one frame at a time"""
+    view = memoryview(buffer)
+
+    try:
+        while position + FRAME.size <= len(view) and view[position]:
+            kind, tunnel_id, timestamp, size = FRAME.unpack_from(view, position)
+            position += FRAME.size
+
+            # truncated frame (writer was killed)
+            if position + size > len(view):
+                break
+
+            yield Frame(kind, tunnel_id, timestamp, bytes(view[position:position + size]))
+            position += size
+    finally:
+        # buffer (mmap) can be closed only without exported views
+        view.release()
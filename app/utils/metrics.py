@@ -0,0 +1,141 @@
+from bisect import bisect_left
+from typing import Callable, Dict, List, Tuple, Union
+
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10) # sec
+
+
+class Counter:
+    """
+    Monotonic counter with optional single label.
+
+    Increment is a plain add under GIL without lock: a rare lost update is acceptable for metrics.
+    """
+
+    __slots__ = ('name', 'help', 'label', 'values')
+
+    def __init__(self, name: str, help: str, label: str = None):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.values = {}
+
+    def inc(self, amount: float = 1, label_value: str = ''):
+        self.values[label_value] = self.values.get(label_value, 0) + amount
+
+    def snapshot(self):
+        return {'name': self.name, 'type': 'counter', 'help': self.help, 'label': self.label, 'values': dict(self.values)}
+
+
+class Histogram:
+    """
+    Distribution of values in fixed buckets.
+    """
+
+    __slots__ = ('name', 'help', 'buckets', 'counts', 'sum')
+
+    def __init__(self, name: str, help: str, buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1) # the last is +Inf
+        self.sum = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def snapshot(self):
+        return {'name': self.name, 'type': 'histogram', 'help': self.help, 'buckets': list(self.buckets), 'counts': list(self.counts), 'sum': self.sum}
+
+
+class Gauge:
+    """
+    Value computed on snapshot: number or {label value: number}.
+    """
+
+    __slots__ = ('name', 'help', 'label', 'function', 'type')
+
+    def __init__(self, name: str, help: str, function: Callable[[], Union[float, Dict[str, float]]], label: str = None, type: str = 'gauge'):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.function = function
+        self.type = type
+
+    def snapshot(self):
+        value = self.function()
+        return {'name': self.name, 'type': self.type, 'help': self.help, 'label': self.label, 'values': value if isinstance(value, dict) else {'': value}}
+
+
+class Metrics:
+    """
+    Registry of metrics of the process. Snapshot is a JSON-serializable list, so it can be sent over control socket.
+    """
+
+    metrics: Dict[str, Union[Counter, Histogram, Gauge]] # name -> metric
+
+    def __init__(self):
+        self.metrics = {}
+
+    def counter(self, name: str, help: str, label: str = None) -> Counter:
+        return self.metrics.setdefault(name, Counter(name, help, label))
+
+    def histogram(self, name: str, help: str, buckets: Tuple[float, ...] = LATENCY_BUCKETS) -> Histogram:
+        return self.metrics.setdefault(name, Histogram(name, help, buckets))
+
+    def gauge(self, name: str, help: str, function: Callable, label: str = None, type: str = 'gauge') -> Gauge:
+        """
+        @param type: gauge or counter (monotonic value computed on snapshot)
+        """
+        self.metrics[name] = Gauge(name, help, function, label, type)
+        return self.metrics[name]
+
+    def snapshot(self) -> List[dict]:
+        return [metric.snapshot() for metric in list(self.metrics.values())]
+
+
+def merge_snapshots(snapshots: List[List[dict]]) -> List[dict]:
+    """Sum snapshots of processes: values by label, histogram counts"""
+    merged = {}
+
+    for snapshot in snapshots:
+        for metric in snapshot:
+            total = merged.get(metric['name'])
+
+            if total is None:
+                merged[metric['name']] = metric | {key: value.copy() for key, value in metric.items() if isinstance(value, (dict, list))}
+            elif metric['type'] == 'histogram':
+                total['counts'] = [a + b for a, b in zip(total['counts'], metric['counts'])]
+                total['sum'] += metric['sum']
+            else:
+                for label_value, value in metric['values'].items():
+                    total['values'][label_value] = total['values'].get(label_value, 0) + value
+
+    return list(merged.values())
+
+
+def to_prometheus(snapshot: List[dict]) -> str:
+    """Snapshot in Prometheus text exposition format"""
+    lines = []
+
+    for metric in snapshot:
+        lines.append(f'# HELP {metric["name"]} {metric["help"]}')
+        lines.append(f'# TYPE {metric["name"]} {metric["type"]}')
+
+        if metric['type'] == 'histogram':
+            cumulative = 0
+            for bucket, count in zip(metric['buckets'] + ['+Inf'], metric['counts']):
+                cumulative += count
+                lines.append(f'{metric["name"]}_bucket{{le="{bucket}"}} {cumulative}')
+            lines.append(f'{metric["name"]}_sum {metric["sum"]}')
+            lines.append(f'{metric["name"]}_count {cumulative}')
+            continue
+
+        for label_value, value in metric['values'].items():
+            labels = f'{{{metric["label"]}="{label_value}"}}' if metric['label'] else ''
+            lines.append(f'{metric["name"]}{labels} {value}')
+
+    return '\n'.join(lines) + '\n'
+
+
+METRICS = Metrics()
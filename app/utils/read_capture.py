@@ -0,0 +1,71 @@
+"""
+Reader of capture files of inspected traffic (see `app.objetcs.CaptureFile`).
+
+Run: python ./app/utils/read_capture.py <capture directory or file> - prints frames without payload
+"""
+import heapq
+import mmap
+import os
+import sys
+from typing import Iterator, List
+
+from app.objetcs.CaptureFile import FILE_HEADER
+from app.utils.inspector_frames import Frame, KINDS, iter_frames
+
+FILE_SUFFIX = '.pfsc'
+WORKER_PREFIX = 'worker-' # directories of supervisor workers inside directory of entry point
+
+
+def capture_files(path: str):
+    """Capture files of directory in order of writing (or the file itself)"""
+    if os.path.isdir(path):
+        return [os.path.join(path, name) for name in sorted(os.listdir(path)) if name.endswith(FILE_SUFFIX)]
+
+    return [path]
+
+
+def read_capture_file(path: str) -> Iterator[Frame]:
+    """Frames of one file, the file is mapped to memory, not loaded"""
+    with open(path, 'rb') as file:
+        if os.fstat(file.fileno()).st_size <= len(FILE_HEADER):
+            return
+
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as capture:
+            if capture[:len(FILE_HEADER)] != FILE_HEADER:
+                raise ValueError(f'{path} is not a capture file')
+
+            frames = iter_frames(capture, len(FILE_HEADER))
+            try:
+                yield from frames
+            finally:
+                frames.close()
+
+
+def read_capture_files(paths: List[str]) -> Iterator[Frame]:
+    for file_path in paths:
+        yield from read_capture_file(file_path)
+
+
+def read_capture(path: str) -> Iterator[Frame]:
+    """
+    Frames of all capture files of directory (or one file) lazily.
+
+    Captures of supervisor workers (worker-N directories) are merged by time.
+    """
+    workers = [
+        os.path.join(path, name) for name in sorted(os.listdir(path)) if name.startswith(WORKER_PREFIX)
+    ] if os.path.isdir(path) else []
+
+    if not workers:
+        yield from read_capture_files(capture_files(path))
+        return
+
+    yield from heapq.merge(*(
+        read_capture_files(capture_files(directory)) for directory in [path] + workers
+    ), key=lambda frame: frame.timestamp)
+
+
+if __name__ == '__main__':
+    for frame in read_capture(sys.argv[1]):
+        payload = frame.payload.decode() if KINDS[frame.kind] == 'open' else f'{len(frame.payload)} B'
+        print(f'{frame.timestamp:.6f} #{frame.tunnel_id} {KINDS[frame.kind]:<8} {payload}')
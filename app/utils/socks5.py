@@ -0,0 +1,182 @@
+import asyncio
+import socket
+import time
+from typing import Optional, Set, Tuple, Union
+
+GREETING = 'greeting'
+AUTH = 'auth'
+REQUEST = 'request'
+DONE = 'done'
+
+RECV_SIZE = 512 # bytes, the longest request is 262
+
+
+class Socks5Error(ValueError):
+    """Malformed SOCKS5 message"""
+
+
+class Socks5Parser:
+    """
+    Incremental (sans-IO) parser of client side of SOCKS5 handshake: greeting, username/password auth and request.
+
+    Bytes are fed as they are received and a message is returned once it's complete,
+    so short reads and messages sent together are handled the same way.
+    """
+
+    __slots__ = ('stage', 'buffer')
+
+    stage: str # message expected next
+    buffer: bytearray # received and not parsed yet
+
+    def __init__(self):
+        self.stage = GREETING
+        self.buffer = bytearray()
+
+    def feed(self, data: bytes = b'') -> Optional[Union[Set[int], Tuple]]:
+        """
+        Add received bytes.
+
+        @return: message of current stage or None if more bytes are needed:
+            greeting - set of auth methods,
+            auth - (version, username, password),
+            request - (cmd, address type, address, port), address and port are None for unknown address type
+        """
+        self.buffer += data
+
+        if self.stage == GREETING:
+            parsed = self._greeting()
+        elif self.stage == AUTH:
+            parsed = self._auth()
+        elif self.stage == REQUEST:
+            parsed = self._request()
+        else:
+            raise Socks5Error('handshake is finished')
+
+        if parsed is None:
+            return None
+
+        message, size = parsed
+        del self.buffer[:size]
+        self.stage = {GREETING: AUTH, AUTH: REQUEST, REQUEST: DONE}[self.stage]
+        return message
+
+    def leftover(self) -> bytes:
+        """Bytes received after the request (client didn't wait for reply)"""
+        data = bytes(self.buffer)
+        self.buffer.clear()
+        return data
+
+    def _greeting(self):
+        buffer = self.buffer
+        if len(buffer) < 2:
+            return None
+
+        if buffer[0] != 5:
+            raise Socks5Error(f'unsupported version {buffer[0]}')
+
+        size = 2 + buffer[1]
+        if len(buffer) < size:
+            return None
+
+        return set(buffer[2:size]), size
+
+    def _auth(self):
+        buffer = self.buffer
+        if len(buffer) < 2:
+            return None
+
+        username_end = 2 + buffer[1]
+        if len(buffer) < username_end + 1:
+            return None
+
+        size = username_end + 1 + buffer[username_end]
+        if len(buffer) < size:
+            return None
+
+        username = decode(buffer[2:username_end], 'username')
+        password = decode(buffer[username_end + 1:size], 'password')
+        return (buffer[0], username, password), size
+
+    def _request(self):
+        buffer = self.buffer
+        if len(buffer) < 4:
+            return None
+
+        version, cmd, _, address_type = buffer[:4]
+        if version != 5:
+            raise Socks5Error(f'unsupported version {version}')
+
+        if address_type == 1:  # IPv4
+            size = 4 + 4 + 2
+            if len(buffer) < size:
+                return None
+            address = socket.inet_ntoa(buffer[4:8])
+        elif address_type == 3:  # Domain name
+            if len(buffer) < 5:
+                return None
+            size = 5 + buffer[4] + 2
+            if len(buffer) < size:
+                return None
+            address = decode(buffer[5:size - 2], 'domain')
+        elif address_type == 4:  # IPv6
+            size = 4 + 16 + 2
+            if len(buffer) < size:
+                return None
+            address = socket.inet_ntop(socket.AF_INET6, bytes(buffer[4:20]))
+        else:
+            return (cmd, address_type, None, None), 4
+
+        port = int.from_bytes(buffer[size - 2:size], 'big', signed=False)
+        return (cmd, address_type, address, port), size
+
+
+def decode(data: bytearray, field: str) -> str:
+    try:
+        return data.decode('utf-8')
+    except UnicodeDecodeError:
+        raise Socks5Error(f'{field} is not utf-8')
+
+
+def recv_message(connection: socket.socket, parser: Socks5Parser, timeout: float):
+    """
+    Receive message of current stage from blocking socket.
+
+    @param timeout: deadline of the stage (sec)
+    """
+    deadline = time.monotonic() + timeout
+    message = parser.feed()
+
+    while message is None:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise TimeoutError(f'{parser.stage} deadline exceeded')
+
+        connection.settimeout(remaining)
+        data = connection.recv(RECV_SIZE)
+        if not data:
+            raise ConnectionError('connection closed during handshake')
+
+        message = parser.feed(data)
+
+    return message
+
+
+async def recv_message_async(loop: asyncio.AbstractEventLoop, connection: socket.socket, parser: Socks5Parser, timeout: float):
+    """Receive message of current stage from non-blocking socket (see `recv_message`)"""
+
+    async def receive():
+        message = parser.feed()
+
+        while message is None:
+            data = await loop.sock_recv(connection, RECV_SIZE)
+            if not data:
+                raise ConnectionError('connection closed during handshake')
+
+            message = parser.feed(data)
+
+        return message
+
+    try:
+        return await asyncio.wait_for(receive(), timeout)
+    except asyncio.TimeoutError:
+        raise TimeoutError(f'{parser.stage} deadline exceeded')
@@ -0,0 +1,43 @@
+import threading
+import time
+
+MIN_BURST = 4096 # bytes
+
+
+class TokenBucket:
+    """
+    Rate limiter in bytes per second with burst.
+
+    Bytes are taken in advance (tokens can go negative), the caller waits until the debt is paid,
+    so a chunk is never split and waiting doesn't need polling.
+    """
+
+    __slots__ = ('rate', 'burst', 'tokens', 'updated_at', 'lock')
+
+    rate: int # bytes per sec, 0 - unlimited
+    burst: int # bytes
+    tokens: float
+    updated_at: float
+
+    def __init__(self, rate: int = 0, burst: int = None):
+        self.lock = threading.Lock()
+        self.set(rate, burst)
+
+    def set(self, rate: int, burst: int = None):
+        """@param burst: None - one second of rate"""
+        self.rate = rate
+        self.burst = max(burst or rate, MIN_BURST)
+        self.tokens = self.burst
+        self.updated_at = time.monotonic()
+
+    def consume(self, size: int) -> float:
+        """Take `size` bytes, return seconds to wait before next one (0 - no wait)"""
+        if not self.rate:
+            return 0
+
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate) - size
+            self.updated_at = now
+
+            return -self.tokens / self.rate if self.tokens < 0 else 0
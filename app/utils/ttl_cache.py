@@ -0,0 +1,62 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    """
+    Thread-safe LRU mapping with limited size, every entry expires after its own TTL.
+    """
+
+    max_size: int
+    items: OrderedDict # key -> (value, expires at)
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            item = self.items.get(key)
+            if item is None:
+                return default
+
+            value, expires_at = item
+
+            # expired
+            if expires_at <= time.monotonic():
+                del self.items[key]
+                return default
+
+            # recently used
+            self.items.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl: float):
+        with self.lock:
+            self.items[key] = (value, time.monotonic() + ttl)
+            self.items.move_to_end(key)
+
+            # evict least recently used
+            while len(self.items) > self.max_size:
+                self.items.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self.lock:
+            item = self.items.pop(key, None)
+
+        return item[0] if item else default
+
+    def ttl(self, key):
+        """Seconds until entry expires (None if not cached)"""
+        with self.lock:
+            item = self.items.get(key)
+
+        if item is None:
+            return None
+
+        return max(item[1] - time.monotonic(), 0)
+
+    def __len__(self):
+        return len(self.items)
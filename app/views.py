@@ -1,32 +1,136 @@
 """ Views and Urls of application """
 import json
 import random
+import time
+from concurrent.futures import ThreadPoolExecutor
 
-from flask import Blueprint, request
+from decouple import config
+from flask import Blueprint, Response, request
 from marshmallow import ValidationError
 
 from app.objetcs.ForwarderProxy import ForwarderProxy, AVAILABLE_COUNTRIES
+from app.objetcs.WarmProxyPool import WARM_PROXY_POOL
 from app.format_response import success, error
 from app.server.ProxyForwarderServer import ProxyForwarderServer
-from app.serializers import EntryPointSchema
+from app.serializers import EntryPointSchema, EntryPointUpdateSchema
+from app.utils.first_result import first_result
+from app.utils.get_proxy_ip import PROXY_PROBE_DEADLINE
+from app.utils.metrics import to_prometheus
+
+PROXY_CANDIDATES = 3 # proxies probed for one entry point
+PROXY_CANDIDATE_HEDGE_DELAY = config('PROXY_CANDIDATE_HEDGE_DELAY', default=5, cast=float) # sec before probing the next candidate
+BULK_MAX_ITEMS = config('API_BULK_MAX_ITEMS', default=1000, cast=int) # entry points per bulk request
+BULK_PROBE_WORKERS = config('API_BULK_PROBE_WORKERS', default=16, cast=int) # entry points probed concurrently
 
 # registrate Blueprint as route
 routes = Blueprint('routes', __name__)
 
 
+def decode_json_fields(request_data: dict, names: tuple):
+    """
+    Decode JSON values of form fields.
+
+    @raise ValidationError: value is not valid JSON
+    """
+    for name in names:
+        if request_data.get(name):
+            try:
+                request_data[name] = json.loads(request_data[name])
+            except ValueError:
+                raise ValidationError({name: ['Not a valid JSON.']})
+
+
+def find_proxy(validated_data: dict):
+    """
+    Proxy with parameters of entry point and tested connection.
+
+    Session from the warm pool is used if possible.
+
+    Candidates are probed with hedging: the next candidate is probed when previous ones failed
+    or didn't answer in PROXY_CANDIDATE_HEDGE_DELAY seconds, the first valid one wins.
+    """
+    # verified in advance
+    if validated_data.get('ip_duration') and not validated_data.get('ip_session'):
+        proxy = WARM_PROXY_POOL.take(validated_data.get('ip_country'), validated_data.get('ip_duration'))
+        if proxy:
+            return proxy
+
+    expires_at = time.monotonic() + PROXY_PROBE_DEADLINE
+
+    def probe():
+
+        # create proxy object
+        proxy = ForwarderProxy(
+            country=validated_data.get(
+                'ip_country', random.choice(AVAILABLE_COUNTRIES) # set random country if empty
+            ),
+            session=validated_data.get('ip_session', None),
+            duration=validated_data.get('ip_duration', None),
+        )
+
+        # test connection
+        if proxy.get_ip(deadline=expires_at - time.monotonic()):
+            return proxy
+
+    proxy = first_result([probe] * PROXY_CANDIDATES, PROXY_CANDIDATE_HEDGE_DELAY, PROXY_PROBE_DEADLINE)
+
+    if proxy is None:
+        raise ConnectionError('failed to get a valid proxy')
+
+    return proxy
+
+
+def entry_point_kwargs(validated_data: dict, proxy: ForwarderProxy):
+    """Arguments of `ProxyForwarderServer.create_entry_point`"""
+    return {
+        'username': validated_data.get('username'),
+        'password': validated_data.get('password'),
+        'proxy_kwargs': {
+            'country': proxy.country,
+            'session': proxy.session,
+            'duration': proxy.duration,
+        },
+        'client_host': validated_data.get('client_host', None),
+        'inspector': validated_data.get('inspector'),
+        'idle_timeout': validated_data.get('idle_timeout'),
+        'tunnel_idle_timeout': validated_data.get('tunnel_idle_timeout'),
+        'rate_limits': validated_data.get('rate_limits'),
+        'max_tunnels': validated_data.get('max_tunnels', 0),
+    }
+
+
+def created_entry_point_data(validated_data: dict, proxy: ForwarderProxy, created_at: float):
+    return {
+        'proxy_info': {
+            'ip': proxy.ip,
+            'country': proxy.country,
+            'session': proxy.session,
+            'duration': proxy.duration,
+        },
+        'credentials': {
+            'username': validated_data.get('username'),
+            'password': validated_data.get('password'),
+        },
+        'created_at': created_at
+    }
+
+
 @routes.post('/api/v1/entrypoint')
 def entrypoint_create():
     serializer = EntryPointSchema()
 
-    # put client address as inspector address
     request_data = request.form.to_dict()
-    if 'inspector' in request_data and request_data['inspector']:
-        request_data['inspector'] = json.loads(request_data['inspector']) | {
-            'address': request.remote_addr
-        }
 
     # validate data
     try:
+        decode_json_fields(request_data, ('inspector', 'rate_limits'))
+
+        # put client address as inspector address
+        if isinstance(request_data.get('inspector'), dict):
+            request_data['inspector'] = request_data['inspector'] | {
+                'address': request.remote_addr
+            }
+
         validated_data = serializer.load(request_data)
     except ValidationError as exc:
         return error('Invalid data', exc.messages)
@@ -38,52 +142,104 @@ def entrypoint_create():
     if not exists:
 
         # find proxy and test connection
-        for i in range(3):
-
-            # create proxy object
-            proxy = ForwarderProxy(
-                country=validated_data.get(
-                    'ip_country', random.choice(AVAILABLE_COUNTRIES) # set random country if empty
-                ),
-                session=validated_data.get('ip_session', None),
-                duration=validated_data.get('ip_duration', None),
+        try:
+            proxy = find_proxy(validated_data)
+        except ConnectionError as exc:
+            return error(str(exc))
+
+        try:
+            created_at = ProxyForwarderServer.create_entry_point(**entry_point_kwargs(validated_data, proxy))
+        except ValueError as exc:
+            # limits not possible with workers of supervisor
+            return error(str(exc))
+
+        if created_at:
+            return success(
+                f'Entry point `{validated_data.get("username")}` successfully created',
+                data=created_entry_point_data(validated_data, proxy, created_at)
             )
 
-            # test connection
-            if proxy.get_ip():
-                break
+    return error(f'Entry point `{validated_data.get("username")}` already exists')
 
-        else:
-            raise ConnectionError('failed to get a valid proxy')
-
-        created_at = ProxyForwarderServer.create_entry_point(
-            username=validated_data.get('username'),
-            password=validated_data.get('password'),
-            proxy_kwargs={
-                'country': proxy.country,
-                'session': proxy.session,
-                'duration': proxy.duration,
-            },
-            client_host=validated_data.get('client_host', None),
-            inspector=validated_data.get('inspector'),
-        )
 
+@routes.post('/api/v1/entrypoints')
+def entrypoints_create():
+    """
+    Create many entry points: JSON {"entry_points": [{<fields of /api/v1/entrypoint>}, ...]}.
+
+    Result of every entry point is in the same order and format as response of single create.
+    """
+    request_data = (request.get_json(silent=True) or {}).get('entry_points')
+
+    if not isinstance(request_data, list) or not request_data:
+        return error('Entry points not provided')
+
+    if len(request_data) > BULK_MAX_ITEMS:
+        return error(f'Too many entry points. Maximum: {BULK_MAX_ITEMS}')
+
+    serializer = EntryPointSchema()
+    results = [None] * len(request_data)
+    validated = {} # index -> validated data
+
+    for i, item_data in enumerate(request_data):
+
+        # put client address as inspector address
+        if isinstance(item_data, dict) and isinstance(item_data.get('inspector'), dict):
+            item_data['inspector'] = item_data['inspector'] | {
+                'address': request.remote_addr
+            }
+
+        # validate data
+        try:
+            validated[i] = serializer.load(item_data)
+        except ValidationError as exc:
+            results[i] = {'status': 'error', 'message': 'Invalid data', 'data': exc.messages}
+
+    # check connections are exist (one request)
+    exists = ProxyForwarderServer.exists_entry_points([data.get('username') for data in validated.values()])
+
+    # find proxies and test connections (concurrently)
+    proxies = {} # index -> proxy
+    with ThreadPoolExecutor(BULK_PROBE_WORKERS) as executor:
+        probes = {
+            i: executor.submit(find_proxy, validated_data)
+            for i, validated_data in validated.items() if not exists[validated_data.get('username')]
+        }
+
+        for i, probe in probes.items():
+            # failure of one item doesn't fail the others
+            try:
+                proxies[i] = probe.result()
+            except ConnectionError as exc:
+                results[i] = {'status': 'error', 'message': str(exc)}
+            except Exception as exc:
+                results[i] = {'status': 'error', 'message': repr(exc)}
+
+    # create connections (one request)
+    created = {}
+    if proxies:
+        created = dict(zip(proxies, ProxyForwarderServer.create_entry_points([
+            entry_point_kwargs(validated[i], proxy) for i, proxy in proxies.items()
+        ])))
+
+    for i, validated_data in validated.items():
+        if results[i]:
+            continue
+
+        created_at = created.get(i, {}).get('created_at')
         if created_at:
-            return success(f'Entry point `{validated_data.get("username")}` successfully created', data={
-                'proxy_info': {
-                    'ip': proxy.ip,
-                    'country': proxy.country,
-                    'session': proxy.session,
-                    'duration': proxy.duration,
-                },
-                'credentials': {
-                    'username': validated_data.get('username'),
-                    'password': validated_data.get('password'),
-                },
-                'created_at': created_at
-            })
+            results[i] = {
+                'status': 'success',
+                'message': f'Entry point `{validated_data.get("username")}` successfully created',
+                'data': created_entry_point_data(validated_data, proxies[i], created_at),
+            }
+        elif 'error' in created.get(i, {}):
+            results[i] = {'status': 'error', 'message': f'Entry point `{validated_data.get("username")}` not created'}
+        else:
+            results[i] = {'status': 'error', 'message': f'Entry point `{validated_data.get("username")}` already exists'}
 
-    return error(f'Entry point `{validated_data.get("username")}` already exists')
+    created_count = sum(result['status'] == 'success' for result in results)
+    return success(f'{created_count} of {len(results)} entry points created', data={'entry_points': results})
 
 
 @routes.delete('/api/v1/entrypoint')
@@ -100,3 +256,91 @@ def entrypoint_delete():
         message = f'Entry point `{username}` deleted'
 
     return success(message, data=response)
+
+
+@routes.patch('/api/v1/entrypoint')
+def entrypoint_update():
+    serializer = EntryPointUpdateSchema()
+
+    request_data = request.form.to_dict()
+
+    # validate data
+    try:
+        decode_json_fields(request_data, ('rate_limits',))
+        validated_data = serializer.load(request_data)
+    except ValidationError as exc:
+        return error('Invalid data', exc.messages)
+
+    try:
+        response = ProxyForwarderServer.update_entry_point(**validated_data)
+    except ValueError as exc:
+        return error(str(exc))
+
+    if response is None:
+        return error(f'Entry point `{validated_data.get("username")}` not exists')
+
+    return success(f'Entry point `{validated_data.get("username")}` updated', data=response)
+
+
+@routes.get('/api/v1/entrypoint')
+def entrypoint_usage():
+    username = request.args.get('username', None)
+
+    if not username:
+        raise ValidationError('Username not provided')
+
+    response = ProxyForwarderServer.entry_point_usage(username)
+    if response is None:
+        return error(f'Entry point `{username}` not exists')
+
+    return success(f'Entry point `{username}` usage', data=response)
+
+
+@routes.delete('/api/v1/entrypoints')
+def entrypoints_delete():
+    """Delete many entry points: JSON {"usernames": [...]}"""
+    usernames = (request.get_json(silent=True) or {}).get('usernames')
+
+    if not isinstance(usernames, list) or not usernames:
+        raise ValidationError('Usernames not provided')
+
+    if len(usernames) > BULK_MAX_ITEMS:
+        return error(f'Too many entry points. Maximum: {BULK_MAX_ITEMS}')
+
+    response = ProxyForwarderServer.delete_entry_points([str(username) for username in usernames])
+    deleted_count = sum(result is not None for result in response.values())
+
+    return success(f'{deleted_count} of {len(response)} entry points deleted', data=response)
+
+
+@routes.get('/api/v1/entrypoints')
+def entrypoints_exists():
+    """Check many entry points: ?username=...&username=..."""
+    usernames = request.args.getlist('username')
+
+    if not usernames:
+        raise ValidationError('Username not provided')
+
+    if len(usernames) > BULK_MAX_ITEMS:
+        return error(f'Too many entry points. Maximum: {BULK_MAX_ITEMS}')
+
+    response = ProxyForwarderServer.exists_entry_points(usernames)
+    exists_count = sum(response.values())
+
+    return success(f'{exists_count} of {len(response)} entry points exist', data=response)
+
+
+@routes.get('/api/v1/proxypool')
+def proxypool_stats():
+    return success('Warm proxy pool', data=WARM_PROXY_POOL.stats())
+
+
+@routes.get('/api/v1/gateways')
+def gateways_stats():
+    return success('Upstream gateways', data=ProxyForwarderServer.gateway_stats())
+
+
+@routes.get('/metrics')
+def metrics():
+    # collected by server process, relay is not touched
+    return Response(to_prometheus(ProxyForwarderServer.metrics()), mimetype='text/plain; version=0.0.4')